@@ -1,332 +1,1249 @@
 import dagster as dg
-import sqlite3
+import functools
+import inspect
 import os
+import tempfile
+import time
 from pathlib import Path
-from typing import Any, Callable
-from markitdown import MarkItDown, DocumentConverterResult
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, NamedTuple
 from . import resources
+from ..utils import (
+    chunking,
+    conversion_engine,
+    embedding,
+    hashing,
+    instrumentation,
+    markdown_plain,
+)
+from ..utils.converters import (
+    REGISTRY,
+    STREAMING_REGISTRY,
+    register,
+    convert_dummy,
+    convert_docx,
+    convert_pdf,
+)
 
 import logging
 logger = logging.getLogger(__name__)
+# Relative to the working directory, which is the project root under
+# Dagster. The file is only opened by the first record logged.
+LOG_FILE = os.environ.get("INGESTION_LOG_FILE", "./logs/asset_logs.txt")
+os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
 logging.basicConfig(
-    filename="./logs/asset_logs.txt",
-    encoding="utf-8",
+    handlers=[logging.FileHandler(LOG_FILE, encoding="utf-8", delay=True)],
     level=logging.INFO
 )
 
 
 files_partition_def = dg.DynamicPartitionsDefinition(name="files")
 
+# Upper bound on partitions handled by one run. The sensor batches new
+# files up to this size and UI backfills are split into runs of this size;
+# `binary_files` finds the files of backfilled keys from the bucket.
+RUN_BATCH_SIZE = 100
+
 COMMON_ASSET_ARGS: dict[str, Any] = dict(
     partitions_def=files_partition_def,
     metadata={"partition_expr": "bucket_key"},
     code_version="v1",
-    io_manager_key="bucket_io_manager"
+    io_manager_key="bucket_io_manager",
+    backfill_policy=dg.BackfillPolicy.multi_run(
+        max_partitions_per_run=RUN_BATCH_SIZE
+    ),
+)
+# Files at least this large take the large-file lane: the sensor gives
+# each a run of its own and conversion streams them page by page (the
+# markdown they produce is still held whole afterwards)
+LARGE_FILE_BYTES = int(
+    os.environ.get("INGESTION_LARGE_FILE_BYTES", str(32 * 1024 * 1024))
 )
 CHUNK_SIZE = 128
-REGISTRY: dict[str, Callable[[str | Path], DocumentConverterResult]] = {}
+TOP_K = 10
+# Minimum cosine similarity for each relationship grade, strongest first
+RELATIONSHIP_THRESHOLDS = (("A", 0.95), ("B", 0.85), ("C", 0.7))
+
+
+def _op_config(context: dg.AssetExecutionContext) -> dict[str, Any]:
+    """The config of this asset's op; `context.op_config` is deprecated."""
+    return context.op_execution_context.op_config
+
+
+def _partition_keys(context: dg.AssetExecutionContext) -> list[str]:
+    """Keys handled by this run: one for a partition run, many for a range."""
+    if context.has_partition_key_range:
+        return list(context.partition_keys)
+    assert context.has_partition_key is True, "Error: No Partition Key"
+    return [context.partition_key]
+
+
+# Directory for Prometheus textfile metrics (node_exporter's textfile
+# collector); unset, stage stats only go to asset metadata and the log
+METRICS_DIR = os.environ.get("INGESTION_METRICS_DIR")
+
+
+def _instrumented(fn: Callable) -> Callable:
+    """Measure an asset's compute function (see `utils.instrumentation`).
+
+    Every output gets the stage's wall, CPU and DB time, conversion time,
+    bytes in/out and peak RSS as `perf/*` metadata, and the stats are kept
+    in the database for the sensor's admission control. Works for plain
+    and generator (multi-asset) compute functions alike.
+    """
+    def report(stats: instrumentation.StageStats,
+               outputs: list[dg.Output],
+               args: tuple) -> list[dg.Output]:
+        stats.bytes_out = sum(
+            getattr(output.value, "nbytes", 0) for output in outputs
+        )
+        logger.info(f"{stats.stage}: {stats.metadata()}")
+        for resource in args:
+            if isinstance(resource, resources.SQLiteResource):
+                resource.record_stage_stats(stats)
+        if METRICS_DIR:
+            instrumentation.write_textfile(stats, METRICS_DIR)
+        return [
+            output.with_metadata({**output.metadata, **stats.metadata()})
+            for output in outputs
+        ]
+
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def gen_wrapper(context: dg.AssetExecutionContext, *args, **kwargs):
+            with instrumentation.measure(
+                fn.__name__, len(_partition_keys(context))
+            ) as stats:
+                outputs = list(fn(context, *args, **kwargs))
+            yield from report(stats, outputs, (*args, *kwargs.values()))
+        return gen_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(context: dg.AssetExecutionContext, *args, **kwargs):
+        with instrumentation.measure(
+            fn.__name__, len(_partition_keys(context))
+        ) as stats:
+            output = fn(context, *args, **kwargs)
+        [output] = report(stats, [output], (*args, *kwargs.values()))
+        return output
+    return wrapper
+
+
+# Digest characters kept in data versions
+VERSION_CHARS = 16
+
+
+def _hash(value: str) -> str:
+    """Stable content digest of a stage output, for its data version."""
+    return hashing.text_digest(value)[:VERSION_CHARS]
+
+
+def _input_version(upstream_version: str, *salt: str) -> str:
+    """Version of a stage's inputs for one partition.
+
+    Combines the upstream data version with the asset code version and
+    whatever else (config, cache tags) the stage's output depends on.
+    """
+    return _hash("\n".join(
+        [upstream_version, COMMON_ASSET_ARGS["code_version"], *salt]
+    ))
+
+
+def _input_versions(db: resources.SQLiteResource,
+                    upstream: str,
+                    bucket_keys: list[str],
+                    *salt: str) -> dict[str, str]:
+    """`_input_version` of each partition the upstream stage has versioned."""
+    return {
+        bucket_key: _input_version(output_version, *salt)
+        for bucket_key, (_, output_version)
+        in db.get_stage_versions(upstream, bucket_keys).items()
+    }
+
+
+# The stage whose data version each stage's inputs derive from
+UPSTREAM_STAGE: dict[str, str] = {
+    "markdown_files": "binary_files",
+    "json_files": "markdown_files",
+    "plain_files": "markdown_files",
+    "chunks": "plain_files",
+    "vec_embeddings": "chunks",
+    "relationships": "vec_embeddings",
+}
+
+
+def stage_input_versions(db: resources.SQLiteResource,
+                         stage: str,
+                         bucket_keys: list[str],
+                         op_config: dict[str, Any] | None = None
+                         ) -> dict[str, str]:
+    """`_input_version` of each partition for a stage below `binary_files`.
+
+    `op_config` is the stage's op config; anything left out takes its
+    default, as in a run.
+    """
+    assert stage in UPSTREAM_STAGE, \
+        f"Error: Unknown stage ({stage}), expected {list(UPSTREAM_STAGE)}"
+    schema = {
+        "chunks": CHUNK_CONFIG,
+        "vec_embeddings": EMBED_CONFIG,
+        "relationships": RELATIONSHIP_CONFIG,
+    }.get(stage, {})
+    config = {
+        **{name: field.default_value for name, field in schema.items()},
+        **(op_config or {}),
+    }
+    salt: tuple[str, ...] = ()
+    if stage == "plain_files":
+        salt = (PLAIN_CACHE_TAG,)
+    elif stage == "chunks":
+        salt = (_chunks_cache_tag({name: config[name] for name in schema}),)
+    elif stage == "vec_embeddings":
+        embedder = embedding.get_embedder(config["embedder"],
+                                          dim=config["dim"])
+        salt = (embedder.name, str(embedder.dim))
+    elif stage == "relationships":
+        # Neighbours depend on every document's embeddings, so the inputs
+        # also change whenever any document's embeddings do
+        salt = (str(db.stage_epoch("vec_embeddings")),
+                str(config["top_k"]), str(config["nprobe"]))
+    return _input_versions(db, UPSTREAM_STAGE[stage], bucket_keys, *salt)
+
+
+def _unchanged(db: resources.SQLiteResource,
+               stage: str,
+               input_versions: dict[str, str]) -> dict[str, str]:
+    """Partitions whose inputs match their last materialization.
+
+    Maps each to the data version that materialization produced. Such
+    partitions are skipped entirely: nothing is computed, written to
+    SQLite or rewritten in the IO manager's store.
+    """
+    unchanged = {
+        bucket_key: output_version
+        for bucket_key, (input_version, output_version)
+        in db.get_stage_versions(stage, input_versions).items()
+        if input_versions[bucket_key] == input_version
+    }
+    if unchanged:
+        logger.info(f"{stage}: {len(unchanged)} unchanged, skipped")
+    return unchanged
+
+
+def _record_versions(db: resources.SQLiteResource,
+                     stage: str,
+                     input_versions: dict[str, str],
+                     output_versions: dict[str, str]) -> None:
+    """Remember what each computed partition was made from.
+
+    Called only once the stage's outputs are written, so a run that dies
+    half way is recomputed rather than skipped next time.
+    """
+    db.put_stage_versions(stage, (
+        (bucket_key, input_versions[bucket_key], output_version)
+        for bucket_key, output_version in output_versions.items()
+        if bucket_key in input_versions
+    ))
+
+
+def _output(hashes: dict[str, str],
+            value: Any = None,
+            output_name: str = "result",
+            unchanged: Iterable[str] = ()) -> dg.Output:
+    """Build the asset output from each partition's content hash.
+
+    A ranged run can only report one data version for the whole range, so
+    batches get a version derived from every key's hash. `value` is the
+    stage's Arrow table, which the IO manager exports, or None when it
+    does not; it holds no rows for the `unchanged` partitions, which the
+    IO manager leaves alone.
+    """
+    if len(hashes) == 1:
+        [(bucket_key, value_hash)] = hashes.items()
+        version = "-".join([bucket_key, value_hash])
+    else:
+        batch_hash = hashing.iter_digest(
+            f"{bucket_key}:{value_hash}"
+            for bucket_key, value_hash in sorted(hashes.items())
+        )[:VERSION_CHARS]
+        version = "-".join([f"batch{len(hashes)}", batch_hash])
+    return dg.Output(
+        value=value,
+        output_name=output_name,
+        data_version=dg.DataVersion(version),
+        metadata={
+            resources.UNCHANGED_METADATA_KEY:
+                dg.MetadataValue.json(sorted(unchanged))
+        },
+    )
+
 
-def register(file_type: str):
-    def inner(fn: Callable):
-        REGISTRY[file_type] = fn
-        return fn
-    return inner
+class StageResult(NamedTuple):
+    """What a stage's compute function did for a set of partitions.
+
+    `versions` maps each computed partition to its data version and
+    `unchanged` each skipped one to the version it already had; `table`
+    is the Arrow table of the computed partitions, only built when the
+    stage was asked to `export` it (None otherwise).
+    """
+    versions: dict[str, str]
+    unchanged: dict[str, str]
+    table: Any
+
+
+def _stage_output(res: StageResult, output_name: str = "result") -> dg.Output:
+    return _output({**res.unchanged, **res.versions}, res.table,
+                   output_name=output_name, unchanged=res.unchanged)
+
+
+def _exporting(context: dg.AssetExecutionContext) -> bool:
+    """Whether the IO manager keeps Arrow copies of this run's outputs.
+
+    Assets invoked directly have no IO manager, and export nothing.
+    """
+    io_manager = getattr(context.resources, "bucket_io_manager", None)
+    return bool(io_manager and io_manager.export)
+
+
+def _text_table(stage: str, column: str, values: dict[str, str]) -> Any:
+    from ..utils import columnar
+    return columnar.table(stage, {
+        "bucket_key": list(values),
+        column: list(values.values()),
+    })
+
+
+def _cached_stage(
+    db: resources.SQLiteResource,
+    bucket_keys: list[str],
+    source_stage: str,
+    stage: str,
+    cache_tag: str,
+    compute: Callable[[dict[str, Any]], dict[str, Any]],
+) -> dict[str, Any]:
+    """Produce `stage` for each key, reusing outputs cached by content digest.
+
+    Keys whose source file digest is already in the cache skip the work
+    entirely. The rest are grouped by digest so duplicate uploads within a
+    batch are computed once; `compute` maps content id -> source value to
+    content id -> output and may leave out inputs it could not handle.
+    """
+    digests: dict[str, str] = db.get_stages(bucket_keys, "digest")
+    cached = db.get_cached(digests.values(), cache_tag)
+    outputs: dict[str, Any] = {
+        bucket_key: cached[digests[bucket_key]]
+        for bucket_key in bucket_keys
+        if digests.get(bucket_key) in cached
+    }
+    sources = db.get_stages(
+        [bucket_key for bucket_key in bucket_keys
+         if bucket_key not in outputs],
+        source_stage
+    )
+    logger.info(f"{stage}: {len(outputs)} cached, {len(sources)} to compute")
+
+    # Rows written before digests existed fall back to their own key
+    content_ids = {
+        bucket_key: digests.get(bucket_key) or bucket_key
+        for bucket_key in sources
+    }
+    todo: dict[str, Any] = {}
+    for bucket_key, content_id in content_ids.items():
+        todo.setdefault(content_id, sources[bucket_key])
+    computed = compute(todo) if todo else {}
+    for bucket_key, content_id in content_ids.items():
+        if content_id in computed:
+            outputs[bucket_key] = computed[content_id]
+
+    known_digests = set(digests.values())
+    db.put_cached(cache_tag, (
+        (content_id, value) for content_id, value in computed.items()
+        if content_id in known_digests
+    ))
+    db.put_stages(stage, outputs.items())
+    return outputs
 
 
 @dg.asset(
     **COMMON_ASSET_ARGS,
-    config_schema={"file_path": str}
+    config_schema={
+        "file_path": dg.Field(str, is_required=False),
+        "file_paths": dg.Field(dg.Map(str, str), is_required=False),
+    }
 )
+@_instrumented
 def binary_files(
     context: dg.AssetExecutionContext,
-    db: resources.SQLiteResource
+    db: resources.SQLiteResource,
+    bucket: resources.BucketResource
 ) -> dg.Output:
-    assert context.has_partition_key is True, "Error: No Partition Key"
-    bucket_key: str = context.partition_key
+    """Record where each partition's file lives.
+
+    Single-partition runs pass `file_path`; batched runs pass `file_paths`
+    mapping every bucket key in the range to its file. Keys without one,
+    as in backfills launched from the UI, are looked up in the bucket.
+    `s3://` paths are fetched into the bucket's local spool and the
+    spooled path recorded.
+    """
+    bucket_keys = _partition_keys(context)
 
     logger.info("binary_files asset")
-    logger.info(f"{bucket_key = }")
-    logger.info(f"{context.run_config = }")
-    logger.info(f"{context.op_config = }")
-    logger.info(f"{context.resources = }")
-
-    db_path: str = db.db_path
-    filepath = context.op_config["file_path"]
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        query = """
-        INSERT INTO files (bucket_key, file_path) VALUES (?, ?)
-        """
-        logger.info(f"{query = }")
-        cur.execute(query, (bucket_key, filepath))
-        conn.commit()
-
-    filehash = str(hash(filepath) % (10 ** 10))
-    return dg.Output(
-        value=None,
-        data_version=dg.DataVersion("-".join([bucket_key, filehash]))
+    logger.info(f"{len(bucket_keys) = }")
+
+    config = _op_config(context)
+    file_paths: dict[str, str] = dict(config.get("file_paths", {}))
+    if "file_path" in config:
+        assert len(bucket_keys) == 1, "Error: file_path given for a batch"
+        file_paths[bucket_keys[0]] = config["file_path"]
+    return _stage_output(compute_binary_files(
+        db, bucket, {bucket_key: file_paths.get(bucket_key)
+                     or bucket.source_path(bucket_key)
+                     for bucket_key in bucket_keys},
+        export=_exporting(context)
+    ))
+
+
+def compute_binary_files(db: resources.SQLiteResource,
+                         bucket: resources.BucketResource,
+                         file_paths: dict[str, str],
+                         export: bool = False) -> StageResult:
+    """`binary_files` for the partitions, given each one's file path."""
+    from ..utils import columnar
+    bucket_keys = list(file_paths)
+
+    def fetch_and_hash(bucket_key: str) -> tuple[str, str]:
+        local_path = bucket.fetch(file_paths[bucket_key])
+        return local_path, hashing.file_digest(local_path)
+
+    # Downloads and hashing release the GIL, so threads overlap them
+    # across a batch
+    with ThreadPoolExecutor() as pool:
+        fetched = dict(zip(bucket_keys, pool.map(fetch_and_hash, bucket_keys)))
+    file_paths = {
+        bucket_key: local_path
+        for bucket_key, (local_path, _) in fetched.items()
+    }
+    digests: dict[str, str] = {
+        bucket_key: digest
+        for bucket_key, (_, digest) in fetched.items()
+    }
+    # Every byte was read to hash it
+    instrumentation.add("bytes_in", sum(
+        os.path.getsize(local_path) for local_path in file_paths.values()
+    ))
+
+    input_versions = {
+        bucket_key: _input_version(digests[bucket_key], file_paths[bucket_key])
+        for bucket_key in bucket_keys
+    }
+    unchanged = _unchanged(db, "binary_files", input_versions)
+    todo = [bucket_key for bucket_key in bucket_keys
+            if bucket_key not in unchanged]
+
+    db.put_stages("file_path", (
+        (bucket_key, file_paths[bucket_key]) for bucket_key in todo
+    ))
+    db.put_stages("digest", (
+        (bucket_key, digests[bucket_key]) for bucket_key in todo
+    ))
+    versions = {
+        bucket_key: digests[bucket_key][:VERSION_CHARS] for bucket_key in todo
+    }
+    _record_versions(db, "binary_files", input_versions, versions)
+
+    return StageResult(versions, unchanged, columnar.table("binary_files", {
+        "bucket_key": todo,
+        "file_path": [file_paths[bucket_key] for bucket_key in todo],
+        "digest": [digests[bucket_key] for bucket_key in todo],
+    }) if export else None)
+
+
+def _convert_files(file_paths: dict[str, str]) -> dict[str, str]:
+    instrumentation.add("bytes_in", sum(
+        os.path.getsize(filepath) for filepath in file_paths.values()
+        if os.path.exists(filepath)
+    ))
+    with instrumentation.timed("conversion"):
+        return _convert(file_paths)
+
+
+def _is_large(filepath: str | Path) -> bool:
+    return os.path.exists(filepath) \
+        and os.path.getsize(filepath) >= LARGE_FILE_BYTES
+
+
+def _convert_one(filepath: str | Path) -> str | None:
+    """Convert a file in this process; None if its type is not supported.
+
+    Large files with a streaming converter are written page by page to a
+    temporary file and read back. That bounds the converter's memory at
+    about a page of layout, not the stage's: the markdown is returned,
+    stored and chunked as one string, so peak memory still grows with the
+    size of the output.
+    """
+    file_type = str(filepath).split(".")[-1]
+    if file_type in STREAMING_REGISTRY and _is_large(filepath):
+        with tempfile.TemporaryFile("w+", encoding="utf-8") as out:
+            pages = STREAMING_REGISTRY[file_type](Path(filepath), out)
+            logger.info(f"Streamed {pages} pages of {filepath}")
+            out.seek(0)
+            return out.read()
+    if file_type in REGISTRY:
+        return REGISTRY[file_type](Path(filepath)).markdown
+    logger.warning(
+        f"Unexpected file type ({file_type}) for {filepath}. "
+        f"Accepted file types: {list(REGISTRY.keys())}."
     )
+    return None
+
+
+def _convert_serially(
+    file_paths: dict[str, str]
+) -> tuple[dict[str, str], float]:
+    md_reps: dict[str, str] = {}
+    start = time.perf_counter()
+    for content_id, filepath in file_paths.items():
+        try:
+            md = _convert_one(filepath)
+        except Exception as e:
+            # Skipped like a failure in the worker pool, so one odd file
+            # cannot sink a batch
+            logger.warning(f"Could not convert {filepath}: {e!r}")
+            continue
+        if md is not None:
+            md_reps[content_id] = md
+    return md_reps, time.perf_counter() - start
+
 
+def _convert(file_paths: dict[str, str]) -> dict[str, str]:
+    large = {
+        content_id: filepath
+        for content_id, filepath in file_paths.items()
+        if _is_large(filepath)
+    }
+    small = {
+        content_id: filepath
+        for content_id, filepath in file_paths.items()
+        if content_id not in large
+    }
+    if len(small) <= 1:
+        md_reps, seconds = _convert_serially({**small, **large})
+        instrumentation.add("conversion_worker_s", seconds)
+        return md_reps
 
-def _get_file_path(
-    db_path: str | Path,
-    bucket_key: str,
-    use_str = False,
-) -> Path | str:
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        query = """
-        SELECT file_path FROM files
-        WHERE bucket_key=?
-        """
-        file_path: str = cur.execute(query, (bucket_key,)).fetchone()[0]
-
-    if not use_str:
-        return Path(file_path)
-    
-    return file_path
-
-
-@register("bin")
-def convert_dummy(filepath: str | Path) -> DocumentConverterResult:
-    assert os.path.isfile(filepath)
-    assert str(filepath).endswith("bin")
-    md = MarkItDown(enable_plugins=False)
-    res = md.convert(filepath)
-    # Extra steps go before/after conversion
-    return res
-
-
-@register("docx")
-def convert_docx(filepath: str | Path) -> DocumentConverterResult:
-    assert os.path.isfile(filepath)
-    assert str(filepath).endswith("docx")
-    md = MarkItDown(enable_plugins=False)
-    res = md.convert(filepath)
-    # Extra steps go before/after conversion
-    return res
-
-
-@register("pdf")
-def convert_pdf(filepath: str | Path) -> DocumentConverterResult:
-    assert os.path.isfile(filepath)
-    assert str(filepath).endswith("pdf")
-    md = MarkItDown(enable_plugins=False)
-    res = md.convert(filepath)
-    # Extra steps go before/after conversion
-    return res
+    # Large files are converted one after another on a thread of their
+    # own, while batches of small ones fan out over the shared worker
+    # pool, one core per file
+    with ThreadPoolExecutor(max_workers=1) as large_lane:
+        large_future = large_lane.submit(_convert_serially, large)
+        md_reps = {}
+        engine = conversion_engine.get_engine()
+        for res in engine.convert_many(small):
+            instrumentation.add("conversion_worker_s", res.seconds)
+            if not res.ok:
+                # Skip rather than fail so one odd file cannot sink a batch
+                logger.warning(
+                    f"Could not convert {small[res.key]}: {res.error}"
+                )
+                continue
+            md_reps[res.key] = res.markdown
+        large_reps, seconds = large_future.result()
+    instrumentation.add("conversion_worker_s", seconds)
+    return {**md_reps, **large_reps}
 
 
 @dg.asset(
     **COMMON_ASSET_ARGS,
     deps=[binary_files]
 )
+@_instrumented
 def markdown_files(
     context: dg.AssetExecutionContext,
     db: resources.SQLiteResource
 ) -> dg.Output:
     logger.info("markdown_files asset")
+    return _stage_output(compute_markdown_files(
+        db, _partition_keys(context), export=_exporting(context)
+    ))
 
-    assert context.has_partition_key is True, "Error: No Partition Key"
-    bucket_key: str = context.partition_key
-    db_path: str = db.db_path
-    filepath = _get_file_path(
-        db_path,
-        bucket_key
-    )
-    file_type = str(filepath).split(".")[-1]
-    try:
-        res = REGISTRY[file_type](filepath)
-    except KeyError:
-        print(f"""
-              
-            Unexpected file type ({file_type}).
-            Accepted file types: {list(REGISTRY.keys())}.
-
-        """)
-        quit()
-
-    with sqlite3.connect(db_path) as conn:
-            cur = conn.cursor()
-            query = """
-            UPDATE files
-            SET md_rep=?
-            WHERE bucket_key=?
-            """
-            cur.execute(query, (res.markdown, bucket_key))
-            conn.commit()
-    
-    md_hash = str(hash(res.markdown) % (10 ** 10))
-    return dg.Output(
-        value=None,
-        data_version=dg.DataVersion("-".join([bucket_key, md_hash]))
+
+def compute_markdown_files(db: resources.SQLiteResource,
+                           bucket_keys: list[str],
+                           export: bool = False) -> StageResult:
+    input_versions = stage_input_versions(db, "markdown_files", bucket_keys)
+    unchanged = _unchanged(db, "markdown_files", input_versions)
+    md_reps = _cached_stage(
+        db,
+        [bucket_key for bucket_key in bucket_keys
+         if bucket_key not in unchanged],
+        source_stage="file_path",
+        stage="md_rep",
+        cache_tag="md_rep",
+        compute=_convert_files,
     )
+    versions = {bucket_key: _hash(md) for bucket_key, md in md_reps.items()}
+    _record_versions(db, "markdown_files", input_versions, versions)
+    return StageResult(versions, unchanged,
+                       _text_table("markdown_files", "md_rep", md_reps)
+                       if export else None)
+
+
+def md_to_json(md_text: str) -> str:
+    import json
+    return json.dumps({"contents": md_text})
 
 
 @dg.asset(
     **COMMON_ASSET_ARGS,
     deps=[markdown_files]
 )
+@_instrumented
 def json_files(
     context: dg.AssetExecutionContext,
     db: resources.SQLiteResource
 ) -> dg.Output:
-    assert context.has_partition_key is True, "Error: No Partition Key"
-    bucket_key: str = context.partition_key
     logger.info("json_files asset")
+    return _stage_output(compute_json_files(
+        db, _partition_keys(context), export=_exporting(context)
+    ))
 
-    db_path: str = db.db_path
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        query = """
-        SELECT md_rep FROM files
-        WHERE bucket_key=?
-        """
-        md = cur.execute(query, (bucket_key,)).fetchone()
-
-        import json
-        json_rep: str = json.dumps({"contents": md})
-    
-        query = """
-        UPDATE files
-        SET json_rep=?
-        WHERE bucket_key=?
-        """
-        cur.execute(query, (json_rep, bucket_key))
-        conn.commit()
-
-    json_hash = str(hash(json_rep) % (10 ** 10))
-    return dg.Output(
-        value=None,
-        data_version=dg.DataVersion("-".join([bucket_key, json_hash]))
+
+def compute_json_files(db: resources.SQLiteResource,
+                       bucket_keys: list[str],
+                       export: bool = False) -> StageResult:
+    input_versions = stage_input_versions(db, "json_files", bucket_keys)
+    unchanged = _unchanged(db, "json_files", input_versions)
+    md_reps = db.get_stages(
+        [bucket_key for bucket_key in bucket_keys
+         if bucket_key not in unchanged],
+        "md_rep"
     )
 
+    json_reps: dict[str, str] = {
+        bucket_key: md_to_json(md)
+        for bucket_key, md in md_reps.items()
+    }
+    db.put_stages("json_rep", json_reps.items())
+    versions = {
+        bucket_key: _hash(json_rep)
+        for bucket_key, json_rep in json_reps.items()
+    }
+    _record_versions(db, "json_files", input_versions, versions)
+    return StageResult(versions, unchanged,
+                       _text_table("json_files", "json_rep", json_reps)
+                       if export else None)
+
+
+# Bump when md_to_plain's output changes, so cached plain text is redone
+PLAIN_CACHE_TAG = "plain_rep:3"
+
+
+def md_to_plain(md_text: str) -> markdown_plain.PlainText:
+    """Plain text of a markdown document plus its offset map."""
+    return markdown_plain.to_plain(md_text)
+
+
+def _plain_reps(db: resources.SQLiteResource,
+                md_reps: dict[str, str]) -> dict[str, str]:
+    """Strip content id -> markdown to plain text, storing offset maps."""
+    converted = {
+        content_id: md_to_plain(md) for content_id, md in md_reps.items()
+    }
+    db.put_offset_maps(
+        (content_id, plain.offsets.pack())
+        for content_id, plain in converted.items()
+    )
+    return {content_id: plain.text for content_id, plain in converted.items()}
 
-def md_to_plain(md_text: str) -> str:
-    return md_text
 
 @dg.asset(
     **COMMON_ASSET_ARGS,
     deps=[markdown_files]
 )
+@_instrumented
 def plain_files(
     context: dg.AssetExecutionContext,
     db: resources.SQLiteResource
 ) -> dg.Output:
-    assert context.has_partition_key is True, "Error: No Partition Key"
-    bucket_key: str = context.partition_key
     logger.info("plain_files asset")
+    return _stage_output(compute_plain_files(
+        db, _partition_keys(context), export=_exporting(context)
+    ))
 
-    db_path: str = db.db_path
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        query = """
-        SELECT md_rep FROM files
-        WHERE bucket_key=?
-        """
-        md = cur.execute(query, (bucket_key,)).fetchone()[0]
-
-        plain_text = md_to_plain(md)
-        query = """
-        UPDATE files
-        SET plain_rep=?
-        WHERE bucket_key=?
-        """
-        cur.execute(query, (plain_text, bucket_key))
-        conn.commit()
-    
-    plain_hash = str(hash(plain_text) % (10 ** 10))
-    return dg.Output(
-        value=None,
-        data_version=dg.DataVersion("-".join([bucket_key, plain_hash]))
+
+def compute_plain_files(db: resources.SQLiteResource,
+                        bucket_keys: list[str],
+                        export: bool = False) -> StageResult:
+    input_versions = stage_input_versions(db, "plain_files", bucket_keys)
+    unchanged = _unchanged(db, "plain_files", input_versions)
+    plain_reps = _cached_stage(
+        db,
+        [bucket_key for bucket_key in bucket_keys
+         if bucket_key not in unchanged],
+        source_stage="md_rep",
+        stage="plain_rep",
+        cache_tag=PLAIN_CACHE_TAG,
+        compute=lambda md_reps: _plain_reps(db, md_reps),
     )
+    versions = {
+        bucket_key: _hash(plain_text)
+        for bucket_key, plain_text in plain_reps.items()
+    }
+    _record_versions(db, "plain_files", input_versions, versions)
+    return StageResult(versions, unchanged,
+                       _text_table("plain_files", "plain_rep", plain_reps)
+                       if export else None)
+
+
+CHUNK_CONFIG: dict[str, dg.Field] = {
+    "size": dg.Field(int, default_value=CHUNK_SIZE),
+    "overlap": dg.Field(int, default_value=0),
+    "unit": dg.Field(str, default_value="chars"),
+    "snap": dg.Field(str, default_value="none"),
+}
+
+
+def _chunks_cache_tag(chunk_args: dict[str, Any]) -> str:
+    import json
+    # Cached chunks are only valid for the chunking they were made with
+    return "chunks:" + json.dumps(chunk_args, sort_keys=True)
+
+
+def _write_chunks(db: resources.SQLiteResource,
+                  bucket_key: str,
+                  plain_text: str,
+                  chunk_args: dict[str, Any],
+                  sink: list[tuple] | None,
+                  offsets: markdown_plain.OffsetMap | None = None
+                  ) -> dict[str, Any]:
+    """Stream `plain_text`'s chunks into the table; return the manifest.
+
+    Each chunk is also appended to `sink`, if given, as a `(bucket_key,
+    idx, start, end, text)` row for the output table. With `offsets`,
+    chunks also
+    record the markdown span they came from.
+    """
+    chunks_hash = hashing.StreamDigest()
+
+    def rows():
+        for chunk in chunking.iter_chunks(plain_text, **chunk_args):
+            chunks_hash.update(chunk.text)
+            if sink is not None:
+                sink.append((bucket_key, *chunk))
+            if offsets is None:
+                yield chunk
+            else:
+                yield (*chunk, *offsets.source_span(chunk.start, chunk.end))
+
+    count = db.put_chunks(bucket_key, rows())
+    return {
+        **chunk_args,
+        "count": count,
+        "digest": chunks_hash.hexdigest(),
+    }
+
+
+def _reuse_chunks(db: resources.SQLiteResource,
+                  src_key: str,
+                  bucket_key: str,
+                  digest: str,
+                  manifest: dict[str, Any]) -> list[tuple] | None:
+    """Give `bucket_key` the cached chunks of `src_key`; None if stale.
+
+    The cache only points at `src_key`'s rows, which are replaced when
+    that partition is rechunked or its file changes. So the source must
+    still hold the cached content, and the rows that end up under
+    `bucket_key` must hash to the manifest's digest.
+    """
+    if db.get_stage(src_key, "digest") != digest:
+        return None
+    if src_key != bucket_key:
+        db.copy_chunks(src_key, bucket_key)
+    rows = list(db.iter_chunks(bucket_key))
+    if len(rows) != manifest["count"] \
+            or hashing.iter_digest(row[3] for row in rows) \
+            != manifest["digest"]:
+        return None
+    return rows
+
+
+def _chunks_table(rows: list[tuple]) -> Any:
+    from ..utils import columnar
+    columns = list(zip(*rows)) or [()] * 5
+    return columnar.table("chunks", dict(zip(
+        ("bucket_key", "idx", "start", "end", "text"), columns
+    )))
 
 
 @dg.asset(
     **COMMON_ASSET_ARGS,
-    deps=[plain_files]
+    deps=[plain_files],
+    config_schema=CHUNK_CONFIG
 )
+@_instrumented
 def chunks(
     context: dg.AssetExecutionContext,
     db: resources.SQLiteResource
 ) -> dg.Output:
-    assert context.has_partition_key is True, "Error: No Partition Key"
-    bucket_key: str = context.partition_key
+    """Split plain text into rows of the `chunks` table.
 
+    Chunks are generated lazily and streamed into the table in batches.
+    `files.chunks` keeps a small JSON manifest of how the document was
+    chunked: the chunking config, the chunk count and a digest of the
+    chunk texts.
+    """
     logger.info("chunks asset")
+    return _stage_output(compute_chunks(db, _partition_keys(context), {
+        name: _op_config(context)[name] for name in CHUNK_CONFIG
+    }, export=_exporting(context)))
 
-    db_path: str = db.db_path
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        query = """
-        SELECT plain_rep FROM files
-        WHERE bucket_key=?
-        """
-        plain_text: str = cur.execute(query, (bucket_key,)).fetchone()[0]
-        chunked_text: dict[int, str] = {
-            idx: plain_text[pos:pos+CHUNK_SIZE]
-            for idx, pos in enumerate(range(0,len(plain_text),CHUNK_SIZE))
-        }
 
-        import json
-        chunks_str = json.dumps(chunked_text)
-
-        query = """
-        UPDATE files
-        SET chunks=?
-        WHERE bucket_key=?
-        """
-        cur.execute(query, (chunks_str, bucket_key))
-        conn.commit()
-    
-    chunks_hash = str(hash(chunks_str) % (10 ** 10))
-    return dg.Output(
-        value=None,
-        data_version=dg.DataVersion("-".join([bucket_key, chunks_hash]))
+def compute_chunks(db: resources.SQLiteResource,
+                   bucket_keys: list[str],
+                   chunk_args: dict[str, Any],
+                   export: bool = False) -> StageResult:
+    """`chunks` for the partitions; `chunk_args` has every key of
+    CHUNK_CONFIG.
+    """
+    import json
+    cache_tag = _chunks_cache_tag(chunk_args)
+    input_versions = stage_input_versions(db, "chunks", bucket_keys,
+                                          chunk_args)
+    unchanged = _unchanged(db, "chunks", input_versions)
+    bucket_keys = [bucket_key for bucket_key in bucket_keys
+                   if bucket_key not in unchanged]
+    digests: dict[str, str] = db.get_stages(bucket_keys, "digest")
+    cached: dict[str, str] = db.get_cached(digests.values(), cache_tag)
+
+    offset_maps = db.get_offset_maps(
+        digests.get(bucket_key) or bucket_key for bucket_key in bucket_keys
     )
 
+    manifests: dict[str, dict[str, Any]] = {}
+    chunk_rows: list[tuple] | None = [] if export else None
+    for bucket_key in bucket_keys:
+        digest = digests.get(bucket_key)
+        if digest in cached:
+            manifest = json.loads(cached[digest])
+            rows = _reuse_chunks(db, manifest.pop("doc_key"), bucket_key,
+                                 digest, manifest)
+            if rows is not None:
+                manifests[bucket_key] = manifest
+                if chunk_rows is not None:
+                    chunk_rows.extend((bucket_key, *row) for row in rows)
+                continue
+
+        plain_text = db.get_stage(bucket_key, "plain_rep")
+        if plain_text is None:
+            continue
+        offsets = offset_maps.get(digest or bucket_key)
+        manifest = _write_chunks(
+            db, bucket_key, plain_text, chunk_args, chunk_rows,
+            None if offsets is None else markdown_plain.OffsetMap.unpack(offsets)
+        )
+        manifests[bucket_key] = manifest
+        if digest is not None:
+            cached[digest] = json.dumps({**manifest, "doc_key": bucket_key})
+            db.put_cached(cache_tag, [(digest, cached[digest])])
+
+    db.put_stages("chunks", (
+        (bucket_key, json.dumps(manifest))
+        for bucket_key, manifest in manifests.items()
+    ))
+    versions = {
+        bucket_key: manifest["digest"][:VERSION_CHARS]
+        for bucket_key, manifest in manifests.items()
+    }
+    _record_versions(db, "chunks", input_versions, versions)
+    return StageResult(versions, unchanged, _chunks_table(chunk_rows)
+                       if chunk_rows is not None else None)
+
+
+EMBED_CONFIG: dict[str, dg.Field] = {
+    "embedder": dg.Field(str, default_value="hashing"),
+    "dim": dg.Field(int, default_value=embedding.EMBED_DIM),
+    "batch_size": dg.Field(int, default_value=embedding.EMBED_BATCH_SIZE),
+}
+
 
 @dg.asset(
     **COMMON_ASSET_ARGS,
-    deps=[chunks]
+    deps=[chunks],
+    config_schema=EMBED_CONFIG
 )
+@_instrumented
 def vec_embeddings(
     context: dg.AssetExecutionContext,
     db: resources.SQLiteResource
 ) -> dg.Output:
-    assert context.has_partition_key is True, "Error: No Partition Key"
-    bucket_key: str = context.partition_key
+    """Embed every chunk into rows of the `embeddings` table.
 
+    Chunks from all partitions in the run are embedded `batch_size` at a
+    time as one matrix, normalized together and written as packed
+    float32. `files.vec_embeddings` keeps a JSON manifest: the embedder,
+    the vector count and dim, and a digest of the packed vectors.
+    """
     logger.info("vec_embeddings asset")
+    return _stage_output(compute_vec_embeddings(
+        db, _partition_keys(context), _op_config(context),
+        export=_exporting(context)
+    ))
+
 
-    db_path: str = db.db_path
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        query = """
-        SELECT chunks FROM files
-        WHERE bucket_key=?
-        """
-        chunked_text = cur.execute(query, (bucket_key,)).fetchone()[0]
-
-        import random
-        vecs: dict[int, float] = {
-            idx: round(random.random(), 3)
-            for idx, _ in enumerate(chunked_text)
+def compute_vec_embeddings(db: resources.SQLiteResource,
+                           bucket_keys: list[str],
+                           config: dict[str, Any],
+                           export: bool = False) -> StageResult:
+    """`vec_embeddings` for the partitions; `config` has every key of
+    EMBED_CONFIG.
+    """
+    import json
+    import numpy as np
+    import pyarrow as pa
+    from ..utils import columnar
+    embedder = embedding.get_embedder(config["embedder"], dim=config["dim"])
+    input_versions = stage_input_versions(db, "vec_embeddings", bucket_keys,
+                                          config)
+    unchanged = _unchanged(db, "vec_embeddings", input_versions)
+    doc_keys = list(db.get_stages(
+        [bucket_key for bucket_key in bucket_keys
+         if bucket_key not in unchanged],
+        "chunks"
+    ))
+    db.delete_embeddings(doc_keys)
+
+    counts: dict[str, int] = dict.fromkeys(doc_keys, 0)
+    vecs_hashes = {
+        doc_key: hashing.StreamDigest() for doc_key in doc_keys
+    }
+    rows = (
+        (doc_key, idx, text)
+        for doc_key in doc_keys
+        for idx, _, _, text in db.iter_chunks(doc_key)
+    )
+    tables = []
+    for batch in embedding.batched(rows, config["batch_size"]):
+        matrix = embedding.normalize(
+            embedder.embed([text for _, _, text in batch])
+        )
+        if export:
+            tables.append(columnar.table("vec_embeddings", {
+                "bucket_key": [doc_key for doc_key, _, _ in batch],
+                "idx": [idx for _, idx, _ in batch],
+                "vector": columnar.vector_column(matrix),
+            }))
+        vectors = embedding.pack_rows(matrix)
+        for (doc_key, _, _), vector in zip(batch, vectors):
+            counts[doc_key] += 1
+            vecs_hashes[doc_key].update(vector)
+        db.put_embeddings(
+            (doc_key, idx, embedder.dim, vector)
+            for (doc_key, idx, _), vector in zip(batch, vectors)
+        )
+
+    manifests: dict[str, dict[str, Any]] = {
+        doc_key: {
+            "embedder": embedder.name,
+            "count": counts[doc_key],
+            "dim": embedder.dim,
+            "digest": vecs_hashes[doc_key].hexdigest(),
         }
+        for doc_key in doc_keys
+    }
+    db.put_stages("vec_embeddings", (
+        (bucket_key, json.dumps(manifest))
+        for bucket_key, manifest in manifests.items()
+    ))
 
-        import json
-        vecs_str = json.dumps(vecs)
-        query = """
-        UPDATE files
-        SET vec_embeddings=?
-        WHERE bucket_key=?
-        """
-        cur.execute(query, (vecs_str, bucket_key))
-        conn.commit()
-        
-    vecs_hash = str(hash(vecs_str) % (10 ** 10))
-    return dg.Output(
-        value=None,
-        data_version=dg.DataVersion("-".join([bucket_key, vecs_hash]))
+    if export and not tables:
+        tables.append(columnar.table("vec_embeddings", {
+            "bucket_key": [],
+            "idx": [],
+            "vector": columnar.vector_column(
+                np.empty((0, embedder.dim), dtype=np.float32)
+            ),
+        }))
+    versions = {
+        bucket_key: manifest["digest"][:VERSION_CHARS]
+        for bucket_key, manifest in manifests.items()
+    }
+    _record_versions(db, "vec_embeddings", input_versions, versions)
+    return StageResult(versions, unchanged,
+                       pa.concat_tables(tables) if export else None)
+
+
+def _grade(score: float) -> str | None:
+    for relationship, threshold in RELATIONSHIP_THRESHOLDS:
+        if score >= threshold:
+            return relationship
+    return None
+
+
+RELATIONSHIP_CONFIG: dict[str, dg.Field] = {
+    "top_k": dg.Field(int, default_value=TOP_K),
+    "nprobe": dg.Field(int, default_value=8),
+}
+
+
+@dg.asset(
+    **COMMON_ASSET_ARGS,
+    deps=[vec_embeddings],
+    config_schema=RELATIONSHIP_CONFIG
+)
+@_instrumented
+def relationships(
+    context: dg.AssetExecutionContext,
+    db: resources.SQLiteResource
+) -> dg.Output:
+    """Link each document to its nearest neighbours in `relationships`.
+
+    Chunk vectors and per-document mean vectors are added to two on-disk
+    IVF indexes (`utils.ann_index`), replacing whatever the partitions had
+    there before. Each document's `top_k` nearest documents above the
+    lowest threshold in `RELATIONSHIP_THRESHOLDS` are stored as graded,
+    scored pairs.
+    """
+    logger.info("relationships asset")
+    return _stage_output(compute_relationships(
+        db, _partition_keys(context), _op_config(context),
+        export=_exporting(context)
+    ))
+
+
+def compute_relationships(db: resources.SQLiteResource,
+                          bucket_keys: list[str],
+                          config: dict[str, Any],
+                          export: bool = False) -> StageResult:
+    """`relationships` for the partitions; `config` has every key of
+    RELATIONSHIP_CONFIG.
+    """
+    import numpy as np
+    from ..utils import ann_index, columnar
+    top_k: int = config["top_k"]
+
+    input_versions = stage_input_versions(db, "relationships", bucket_keys,
+                                          config)
+    unchanged = _unchanged(db, "relationships", input_versions)
+    bucket_keys = [bucket_key for bucket_key in bucket_keys
+                   if bucket_key not in unchanged]
+
+    grouped: dict[str, list[tuple[int, bytes]]] = {}
+    dim = 0
+    for doc_key, idx, dim, vector in db.iter_embeddings(bucket_keys):
+        grouped.setdefault(doc_key, []).append((idx, vector))
+    chunk_items: list[tuple[str, int]] = []
+    chunk_blocks: list[np.ndarray] = []
+    doc_vecs: list[np.ndarray] = []
+    for doc_key, rows in grouped.items():
+        block = np.frombuffer(
+            b"".join(vector for _, vector in rows), dtype="<f4"
+        ).reshape(len(rows), dim)
+        chunk_items.extend((doc_key, idx) for idx, _ in rows)
+        chunk_blocks.append(block)
+        doc_vecs.append(block.mean(axis=0))
+
+    chunk_index = ann_index.IVFIndex(db, db.ann_dir, "chunks", dim)
+    doc_index = ann_index.IVFIndex(db, db.ann_dir, "docs", dim)
+    # Partitions that lost their embeddings drop out of both indexes
+    chunk_index.remove(bucket_keys)
+    doc_index.remove(bucket_keys)
+
+    neighbours: dict[str, list[tuple[str, str, float]]] = {
+        doc_key: [] for doc_key in bucket_keys
+    }
+    if grouped:
+        doc_matrix = embedding.normalize(np.vstack(doc_vecs))
+        chunk_index.add(chunk_items, np.vstack(chunk_blocks))
+        doc_index.add([(doc_key, 0) for doc_key in grouped], doc_matrix)
+        hits = doc_index.search(doc_matrix, top_k + 1, config["nprobe"])
+        for doc_key, doc_hits in zip(grouped, hits):
+            for hit in doc_hits:
+                relationship = _grade(hit.score)
+                if hit.doc_key == doc_key or relationship is None:
+                    continue
+                neighbours[doc_key].append(
+                    (hit.doc_key, relationship, round(hit.score, 6))
+                )
+            del neighbours[doc_key][top_k:]
+
+    pairs = [
+        (doc_key, other, relationship, score)
+        for doc_key, doc_pairs in neighbours.items()
+        for other, relationship, score in doc_pairs
+    ]
+    db.put_relationships(bucket_keys, pairs)
+
+    versions = {
+        doc_key: hashing.iter_digest(
+            f"{other}:{relationship}:{score}"
+            for other, relationship, score in doc_pairs
+        )[:VERSION_CHARS]
+        for doc_key, doc_pairs in neighbours.items()
+    }
+    _record_versions(db, "relationships", input_versions, versions)
+
+    columns = list(zip(*pairs)) or [()] * 4
+    return StageResult(versions, unchanged, columnar.table(
+        "relationships", dict(zip(
+            ("bucket_key", "other_key", "relationship", "score"), columns
+        ))
+    ) if export else None)
+
+
+def _fused_text_stages() -> dg.AssetsDefinition:
+    """`json_files`, `plain_files` and `chunks` as one multi-asset.
+
+    The separate assets each read their input back out of SQLite; this
+    reads `md_rep` once, derives the JSON, plain text and chunks in
+    memory and writes all of them in a single transaction. Each asset
+    still gets its own materialization, with its data version computed
+    as the separate asset computes it. Chunk config goes under this op
+    (`text_stages`) instead of `chunks`.
+    """
+    common: dict[str, Any] = {
+        name: COMMON_ASSET_ARGS[name]
+        for name in ("metadata", "code_version", "io_manager_key")
+    }
+
+    @dg.multi_asset(
+        name="text_stages",
+        outs={
+            "json_files": dg.AssetOut(**common),
+            "plain_files": dg.AssetOut(**common),
+            "chunks": dg.AssetOut(**common),
+        },
+        internal_asset_deps={
+            "json_files": {markdown_files.key},
+            "plain_files": {markdown_files.key},
+            "chunks": {dg.AssetKey("plain_files")},
+        },
+        deps=[markdown_files],
+        partitions_def=COMMON_ASSET_ARGS["partitions_def"],
+        backfill_policy=COMMON_ASSET_ARGS["backfill_policy"],
+        config_schema=CHUNK_CONFIG,
+    )
+    @_instrumented
+    def text_stages(
+        context: dg.AssetExecutionContext,
+        db: resources.SQLiteResource
+    ):
+        logger.info("text_stages asset")
+        results = compute_text_stages(db, _partition_keys(context), {
+            name: _op_config(context)[name] for name in CHUNK_CONFIG
+        }, export=_exporting(context))
+        for output_name, res in results.items():
+            yield _stage_output(res, output_name)
+
+    return text_stages
+
+
+def compute_text_stages(db: resources.SQLiteResource,
+                        bucket_keys: list[str],
+                        chunk_args: dict[str, Any],
+                        export: bool = False) -> dict[str, StageResult]:
+    """`json_files`, `plain_files` and `chunks`, as `_fused_text_stages`
+    computes them, keyed by asset name.
+    """
+    import json
+    chunks_tag = _chunks_cache_tag(chunk_args)
+    json_inputs = stage_input_versions(db, "json_files", bucket_keys)
+    plain_inputs = stage_input_versions(db, "plain_files", bucket_keys)
+    unchanged_json = _unchanged(db, "json_files", json_inputs)
+    unchanged_plain = _unchanged(db, "plain_files", plain_inputs)
+    unchanged_chunks = _unchanged(db, "chunks", {
+        bucket_key: _input_version(plain_version, chunks_tag)
+        for bucket_key, plain_version in unchanged_plain.items()
+    })
+    # The three are computed together, so a partition is only skipped
+    # when all three are unchanged
+    unchanged = [
+        bucket_key for bucket_key in bucket_keys
+        if bucket_key in unchanged_json and bucket_key in unchanged_chunks
+    ]
+    md_reps: dict[str, str] = db.get_stages(
+        [bucket_key for bucket_key in bucket_keys
+         if bucket_key not in unchanged],
+        "md_rep"
     )
-    
\ No newline at end of file
+    digests: dict[str, str] = db.get_stages(md_reps, "digest")
+    json_reps = {
+        bucket_key: md_to_json(md) for bucket_key, md in md_reps.items()
+    }
+    converted = {
+        bucket_key: md_to_plain(md) for bucket_key, md in md_reps.items()
+    }
+    plain_reps = {
+        bucket_key: plain.text for bucket_key, plain in converted.items()
+    }
+
+    chunk_rows: list[tuple] | None = [] if export else None
+    with db.transaction():
+        db.put_stages("json_rep", json_reps.items())
+        db.put_stages("plain_rep", plain_reps.items())
+        db.put_offset_maps(
+            (digests.get(bucket_key) or bucket_key, plain.offsets.pack())
+            for bucket_key, plain in converted.items()
+        )
+        manifests: dict[str, dict[str, Any]] = {
+            bucket_key: _write_chunks(db, bucket_key, plain.text,
+                                      chunk_args, chunk_rows,
+                                      plain.offsets)
+            for bucket_key, plain in converted.items()
+        }
+        db.put_stages("chunks", (
+            (bucket_key, json.dumps(manifest))
+            for bucket_key, manifest in manifests.items()
+        ))
+        # Keep the separate assets' caches warm for later runs
+        db.put_cached(PLAIN_CACHE_TAG, (
+            (digests[bucket_key], plain_text)
+            for bucket_key, plain_text in plain_reps.items()
+            if bucket_key in digests
+        ))
+        db.put_cached(chunks_tag, (
+            (digests[bucket_key],
+             json.dumps({**manifest, "doc_key": bucket_key}))
+            for bucket_key, manifest in manifests.items()
+            if bucket_key in digests
+        ))
+
+        json_versions = {
+            bucket_key: _hash(json_rep)
+            for bucket_key, json_rep in json_reps.items()
+        }
+        plain_versions = {
+            bucket_key: _hash(plain_text)
+            for bucket_key, plain_text in plain_reps.items()
+        }
+        chunks_versions = {
+            bucket_key: manifest["digest"][:VERSION_CHARS]
+            for bucket_key, manifest in manifests.items()
+        }
+        _record_versions(db, "json_files", json_inputs, json_versions)
+        _record_versions(db, "plain_files", plain_inputs, plain_versions)
+        _record_versions(db, "chunks", {
+            bucket_key: _input_version(plain_version, chunks_tag)
+            for bucket_key, plain_version in plain_versions.items()
+        }, chunks_versions)
+
+    return {
+        output_name: StageResult(versions, {
+            bucket_key: previous[bucket_key] for bucket_key in unchanged
+        }, table() if export else None)
+        for output_name, versions, previous, table in (
+            ("json_files", json_versions, unchanged_json,
+             lambda: _text_table("json_files", "json_rep", json_reps)),
+            ("plain_files", plain_versions, unchanged_plain,
+             lambda: _text_table("plain_files", "plain_rep", plain_reps)),
+            ("chunks", chunks_versions, unchanged_chunks,
+             lambda: _chunks_table(chunk_rows)),
+        )
+    }
+
+
+# Opt in to the fused text stages by setting this environment variable to
+# 1. The separate assets are then replaced (not joined) at module scope,
+# since Dagster cannot load two definitions of the same asset keys.
+FUSED_TEXT_STAGES = os.environ.get("INGESTION_FUSED_TEXT_STAGES") == "1"
+if FUSED_TEXT_STAGES:
+    json_files = plain_files = chunks = _fused_text_stages()
@@ -0,0 +1,105 @@
+import dagster as dg
+import os
+import time
+from typing import Any, Callable
+from . import assets, resources, sensors
+from ..utils import db_utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+# When compaction runs; every round is bounded, so it can run often
+COMPACT_CRON = os.environ.get("INGESTION_COMPACT_CRON", "17 * * * *")
+
+COMPACT_CONFIG: dict[str, dg.Field] = {
+    "pages": dg.Field(int, default_value=db_utils.COMPACT_PAGES),
+    "fts_pages": dg.Field(int, default_value=db_utils.FTS_MERGE_PAGES),
+}
+
+
+def compact_db(db: resources.SQLiteResource,
+               store_root: str | None,
+               config: dict[str, Any],
+               delete_partitions: Callable[[list[str]], None] | None = None
+               ) -> dict[str, int]:
+    """One round of cleanup and compaction; `config` has every key of
+    COMPACT_CONFIG.
+
+    Every tombstoned file is purged again, catching rows and stored
+    tables written back by runs that were in flight at its deletion.
+    Tombstones past their retention are then forgotten, after their
+    partitions are handed to `delete_partitions`. ANN indexes mostly made
+    of removed vectors are rebuilt, and the database gets a bounded
+    `db_utils.compact`.
+    """
+    from ..utils import ann_index, columnar
+    keys = db.tombstones()
+    stats = {"tombstones": len(keys), "rows_purged": 0, "tables_purged": 0}
+    for pos in range(0, len(keys), sensors.PURGE_BATCH_SIZE):
+        batch = keys[pos:pos+sensors.PURGE_BATCH_SIZE]
+        stats["rows_purged"] += db.purge(batch)
+        if store_root is not None:
+            stats["tables_purged"] += columnar.delete_partitions(
+                store_root, batch
+            )
+    before = time.time() - resources.TOMBSTONE_RETENTION_S
+    if delete_partitions is not None:
+        with db.connection() as conn:
+            expired = [bucket_key for (bucket_key,) in conn.execute(
+                "SELECT bucket_key FROM tombstones WHERE purged_at < ?",
+                (before,)
+            )]
+        delete_partitions(expired)
+    stats["tombstones_pruned"] = db.prune_tombstones(before)
+
+    with db.connection() as conn:
+        indexes = conn.execute("SELECT name, dim FROM ann_meta").fetchall()
+    stats["ann_rebuilt"] = sum(
+        ann_index.IVFIndex(db, db.ann_dir, name, dim).compact()
+        for name, dim in indexes
+    )
+    with db.connection() as conn:
+        stats.update(db_utils.compact(
+            conn, config["pages"], config["fts_pages"]
+        ))
+    logger.info(f"Compacted {db.db_path}: {stats}")
+    return stats
+
+
+@dg.op(config_schema=COMPACT_CONFIG,
+       required_resource_keys={"db", "bucket_io_manager"})
+def compact(context: dg.OpExecutionContext) -> dg.Output:
+    """Purge deleted files again, then vacuum and reindex a little.
+
+    The IO manager is only needed for its `root`, which an annotated
+    resource parameter cannot reach.
+    """
+    instance = context.instance
+    existing = set(instance.get_dynamic_partitions(
+        assets.files_partition_def.name
+    ))
+
+    def delete_partitions(bucket_keys: list[str]) -> None:
+        # Normally done by `file_monitor` long before
+        for bucket_key in bucket_keys:
+            if bucket_key in existing:
+                instance.delete_dynamic_partition(
+                    assets.files_partition_def.name, bucket_key
+                )
+
+    stats = compact_db(context.resources.db,
+                       context.resources.bucket_io_manager.root,
+                       context.op_config, delete_partitions)
+    return dg.Output(None, metadata=stats)
+
+
+@dg.job(name="compact_db")
+def compact_db_job():
+    compact()
+
+
+compaction_schedule = dg.ScheduleDefinition(
+    job=compact_db_job,
+    cron_schedule=COMPACT_CRON,
+    default_status=dg.DefaultScheduleStatus.RUNNING,
+)
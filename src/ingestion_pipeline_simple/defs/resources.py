@@ -1,34 +1,1083 @@
 import dagster as dg
 import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
+from typing import Any, Iterable, Iterator, NamedTuple, Optional
+from ..utils import codec, db_utils, instrumentation
+
+# Columns of the `files` table that hold a stage's output
+STAGES: tuple[str, ...] = (
+    "file_path",
+    "digest",
+    "md_rep",
+    "json_rep",
+    "plain_rep",
+    "chunks",
+    "vec_embeddings",
+)
+
+# Built once so every call hands sqlite3 the exact same SQL string and
+# hits the connection's prepared-statement cache
+_GET_SQL: dict[str, str] = {
+    stage: f"SELECT {stage} FROM files WHERE bucket_key=?"
+    for stage in STAGES
+}
+_GET_MANY_SQL: dict[str, str] = {
+    stage: f"SELECT bucket_key, {stage} FROM files WHERE bucket_key IN "
+    for stage in STAGES
+}
+_PUT_SQL: dict[str, str] = {
+    stage: f"""
+    INSERT INTO files (bucket_key, {stage}) VALUES (?, ?)
+    ON CONFLICT(bucket_key) DO UPDATE SET {stage}=excluded.{stage}
+    """
+    for stage in STAGES
+}
+
+# Keep Arrow copies of every stage's output by setting this environment
+# variable to 1 (see `BucketIOManager`)
+EXPORT_TABLES = os.environ.get("INGESTION_EXPORT_TABLES") == "1"
+
+_GET_CACHED_SQL = """
+SELECT digest, value FROM content_cache WHERE stage=? AND digest IN
+"""
+_PUT_CACHED_SQL = """
+INSERT INTO content_cache (digest, stage, value) VALUES (?, ?, ?)
+ON CONFLICT(digest, stage) DO UPDATE SET value=excluded.value
+"""
+
+_GET_VERSIONS_SQL = """
+SELECT bucket_key, input_version, output_version FROM stage_versions
+WHERE stage=? AND bucket_key IN
+"""
+_PUT_VERSIONS_SQL = """
+INSERT INTO stage_versions (stage, bucket_key, input_version, output_version)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(stage, bucket_key) DO UPDATE SET
+    input_version=excluded.input_version,
+    output_version=excluded.output_version
+"""
+
+# Output metadata listing partitions a run skipped as unchanged; the IO
+# manager leaves their stored outputs as they are
+UNCHANGED_METADATA_KEY = "unchanged_partitions"
+
+# Rows per executemany when streaming a document's chunks in
+CHUNK_WRITE_BATCH = 500
+
+# Stay well under SQLITE_MAX_VARIABLE_NUMBER on older builds
+_MAX_PARAMS = 500
+
+# Backlog orders: oldest first, or smallest first with files waiting
+# longer than `max_wait_s` going ahead of everything else
+_BACKLOG_ORDER_SQL: dict[str, str] = {
+    "age": "enqueued_at, bucket_key",
+    "size": "enqueued_at > ?, size, enqueued_at, bucket_key",
+}
+# Stage stats older than this are pruned
+STAGE_STATS_RETENTION_S = 7 * 24 * 3600
+# And so are entries of the stage change feed; readers that fall further
+# behind than this have to assume everything changed
+CHANGE_RETENTION_S = 24 * 3600
+# Purged tombstones are kept this long, so compaction can purge again
+# whatever a run in flight at the time wrote back
+TOMBSTONE_RETENTION_S = 24 * 3600
+# Stage named in the change feed for partitions purged outright
+DELETED_STAGE = "deleted"
+
+
+class BacklogEntry(NamedTuple):
+    bucket_key: str
+    file_path: str
+    version: str | None
+    size: int
+    enqueued_at: float
+
+
+def _check_stage(stage: str) -> None:
+    if stage not in STAGES:
+        raise ValueError(
+            f"Unknown stage ({stage}). Known stages: {list(STAGES)}."
+        )
 
 
 class SQLiteResource(dg.ConfigurableResource):
+    """Storage layer over the `files` database.
+
+    Each process keeps one pool of WAL-mode connections per `db_path`, so
+    concurrent partition runs share readers and queue on a single writer
+    lock (with `busy_timeout_ms` of patience) instead of failing with
+    "database is locked".
+    """
     db_path: str
+    # Root of the `BucketIOManager` store, so files purged outside a run
+    # (by `file_monitor`) lose their stored tables too
+    store_root: Optional[str] = None
+    pool_size: int = 4
+    busy_timeout_ms: int = 30_000
+    synchronous: str = "NORMAL"
+    mmap_size: int = 256 * 1024 * 1024
+    cached_statements: int = 256
+
+    @property
+    def ann_dir(self) -> Path:
+        """Directory of the memory-mapped ANN vector files."""
+        return Path(self.db_path).with_suffix(".ann")
+
+    @property
+    def pool(self) -> db_utils.ConnectionPool:
+        pragmas = {
+            **db_utils.DEFAULT_PRAGMAS,
+            "synchronous": self.synchronous,
+            "busy_timeout": self.busy_timeout_ms,
+            "mmap_size": self.mmap_size,
+        }
+        pool = db_utils.get_pool(
+            self.db_path,
+            size=self.pool_size,
+            pragmas=pragmas,
+            cached_statements=self.cached_statements,
+        )
+        if not pool.schema_ready:
+            # Readers should not queue on the write lock for a schema that
+            # is already current
+            with pool.connection() as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < db_utils.SCHEMA_VERSION:
+                with pool.transaction() as conn:
+                    db_utils.ensure_schema(conn)
+            pool.schema_ready = True
+            # Before any transaction, so encoding inside one never has
+            # to wait for a second connection
+            self.value_codec.load()
+        return pool
+
+    @property
+    def value_codec(self) -> codec.ValueCodec:
+        """Compression of large stage values; see `utils.codec`."""
+        return codec.get_codec(self.db_path, self)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        with instrumentation.timed("db"), self.pool.connection() as conn:
+            yield conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with instrumentation.timed("db"), self.pool.transaction() as conn:
+            yield conn
+
+    def get_stage(self, bucket_key: str, stage: str) -> Any | None:
+        _check_stage(stage)
+        with self.connection() as conn:
+            row = conn.execute(_GET_SQL[stage], (bucket_key,)).fetchone()
+        if row is None:
+            return None
+        instrumentation.add("bytes_in", instrumentation.size_of(row[0]))
+        if stage in codec.COMPRESSED_STAGES:
+            return self.value_codec.decode(row[0])
+        return row[0]
+
+    def put_stage(self, bucket_key: str, stage: str, value: Any) -> None:
+        _check_stage(stage)
+        if stage in codec.COMPRESSED_STAGES:
+            value = self.value_codec.encode(value)
+        with self.transaction() as conn:
+            conn.execute(_PUT_SQL[stage], (bucket_key, value))
+
+    def get_stages(self,
+                   bucket_keys: Iterable[str],
+                   stage: str) -> dict[str, Any]:
+        """Read one stage for many partitions; missing keys are left out."""
+        _check_stage(stage)
+        values = self._select_in(_GET_MANY_SQL[stage], (), bucket_keys)
+        if stage in codec.COMPRESSED_STAGES:
+            return self._decoded(values)
+        return values
+
+    def put_stages(self,
+                   stage: str,
+                   items: Iterable[tuple[str, Any]]) -> None:
+        """Write one stage for many partitions in a single transaction."""
+        _check_stage(stage)
+        if stage in codec.COMPRESSED_STAGES:
+            items = self._encoded(items)
+        with self.transaction() as conn:
+            conn.executemany(_PUT_SQL[stage], items)
+
+    def get_cached(self,
+                   digests: Iterable[str],
+                   stage: str) -> dict[str, Any]:
+        """Look up a stage's cached output by source content digest."""
+        return self._decoded(
+            self._select_in(_GET_CACHED_SQL, (stage,), set(digests))
+        )
+
+    def put_cached(self,
+                   stage: str,
+                   items: Iterable[tuple[str, Any]]) -> None:
+        """Cache a stage's output under each source content digest."""
+        items = self._encoded(items)
+        with self.transaction() as conn:
+            conn.executemany(_PUT_CACHED_SQL, (
+                (digest, stage, value) for digest, value in items
+            ))
+
+    def _encoded(self, items: Iterable[tuple[str, Any]]) -> list[tuple]:
+        # Compressed ahead of the transaction, not while holding the lock
+        encode = self.value_codec.encode
+        return [(key, encode(value)) for key, value in items]
+
+    def _decoded(self, values: dict[str, Any]) -> dict[str, Any]:
+        decode = self.value_codec.decode
+        return {key: decode(value) for key, value in values.items()}
+
+    def put_chunks(self,
+                   doc_key: str,
+                   chunks: Iterable[tuple],
+                   batch_size: int = CHUNK_WRITE_BATCH) -> int:
+        """Replace a document's `(idx, start, end, text)` chunk rows.
+
+        Rows may carry two more items, the `(md_start, md_end)` markdown
+        span of the chunk. `chunks` is consumed lazily and written
+        `batch_size` rows at a time, so a generator never has to be
+        materialized. Returns the number of rows written.
+        """
+        rows = iter(chunks)
+        count = 0
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM chunks WHERE doc_key=?", (doc_key,))
+            while batch := list(islice(rows, batch_size)):
+                conn.executemany(
+                    """
+                    INSERT INTO chunks
+                        (doc_key, idx, start, end, text, md_start, md_end)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        (doc_key, *row) if len(row) == 6
+                        else (doc_key, *row, None, None)
+                        for row in batch
+                    )
+                )
+                count += len(batch)
+        return count
+
+    def copy_chunks(self, src_key: str, dst_key: str) -> int:
+        """Replace `dst_key`'s chunks with a copy of `src_key`'s."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM chunks WHERE doc_key=?", (dst_key,))
+            return conn.execute(
+                """
+                INSERT INTO chunks
+                    (doc_key, idx, start, end, text, md_start, md_end)
+                SELECT ?, idx, start, end, text, md_start, md_end
+                FROM chunks WHERE doc_key=?
+                """,
+                (dst_key, src_key)
+            ).rowcount
+
+    def iter_chunks(self,
+                    doc_key: str) -> Iterator[tuple[int, int, int, str]]:
+        """Stream a document's `(idx, start, end, text)` rows in order."""
+        yield from self._stream(
+            """
+            SELECT idx, start, end, text FROM chunks
+            WHERE doc_key=? ORDER BY idx
+            """,
+            (doc_key,)
+        )
+
+    def get_chunks(
+        self,
+        items: Iterable[tuple[str, int]]
+    ) -> dict[tuple[str, int], tuple[int, int, int | None, int | None, str]]:
+        """`(start, end, md_start, md_end, text)` of `(doc_key, idx)` chunks.
+
+        Chunks that do not exist are left out.
+        """
+        items = list(dict.fromkeys(items))
+        found = {}
+        with self.connection() as conn:
+            for pos in range(0, len(items), _MAX_PARAMS // 2):
+                batch = items[pos:pos+_MAX_PARAMS // 2]
+                rows = conn.execute(
+                    f"""
+                    SELECT doc_key, idx, start, end, md_start, md_end, text
+                    FROM chunks WHERE (doc_key, idx) IN
+                    (VALUES {','.join(['(?, ?)'] * len(batch))})
+                    """,
+                    [value for item in batch for value in item]
+                )
+                found.update(((row[0], row[1]), row[2:]) for row in rows)
+        return found
+
+    def search_chunks(self,
+                      query: str,
+                      limit: int = 10,
+                      prefix: str = "",
+                      raw: bool = False) -> list[db_utils.SearchHit]:
+        """Chunks best matching a keyword query; see `db_utils`."""
+        with self.connection() as conn:
+            return db_utils.search_chunks(conn, query, limit, prefix, raw)
+
+    def search_docs(self,
+                    query: str,
+                    limit: int = 10,
+                    prefix: str = "",
+                    raw: bool = False) -> list[db_utils.DocHit]:
+        with self.connection() as conn:
+            return db_utils.search_docs(conn, query, limit, prefix, raw)
+
+    def get_offset_maps(self, content_ids: Iterable[str]) -> dict[str, bytes]:
+        """Packed offset maps by content id; see `markdown_plain`."""
+        return self._select_in(
+            "SELECT content_id, offsets FROM offset_maps WHERE content_id IN ",
+            (),
+            set(content_ids)
+        )
+
+    def put_offset_maps(self, items: Iterable[tuple[str, bytes]]) -> None:
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO offset_maps (content_id, offsets) "
+                "VALUES (?, ?)",
+                items
+            )
+
+    def put_embeddings(self,
+                       rows: Iterable[tuple[str, int, int, bytes]],
+                       batch_size: int = CHUNK_WRITE_BATCH) -> int:
+        """Upsert `(doc_key, idx, dim, packed float32)` vectors."""
+        rows = iter(rows)
+        count = 0
+        with self.transaction() as conn:
+            while batch := list(islice(rows, batch_size)):
+                conn.executemany(
+                    """
+                    INSERT OR REPLACE INTO embeddings (doc_key, idx, dim, vector)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    batch
+                )
+                count += len(batch)
+        return count
+
+    def delete_embeddings(self, doc_keys: Iterable[str]) -> None:
+        with self.transaction() as conn:
+            conn.executemany(
+                "DELETE FROM embeddings WHERE doc_key=?",
+                ((doc_key,) for doc_key in doc_keys)
+            )
+
+    def iter_embeddings(
+        self,
+        doc_keys: Iterable[str] | None = None
+    ) -> Iterator[tuple[str, int, int, bytes]]:
+        """Stream `(doc_key, idx, dim, packed float32)` rows.
+
+        Vectors come back as raw blobs; decode them with
+        `db_utils.unpack_vector` or straight into an array buffer.
+        """
+        query = "SELECT doc_key, idx, dim, vector FROM embeddings"
+        if doc_keys is None:
+            yield from self._stream(query + " ORDER BY doc_key, idx")
+            return
+        doc_keys = list(doc_keys)
+        for pos in range(0, len(doc_keys), _MAX_PARAMS):
+            batch = doc_keys[pos:pos+_MAX_PARAMS]
+            yield from self._stream(
+                query
+                + f" WHERE doc_key IN ({','.join('?' * len(batch))})"
+                + " ORDER BY doc_key, idx",
+                batch
+            )
+
+    def put_relationships(self,
+                          doc_keys: Iterable[str],
+                          rows: Iterable[tuple[str, str, str, float]]) -> None:
+        """Replace every relationship touching `doc_keys`.
+
+        Rows are `(doc_a_key, doc_b_key, relationship, score)`; each pair
+        is stored once, ordered by key.
+        """
+        doc_keys = list(doc_keys)
+        with self.transaction() as conn:
+            conn.executemany(
+                "DELETE FROM relationships WHERE doc_a_key=? OR doc_b_key=?",
+                ((doc_key, doc_key) for doc_key in doc_keys)
+            )
+            conn.executemany(
+                """
+                INSERT OR REPLACE INTO relationships
+                    (doc_a_key, doc_b_key, relationship, score)
+                VALUES (?, ?, ?, ?)
+                """,
+                (
+                    (min(a, b), max(a, b), relationship, score)
+                    for a, b, relationship, score in rows
+                )
+            )
+
+    def enqueue_backlog(self,
+                        rows: Iterable[tuple[str, str, str | None, int]],
+                        now: float | None = None) -> None:
+        """Add detected `(bucket_key, file_path, version, size)` files.
+
+        A file that is already waiting keeps its place in line but takes
+        the new path, version and size, and is pending again if a tick had
+        admitted it. A file back after being deleted loses its tombstone.
+        """
+        rows = list(rows)
+        now = time.time() if now is None else now
+        with self.transaction() as conn:
+            conn.executemany(
+                "DELETE FROM tombstones WHERE bucket_key=?",
+                ((bucket_key,) for bucket_key, *_ in rows)
+            )
+            conn.executemany(
+                """
+                INSERT INTO ingest_backlog
+                    (bucket_key, file_path, version, size, enqueued_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(bucket_key) DO UPDATE SET
+                    file_path=excluded.file_path,
+                    version=excluded.version,
+                    size=excluded.size,
+                    admitted_seq=NULL
+                """,
+                ((*row, now) for row in rows)
+            )
+
+    def settle_backlog(self, committed_seq: int) -> None:
+        """Drop rows admitted by ticks up to `committed_seq`.
+
+        Rows admitted by a later tick belong to a tick whose result never
+        reached the cursor, so they go back to pending.
+        """
+        with self.transaction() as conn:
+            conn.execute(
+                "DELETE FROM ingest_backlog WHERE admitted_seq <= ?",
+                (committed_seq,)
+            )
+            conn.execute(
+                """
+                UPDATE ingest_backlog SET admitted_seq=NULL
+                WHERE admitted_seq > ?
+                """,
+                (committed_seq,)
+            )
+
+    def pending_backlog(self,
+                        limit: int,
+                        order: str = "age",
+                        max_wait_s: float = 0.0,
+                        min_size: int = 0,
+                        max_size: int | None = None) -> list[BacklogEntry]:
+        """Up to `limit` files not yet admitted, in admission order.
+
+        Only files of at least `min_size` and, if given, under `max_size`
+        bytes are returned.
+        """
+        assert order in _BACKLOG_ORDER_SQL, (
+            f"Error: Unknown order ({order}), "
+            f"expected {list(_BACKLOG_ORDER_SQL)}"
+        )
+        where = "admitted_seq IS NULL AND size >= ?"
+        params: tuple = (min_size,)
+        if max_size is not None:
+            where += " AND size < ?"
+            params += (max_size,)
+        if order == "size":
+            params += (time.time() - max_wait_s,)
+        with self.connection() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT bucket_key, file_path, version, size, enqueued_at
+                FROM ingest_backlog WHERE {where}
+                ORDER BY {_BACKLOG_ORDER_SQL[order]} LIMIT ?
+                """,
+                (*params, limit)
+            ).fetchall()
+        return [BacklogEntry(*row) for row in rows]
+
+    def admit_backlog(self, bucket_keys: Iterable[str], seq: int) -> None:
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE ingest_backlog SET admitted_seq=? WHERE bucket_key=?",
+                ((seq, bucket_key) for bucket_key in bucket_keys)
+            )
+
+    def drop_backlog(self, bucket_keys: Iterable[str], seq: int) -> None:
+        """Drop files admitted with `seq` once they are done.
+
+        A file detected again since then is pending and stays.
+        """
+        with self.transaction() as conn:
+            conn.executemany(
+                """
+                DELETE FROM ingest_backlog
+                WHERE bucket_key=? AND admitted_seq=?
+                """,
+                ((bucket_key, seq) for bucket_key in bucket_keys)
+            )
+
+    def backlog_size(self) -> int:
+        with self.connection() as conn:
+            return conn.execute(
+                """
+                SELECT COUNT(*) FROM ingest_backlog WHERE admitted_seq IS NULL
+                """
+            ).fetchone()[0]
+
+    def tombstone(self,
+                  bucket_keys: Iterable[str],
+                  now: float | None = None) -> None:
+        """Record files deleted from the bucket, to be purged.
+
+        They leave the backlog, admitted or not, so they are never
+        admitted again.
+        """
+        bucket_keys = list(bucket_keys)
+        now = time.time() if now is None else now
+        with self.transaction() as conn:
+            conn.executemany(
+                """
+                INSERT INTO tombstones (bucket_key, deleted_at) VALUES (?, ?)
+                ON CONFLICT(bucket_key) DO UPDATE SET purged_at=NULL
+                """,
+                ((bucket_key, now) for bucket_key in bucket_keys)
+            )
+            conn.executemany(
+                "DELETE FROM ingest_backlog WHERE bucket_key=?",
+                ((bucket_key,) for bucket_key in bucket_keys)
+            )
+
+    def tombstones(self,
+                   purged: bool | None = None,
+                   limit: int | None = None) -> list[str]:
+        """Tombstoned keys, oldest first: all, or only (un)purged ones."""
+        where = ""
+        if purged is not None:
+            where = f"WHERE purged_at IS {'NOT ' if purged else ''}NULL"
+        with self.connection() as conn:
+            return [bucket_key for (bucket_key,) in conn.execute(
+                f"""
+                SELECT bucket_key FROM tombstones {where}
+                ORDER BY deleted_at, bucket_key LIMIT ?
+                """,
+                (-1 if limit is None else limit,)
+            )]
+
+    def purged_since(self,
+                     after: tuple[float, str] = (0.0, ""),
+                     limit: int | None = None) -> list[tuple[float, str]]:
+        """`(purged_at, key)` of tombstones purged after `after`, in order.
+
+        The last row makes the `after` of the next call, so callers page
+        through purges without rereading every retained tombstone.
+        """
+        with self.connection() as conn:
+            return conn.execute(
+                """
+                SELECT purged_at, bucket_key FROM tombstones
+                WHERE (purged_at, bucket_key) > (?, ?)
+                ORDER BY purged_at, bucket_key LIMIT ?
+                """,
+                (*after, -1 if limit is None else limit)
+            ).fetchall()
+
+    def purge(self,
+              bucket_keys: Iterable[str],
+              now: float | None = None) -> int:
+        """Delete every stored trace of the partitions; return rows deleted.
+
+        Cascades through the `files` row and its full-text entry, chunks,
+        embeddings, ANN items, relationships on either side, stage
+        versions, the backlog, and cached values and offset maps no other
+        file shares. Tombstones of the keys are marked purged. If anything
+        was deleted, the partitions go on the change feed and the
+        `vec_embeddings` epoch is bumped, so neighbours of the purged
+        documents are recomputed. Vectors stay in the ANN files until
+        their next rebuild.
+        """
+        bucket_keys = list(bucket_keys)
+        now = time.time() if now is None else now
+        deleted = 0
+        with self.transaction() as conn:
+            names = [name for (name,) in conn.execute(
+                "SELECT name FROM ann_meta"
+            )]
+            for pos in range(0, len(bucket_keys), _MAX_PARAMS):
+                batch = bucket_keys[pos:pos+_MAX_PARAMS]
+                marks = f"({','.join('?' * len(batch))})"
+                digests = [digest for (digest,) in conn.execute(
+                    f"""
+                    SELECT DISTINCT digest FROM files
+                    WHERE digest IS NOT NULL AND bucket_key IN {marks}
+                    """,
+                    batch
+                )]
+                for query in (
+                    f"DELETE FROM files WHERE bucket_key IN {marks}",
+                    f"DELETE FROM chunks WHERE doc_key IN {marks}",
+                    f"DELETE FROM embeddings WHERE doc_key IN {marks}",
+                    f"DELETE FROM relationships WHERE doc_a_key IN {marks}",
+                    f"DELETE FROM relationships WHERE doc_b_key IN {marks}",
+                    f"DELETE FROM stage_versions WHERE bucket_key IN {marks}",
+                    f"DELETE FROM ingest_backlog WHERE bucket_key IN {marks}",
+                    f"DELETE FROM offset_maps WHERE content_id IN {marks}",
+                ):
+                    deleted += conn.execute(query, batch).rowcount
+                for name in names:
+                    deleted += conn.execute(
+                        "DELETE FROM ann_items WHERE name=? AND doc_key IN "
+                        + marks,
+                        (name, *batch)
+                    ).rowcount
+                # Content is cached by digest; keep what another file shares
+                unshared = [digest for digest in digests if conn.execute(
+                    "SELECT 1 FROM files WHERE digest=? LIMIT 1", (digest,)
+                ).fetchone() is None]
+                conn.executemany(
+                    "DELETE FROM content_cache WHERE digest=?",
+                    ((digest,) for digest in unshared)
+                )
+                conn.executemany(
+                    "DELETE FROM offset_maps WHERE content_id=?",
+                    ((digest,) for digest in unshared)
+                )
+                conn.executemany(
+                    "UPDATE tombstones SET purged_at=? WHERE bucket_key=?",
+                    ((now, bucket_key) for bucket_key in batch)
+                )
+            if deleted:
+                conn.executemany(
+                    """
+                    INSERT INTO stage_changes (stage, bucket_key, changed_at)
+                    VALUES (?, ?, ?)
+                    """,
+                    ((DELETED_STAGE, bucket_key, now)
+                     for bucket_key in bucket_keys)
+                )
+                conn.execute(
+                    """
+                    INSERT INTO stage_epochs (stage, epoch)
+                    VALUES ('vec_embeddings', 1)
+                    ON CONFLICT(stage) DO UPDATE SET epoch=epoch + 1
+                    """
+                )
+        return deleted
+
+    def prune_tombstones(self, before: float) -> int:
+        """Forget tombstones purged before `before`; return how many."""
+        with self.transaction() as conn:
+            return conn.execute(
+                "DELETE FROM tombstones WHERE purged_at < ?", (before,)
+            ).rowcount
+
+    def get_stage_versions(
+        self,
+        stage: str,
+        bucket_keys: Iterable[str]
+    ) -> dict[str, tuple[str, str]]:
+        """Each partition's last `(input_version, output_version)`."""
+        with self.connection() as conn:
+            return self._versions(conn, stage, bucket_keys)
+
+    @staticmethod
+    def _versions(conn: sqlite3.Connection,
+                  stage: str,
+                  bucket_keys: Iterable[str]) -> dict[str, tuple[str, str]]:
+        keys = list(bucket_keys)
+        versions: dict[str, tuple[str, str]] = {}
+        for pos in range(0, len(keys), _MAX_PARAMS):
+            batch = keys[pos:pos+_MAX_PARAMS]
+            rows = conn.execute(
+                _GET_VERSIONS_SQL + f"({','.join('?' * len(batch))})",
+                (stage, *batch)
+            ).fetchall()
+            versions.update(
+                (bucket_key, (input_version, output_version))
+                for bucket_key, input_version, output_version in rows
+            )
+        return versions
+
+    def put_stage_versions(
+        self,
+        stage: str,
+        items: Iterable[tuple[str, str, str]]
+    ) -> bool:
+        """Record `(bucket_key, input_version, output_version)` rows.
+
+        Returns whether any partition's output version changed, in which
+        case the stage's epoch is bumped too and the changed partitions
+        are added to the change feed (see `stage_changes`).
+        """
+        items = list(items)
+        with self.transaction() as conn:
+            old = self._versions(
+                conn, stage, [bucket_key for bucket_key, _, _ in items]
+            )
+            conn.executemany(_PUT_VERSIONS_SQL, (
+                (stage, bucket_key, input_version, output_version)
+                for bucket_key, input_version, output_version in items
+            ))
+            changed = [
+                bucket_key for bucket_key, _, output_version in items
+                if old.get(bucket_key, (None, None))[1] != output_version
+            ]
+            if changed:
+                now = time.time()
+                conn.executemany(
+                    """
+                    INSERT INTO stage_changes (stage, bucket_key, changed_at)
+                    VALUES (?, ?, ?)
+                    """,
+                    ((stage, bucket_key, now) for bucket_key in changed)
+                )
+                conn.execute(
+                    "DELETE FROM stage_changes WHERE changed_at < ?",
+                    (now - CHANGE_RETENTION_S,)
+                )
+                conn.execute(
+                    """
+                    INSERT INTO stage_epochs (stage, epoch) VALUES (?, 1)
+                    ON CONFLICT(stage) DO UPDATE SET epoch=epoch + 1
+                    """,
+                    (stage,)
+                )
+        return bool(changed)
+
+    def stage_changes(
+        self,
+        after_seq: int = 0,
+        limit: int | None = None
+    ) -> list[tuple[int, str, str]]:
+        """`(seq, stage, bucket_key)` of output changes after `after_seq`.
+
+        Sequence numbers only grow, so a reader keeps the last one it saw
+        and asks again from there. A first row past `after_seq + 1` means
+        older changes were pruned in between.
+        """
+        with self.connection() as conn:
+            return conn.execute(
+                """
+                SELECT seq, stage, bucket_key FROM stage_changes
+                WHERE seq > ? ORDER BY seq LIMIT ?
+                """,
+                (after_seq, -1 if limit is None else limit)
+            ).fetchall()
+
+    def last_change_seq(self) -> int:
+        """The `seq` of the newest change in the feed, 0 if none yet."""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name='stage_changes'"
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+    def stage_epoch(self, stage: str) -> int:
+        """How many times any of the stage's outputs has changed."""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT epoch FROM stage_epochs WHERE stage=?", (stage,)
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+    def iter_files(self, prefix: str = "") -> Iterator[tuple[str, str]]:
+        """`(bucket_key, file_path)` of every known file under `prefix`."""
+        yield from self._stream(
+            """
+            SELECT bucket_key, file_path FROM files
+            WHERE file_path IS NOT NULL AND substr(bucket_key, 1, ?) = ?
+            ORDER BY bucket_key
+            """,
+            (len(prefix), prefix)
+        )
+
+    def create_backfill(self,
+                        name: str,
+                        params: dict[str, Any],
+                        files: Iterable[tuple[str, str | None]]) -> bool:
+        """Checkpoint a new backfill over `(bucket_key, file_path)` rows.
+
+        Returns False, changing nothing, if `name` already exists.
+        """
+        import json
+        with self.transaction() as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM backfills WHERE name=?", (name,)
+            ).fetchone()
+            if exists:
+                return False
+            conn.execute(
+                """
+                INSERT INTO backfills (name, params, created_at)
+                VALUES (?, ?, ?)
+                """,
+                (name, json.dumps(params, sort_keys=True), time.time())
+            )
+            conn.executemany(
+                """
+                INSERT INTO backfill_keys (name, pos, bucket_key, file_path)
+                VALUES (?, ?, ?, ?)
+                """,
+                (
+                    (name, pos, bucket_key, file_path)
+                    for pos, (bucket_key, file_path) in enumerate(files)
+                )
+            )
+        return True
+
+    def get_backfill(self, name: str) -> dict[str, Any] | None:
+        """A backfill's params, timestamps and key counts by status."""
+        import json
+        with self.connection() as conn:
+            row = conn.execute(
+                """
+                SELECT params, created_at, finished_at FROM backfills
+                WHERE name=?
+                """,
+                (name,)
+            ).fetchone()
+            if row is None:
+                return None
+            counts = dict(conn.execute(
+                """
+                SELECT status, COUNT(*) FROM backfill_keys
+                WHERE name=? GROUP BY status
+                """,
+                (name,)
+            ).fetchall())
+        params, created_at, finished_at = row
+        return {
+            "params": json.loads(params),
+            "created_at": created_at,
+            "finished_at": finished_at,
+            "counts": counts,
+        }
+
+    def backfill_todo(self, name: str) -> list[tuple[str, str | None]]:
+        """Keys of a backfill not yet done, failed ones included, in order."""
+        with self.connection() as conn:
+            return conn.execute(
+                """
+                SELECT bucket_key, file_path FROM backfill_keys
+                WHERE name=? AND status != 'done' ORDER BY pos
+                """,
+                (name,)
+            ).fetchall()
+
+    def mark_backfill(self,
+                      name: str,
+                      bucket_keys: Iterable[str],
+                      status: str) -> None:
+        with self.transaction() as conn:
+            conn.executemany(
+                """
+                UPDATE backfill_keys SET status=?
+                WHERE name=? AND bucket_key=?
+                """,
+                ((status, name, bucket_key) for bucket_key in bucket_keys)
+            )
+            remaining = conn.execute(
+                """
+                SELECT COUNT(*) FROM backfill_keys
+                WHERE name=? AND status != 'done'
+                """,
+                (name,)
+            ).fetchone()[0]
+            conn.execute(
+                "UPDATE backfills SET finished_at=? WHERE name=?",
+                (None if remaining else time.time(), name)
+            )
+
+    def record_stage_stats(self,
+                           stats: instrumentation.StageStats,
+                           now: float | None = None) -> None:
+        """Keep an asset execution's stats for admission control."""
+        now = time.time() if now is None else now
+        with self.transaction() as conn:
+            conn.execute(
+                """
+                INSERT INTO stage_stats (stage, finished_at, partitions,
+                    wall_s, cpu_s, db_s, bytes_in, bytes_out)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (stats.stage, now, stats.partitions, stats.wall_s,
+                 stats.cpu_s, stats.db_s, stats.bytes_in, stats.bytes_out)
+            )
+            conn.execute(
+                "DELETE FROM stage_stats WHERE finished_at < ?",
+                (now - STAGE_STATS_RETENTION_S,)
+            )
+
+    def stage_totals(self,
+                     since: float) -> dict[str, tuple[int, float, int]]:
+        """Per stage `(partitions, wall_s, bytes_in)` summed since `since`."""
+        with self.connection() as conn:
+            return {
+                stage: (partitions, wall_s, bytes_in)
+                for stage, partitions, wall_s, bytes_in in conn.execute(
+                    """
+                    SELECT stage, SUM(partitions), SUM(wall_s), SUM(bytes_in)
+                    FROM stage_stats WHERE finished_at >= ?
+                    GROUP BY stage
+                    """,
+                    (since,)
+                )
+            }
+
+    def _stream(self,
+                query: str,
+                params: Iterable[Any] = ()) -> Iterator[tuple]:
+        """Yield a query's rows, fetched `CHUNK_WRITE_BATCH` at a time.
+
+        Only the fetches count as DB time, not the caller's work between
+        rows; the last column of each row counts towards bytes read.
+        """
+        with self.pool.connection() as conn:
+            with instrumentation.timed("db"):
+                cur = conn.execute(query, tuple(params))
+            while True:
+                with instrumentation.timed("db"):
+                    rows = cur.fetchmany(CHUNK_WRITE_BATCH)
+                if not rows:
+                    return
+                instrumentation.add("bytes_in", sum(
+                    instrumentation.size_of(row[-1]) for row in rows
+                ))
+                yield from rows
+
+    def _select_in(self,
+                   query: str,
+                   params: tuple,
+                   keys: Iterable[str]) -> dict[str, Any]:
+        """Run a two-column `... IN (...)` query over `keys` in batches."""
+        keys = list(keys)
+        values: dict[str, Any] = {}
+        with self.connection() as conn:
+            for pos in range(0, len(keys), _MAX_PARAMS):
+                batch = keys[pos:pos+_MAX_PARAMS]
+                batch_query = query + f"({','.join('?' * len(batch))})"
+                values.update(
+                    conn.execute(batch_query, (*params, *batch)).fetchall()
+                )
+        instrumentation.add("bytes_in", sum(
+            map(instrumentation.size_of, values.values())
+        ))
+        return values
+
 
 class BucketResource(dg.ConfigurableResource):
+    """Where uploads land: a local directory or an S3 bucket.
+
+    With `backend="s3"`, `s3_bucket` is listed under the `org/usr/`
+    prefix and objects are fetched into `spool_path` on demand.
+    Credentials come from the usual AWS environment/config chain.
+    """
     bucket_path: str
     org: str
     usr: str
+    backend: str = "local"
+    s3_bucket: str = ""
+    endpoint_url: Optional[str] = None
+    region_name: str = "us-east-1"
+    spool_path: str = os.path.join(tempfile.gettempdir(), "ingestion-spool")
+
+    def client(self) -> Any:
+        from ..utils import s3_bucket
+        return s3_bucket.get_client(self.endpoint_url, self.region_name)
+
+    def source_path(self, bucket_key: str) -> str:
+        """Where the file of `bucket_key` lives: a local path or `s3://` URI."""
+        if self.backend == "s3":
+            return f"s3://{self.s3_bucket}{bucket_key}"
+        return str(Path(self.bucket_path) / bucket_key.lstrip("/"))
+
+    def fetch(self, file_path: str) -> str:
+        """Return a local path for `file_path`, spooling S3 objects."""
+        if not file_path.startswith("s3://"):
+            return file_path
+        from ..utils import s3_bucket
+        bucket, key = s3_bucket.parse_uri(file_path)
+        return str(s3_bucket.fetch(self.client(), bucket, key, self.spool_path))
+
+    def evict(self, bucket_keys: Iterable[str]) -> int:
+        """Drop the spooled copies of deleted files; return how many."""
+        if self.backend != "s3":
+            return 0
+        from ..utils import s3_bucket
+        return s3_bucket.evict(self.spool_path, self.s3_bucket, (
+            bucket_key.lstrip("/") for bucket_key in bucket_keys
+        ))
 
 class BucketIOManager(dg.ConfigurableIOManager):
+    """Optionally exports each asset's output table as Arrow files.
+
+    The assets work from SQLite and pass nothing to each other, so the
+    tables are an export for scanning a whole stage with
+    `columnar.dataset`, off unless `export` is set. Stages do not even
+    build them otherwise. Every partition is written to its own
+    uncompressed Arrow IPC file at
+    `root/<asset>/bucket_key=<uri-encoded key>/part-0.arrow` (see
+    `utils.columnar`). Partitions listed under `UNCHANGED_METADATA_KEY`
+    in the output's metadata keep the files they have. `root` is also
+    where deleted files' tables are purged from.
+    """
     root: str
+    export: bool = False
+
+    @staticmethod
+    def _partition_keys(
+        context: dg.OutputContext | dg.InputContext
+    ) -> list[str]:
+        if context.has_asset_partitions:
+            return list(context.asset_partition_keys)
+        assert context.has_partition_key, \
+            "Error: BucketIOManager only stores partitioned assets"
+        return [context.partition_key]
 
     def handle_output(self, context: dg.OutputContext, obj: dg.Any) -> None:
-        pass
+        if obj is None or not self.export:
+            return
+        from ..utils import columnar
+        stage = "/".join(context.asset_key.path)
+        unchanged = context.output_metadata.get(UNCHANGED_METADATA_KEY)
+        unchanged = set(getattr(unchanged, "value", unchanged) or ())
+        columnar.write_partitions(self.root, stage, obj, [
+            bucket_key for bucket_key in self._partition_keys(context)
+            if bucket_key not in unchanged
+        ])
+        context.add_output_metadata({
+            "rows": obj.num_rows,
+            "bytes": obj.nbytes,
+        })
 
     def load_input(self, context: dg.InputContext) -> dg.Any:
-        pass
+        from ..utils import columnar
+        stage = "/".join(context.asset_key.path)
+        return columnar.read_partitions(
+            self.root, stage, self._partition_keys(context)
+        )
 
 
 @dg.definitions
 def resources():
+    store_root = "./tmp/"
     return dg.Definitions(
         resources={
             "db": SQLiteResource(
                 db_path=os.path.join(
                     os.getcwd().split("src")[0],
                     "database/dummy.db"
-                )
+                ),
+                store_root=store_root
             ),
             "bucket": BucketResource(
                 bucket_path=os.path.join(
@@ -38,6 +1087,7 @@ def resources():
                 org="org",
                 usr="usr"
             ),
-            "bucket_io_manager": BucketIOManager(root="./tmp/")
+            "bucket_io_manager": BucketIOManager(root=store_root,
+                                                 export=EXPORT_TABLES)
         }
-    )
\ No newline at end of file
+    )
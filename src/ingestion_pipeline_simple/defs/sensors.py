@@ -1,73 +1,396 @@
 import dagster as dg
+import json
 import os
+import time
 from pathlib import Path
+from typing import Callable, Collection
+from dagster._core.storage.tags import (
+    ASSET_PARTITION_RANGE_START_TAG,
+    ASSET_PARTITION_RANGE_END_TAG,
+)
 from . import assets, resources
+from ..utils import scan_index
 
 
 add_to_db = dg.define_asset_job(
-    "add_to_db", selection=["*json_files", "*vec_embeddings"],op_retry_policy=dg.RetryPolicy(max_retries=0),
+    "add_to_db", selection=["*json_files", "*relationships"],op_retry_policy=dg.RetryPolicy(max_retries=0),
 )
 
+# Incremental ticks skip directories whose mtime is unchanged, which
+# misses files rewritten in place; a periodic full scan catches those
+FULL_RESCAN_SECONDS = 15 * 60
 
-@dg.sensor(
-    job=add_to_db,
-    minimum_interval_seconds=5,
-    default_status=dg.DefaultSensorStatus.RUNNING
+# Admission control. Detected files wait in the `ingest_backlog` table
+# and are admitted as runs only while fewer than this many add_to_db runs
+# are queued or in progress.
+MAX_IN_FLIGHT_RUNS = int(os.environ.get("INGESTION_MAX_IN_FLIGHT_RUNS", "4"))
+# "age" admits the oldest files first, "size" the smallest
+ADMISSION_ORDER = os.environ.get("INGESTION_ADMISSION_ORDER", "age")
+# With "size" order, files waiting longer than this go first regardless
+MAX_WAIT_SECONDS = 30 * 60
+# Batches are sized to take about this long at the throughput observed
+# over the last STATS_WINDOW_SECONDS of stage stats
+TARGET_RUN_SECONDS = 120.0
+STATS_WINDOW_SECONDS = 30 * 60
+# Floor on a document's cost relative to an average-sized one
+MIN_COST_FRACTION = 0.1
+# Files of at least `assets.LARGE_FILE_BYTES` take a lane of their own:
+# one run per file, at most this many at once, and neither counted
+# against nor queued ahead of MAX_IN_FLIGHT_RUNS, so small files never
+# wait behind a large one
+MAX_LARGE_IN_FLIGHT_RUNS = int(
+    os.environ.get("INGESTION_MAX_LARGE_IN_FLIGHT_RUNS", "1")
 )
-def file_monitor(
-    context: dg.SensorEvaluationContext,
-    bucket: resources.BucketResource
-) -> dg.SensorResult:
-    last_mtime: float = float(context.cursor) if context.cursor else 0
-    dirpath = Path(bucket.bucket_path, bucket.org, bucket.usr)
-    
-    files_stats: list[tuple[Path, os.stat_result]] = [
-        (filepath, os.stat(filepath))
-        for filepath in (
-            Path(root, file)
-            for root, _, files in os.walk(dirpath)
-            for file in files
-        )
-        if os.path.isfile(filepath)
-    ]
+# Run tag naming the lane a run was admitted in
+LANE_TAG = "ingestion/lane"
+# Deleted files purged per tick; the rest wait for the next one
+PURGE_BATCH_SIZE = 500
 
-    new_files: list[Path] = [file for file, fstats in files_stats
-                             if fstats.st_mtime > last_mtime]
-    
-    filekeys: list[str] = [str(filepath).split("test_bucket")[-1]
-                           for filepath in new_files]
-    
-    try:
-        max_new_mtime: float = max([
-            fstats.st_mtime for _, fstats in files_stats
-        ])
-    except ValueError:
-        max_new_mtime = 0
-    
-    max_mtime: float = max(last_mtime, max_new_mtime)
-    context.update_cursor(str(max_mtime))
+_IN_FLIGHT_STATUSES = [
+    dg.DagsterRunStatus.QUEUED,
+    dg.DagsterRunStatus.NOT_STARTED,
+    dg.DagsterRunStatus.STARTING,
+    dg.DagsterRunStatus.STARTED,
+]
 
-    run_reqs: list[dg.RunRequest] = [
-        dg.RunRequest(
-            partition_key=filekey,
-            run_key=filekey,
+
+def _bucket_key(bucket_path: str | Path, filepath: str | Path) -> str:
+    return "/" + Path(filepath).relative_to(bucket_path).as_posix()
+
+
+def _doc_cost(
+    db: resources.SQLiteResource
+) -> Callable[[resources.BacklogEntry], float]:
+    """Estimate the run seconds a file will take from recent stage stats.
+
+    A document costs the per-document wall time summed over every stage,
+    scaled by its size relative to the average document seen. Without
+    stats every file costs nothing and only `RUN_BATCH_SIZE` bounds runs.
+    """
+    totals = db.stage_totals(time.time() - STATS_WINDOW_SECONDS)
+    per_doc_s = sum(
+        wall_s / partitions
+        for partitions, wall_s, _ in totals.values() if partitions
+    )
+    partitions, _, bytes_in = totals.get("binary_files", (0, 0.0, 0))
+    mean_size = bytes_in / partitions if partitions else 0
+
+    def cost(entry: resources.BacklogEntry) -> float:
+        if not mean_size:
+            return per_doc_s
+        return per_doc_s * max(entry.size / mean_size, MIN_COST_FRACTION)
+    return cost
+
+
+def _plan_batches(
+    entries: list[resources.BacklogEntry],
+    existing: set[str],
+    slots: int,
+    cost: Callable[[resources.BacklogEntry], float]
+) -> list[list[str]]:
+    """Group backlog entries, in admission order, into at most `slots` runs.
+
+    A batch is launched as a partition key range, so its keys must be
+    contiguous in the dynamic partition order. Keys that do not exist yet
+    are appended in order by this tick's add request and can be batched,
+    up to `RUN_BATCH_SIZE` keys or `TARGET_RUN_SECONDS` of estimated work;
+    keys that already exist (re-detected files) get a run of their own.
+    """
+    batches: list[list[str]] = []
+    batch: list[str] | None = None
+    batch_cost = 0.0
+    for entry in entries:
+        if entry.bucket_key in existing:
+            if len(batches) < slots:
+                batches.append([entry.bucket_key])
+            continue
+        doc_cost = cost(entry)
+        if batch is not None and (
+            len(batch) >= assets.RUN_BATCH_SIZE
+            or batch_cost + doc_cost > TARGET_RUN_SECONDS
+        ):
+            batch = None
+        if batch is None:
+            if len(batches) >= slots:
+                continue
+            batch = []
+            batch_cost = 0.0
+            batches.append(batch)
+        batch.append(entry.bucket_key)
+        batch_cost += doc_cost
+    return batches
+
+
+def _batch_run_requests(
+    batches: list[list[str]],
+    file_paths: dict[str, str],
+    versions: dict[str, str | None],
+    seq: int,
+    lane: str = "small"
+) -> list[dg.RunRequest]:
+    """One run per batch: a partition run for a single key, else a range.
+
+    Run keys end with the admission `seq`, so a file admitted again (it
+    changed, or was deleted and uploaded anew) is not deduplicated
+    against an earlier run; single runs also carry the file's version.
+    Every run is tagged with its `lane`.
+    """
+    run_reqs: list[dg.RunRequest] = []
+    for batch in batches:
+        if len(batch) == 1:
+            [filekey] = batch
+            run_reqs.append(dg.RunRequest(
+                partition_key=filekey,
+                run_key="@".join(filter(None, [
+                    filekey, versions.get(filekey), str(seq)
+                ])),
+                tags={LANE_TAG: lane},
+                run_config={
+                    "ops": {
+                        "binary_files": {
+                            "config": {
+                                "file_path": file_paths[filekey]
+                            }
+                        }
+                    }
+                }
+            ))
+            continue
+        run_reqs.append(dg.RunRequest(
+            run_key=f"{batch[0]}..{batch[-1]}@{seq}",
+            tags={
+                ASSET_PARTITION_RANGE_START_TAG: batch[0],
+                ASSET_PARTITION_RANGE_END_TAG: batch[-1],
+                LANE_TAG: lane,
+            },
             run_config={
                 "ops": {
                     "binary_files": {
                         "config": {
-                            "file_path": str(filepath)
+                            "file_paths": {
+                                filekey: file_paths[filekey]
+                                for filekey in batch
+                            }
                         }
                     }
                 }
             }
-        )
-        for filepath, filekey in zip(new_files, filekeys)
+        ))
+    return run_reqs
+
+
+@dg.sensor(
+    job=add_to_db,
+    minimum_interval_seconds=5,
+    default_status=dg.DefaultSensorStatus.RUNNING
+)
+def file_monitor(
+    context: dg.SensorEvaluationContext,
+    bucket: resources.BucketResource,
+    db: resources.SQLiteResource
+) -> dg.SensorResult:
+    """Queue new and changed files, then admit as many as there is room for.
+
+    Admission is settled through the cursor: rows admitted by a tick are
+    tagged with its sequence number, which only reaches the cursor along
+    with the tick's run requests. The next tick drops rows of committed
+    ticks and puts any others back in line.
+
+    Deleted files are purged from the database and the Arrow store, and
+    their partitions deleted. Purged tombstones are paged through with
+    the cursor, so a tick that never committed its delete request is made
+    up for by the next.
+    """
+    cursor: dict = json.loads(context.cursor) if context.cursor else {}
+    detected = detect_changes(bucket, db, cursor, context.log.info)
+    committed_seq: int = cursor.get("admit_seq", 0)
+    db.settle_backlog(committed_seq)
+    db.enqueue_backlog(detected)
+    purge_deleted(db, context.log.info, db.store_root, bucket=bucket)
+
+    in_flight = context.instance.get_runs_count(dg.RunsFilter(
+        job_name=add_to_db.name,
+        statuses=_IN_FLIGHT_STATUSES,
+    ))
+    large_in_flight = context.instance.get_runs_count(dg.RunsFilter(
+        job_name=add_to_db.name,
+        statuses=_IN_FLIGHT_STATUSES,
+        tags={LANE_TAG: "large"},
+    ))
+    # Untagged runs (e.g. backfills launched from the UI) count as small
+    slots = max(0, MAX_IN_FLIGHT_RUNS - (in_flight - large_in_flight))
+    large_slots = max(0, MAX_LARGE_IN_FLIGHT_RUNS - large_in_flight)
+    entries = db.pending_backlog(
+        slots * assets.RUN_BATCH_SIZE, ADMISSION_ORDER, MAX_WAIT_SECONDS,
+        max_size=assets.LARGE_FILE_BYTES,
+    ) if slots else []
+    large_entries = db.pending_backlog(
+        large_slots, ADMISSION_ORDER, MAX_WAIT_SECONDS,
+        min_size=assets.LARGE_FILE_BYTES,
+    ) if large_slots else []
+    existing = set(context.instance.get_dynamic_partitions(
+        assets.files_partition_def.name
+    ))
+    # Only purges since the last committed tick; the cursor moves along
+    # with their delete request, so an uncommitted tick asks again
+    purged = db.purged_since(tuple(cursor.get("purged_mark", (0.0, ""))),
+                             PURGE_BATCH_SIZE)
+    deleted = [key for _, key in purged if key in existing]
+    if purged:
+        cursor["purged_mark"] = list(purged[-1])
+    batches = _plan_batches(entries, existing, slots, _doc_cost(db))
+    large_batches = [[entry.bucket_key] for entry in large_entries]
+    admitted: list[str] = [
+        key for batch in batches + large_batches for key in batch
     ]
+    if admitted:
+        db.admit_backlog(admitted, committed_seq + 1)
+        cursor["admit_seq"] = committed_seq + 1
+    context.log.info(
+        f"Admitted {len(admitted)} files in {len(batches)} runs and "
+        f"{len(large_batches)} large-file runs ({in_flight} in flight, "
+        f"{db.backlog_size()} waiting), deleting {len(deleted)} partitions"
+    )
+    context.update_cursor(json.dumps(cursor))
 
+    entries += large_entries
+    file_paths = {entry.bucket_key: entry.file_path for entry in entries}
+    versions = {entry.bucket_key: entry.version for entry in entries}
+    run_reqs: list[dg.RunRequest] = [
+        *_batch_run_requests(batches, file_paths, versions,
+                             committed_seq + 1),
+        *_batch_run_requests(large_batches, file_paths, versions,
+                             committed_seq + 1, "large"),
+    ]
+
+    partition_reqs: list[dg.AddDynamicPartitionsRequest
+                         | dg.DeleteDynamicPartitionsRequest] = [
+        assets.files_partition_def.build_add_request(
+            [key for key in admitted if key not in existing]
+        )
+    ]
+    if deleted:
+        partition_reqs.append(
+            assets.files_partition_def.build_delete_request(deleted)
+        )
     return dg.SensorResult(
         run_requests=run_reqs,
-        dynamic_partitions_requests=[
-            assets.files_partition_def.build_add_request(filekeys)
-        ],
+        dynamic_partitions_requests=partition_reqs,
         cursor=context.cursor
     )
+
+
+def purge_deleted(
+    db: resources.SQLiteResource,
+    log: Callable[[str], None],
+    store_root: str | Path | None = None,
+    limit: int = PURGE_BATCH_SIZE,
+    skip: Collection[str] = (),
+    bucket: resources.BucketResource | None = None
+) -> list[str]:
+    """Purge up to `limit` files tombstoned by `detect_changes`.
+
+    Their rows go from every table (see `SQLiteResource.purge`), with
+    `store_root` their stage tables from the Arrow store, and with
+    `bucket` their spooled copies. Keys in `skip` (still being ingested)
+    wait for a later call. Returns the keys purged.
+    """
+    keys = [key for key in db.tombstones(purged=False, limit=limit)
+            if key not in skip]
+    if not keys:
+        return []
+    rows = db.purge(keys)
+    files = 0
+    if store_root is not None:
+        from ..utils import columnar
+        files = columnar.delete_partitions(store_root, keys)
+    spooled = bucket.evict(keys) if bucket is not None else 0
+    log(
+        f"Purged {len(keys)} deleted files: {rows} rows, "
+        f"{files} stored tables, {spooled} spooled copies"
+    )
+    return keys
+
+
+def detect_changes(
+    bucket: resources.BucketResource,
+    db: resources.SQLiteResource,
+    cursor: dict,
+    log: Callable[[str], None]
+) -> list[tuple[str, str, str | None, int]]:
+    """New or changed files in the bucket since the last call.
+
+    Rows are `(key, path, version, size)`. Deleted files are tombstoned
+    on the way, for `purge_deleted`. `cursor` carries the scan state
+    between calls and is updated in place; `log` gets a summary line.
+    """
+    if bucket.backend == "s3":
+        return _scan_s3(bucket, db, cursor, log)
+    return _scan_local(bucket, db, cursor, log)
+
+
+def _scan_local(
+    bucket: resources.BucketResource,
+    db: resources.SQLiteResource,
+    cursor: dict,
+    log: Callable[[str], None]
+) -> list[tuple[str, str, str | None, int]]:
+    """New or changed files as `(key, path, version, size)` rows."""
+    last_full_scan: float = cursor.get("last_full_scan", 0)
+    now = time.time()
+    full = now - last_full_scan >= FULL_RESCAN_SECONDS
+    dirpath = Path(bucket.bucket_path, bucket.org, bucket.usr)
+
+    delta = scan_index.scan(db, dirpath, full=full)
+    log(
+        f"Scanned {dirpath}: {len(delta.added)} added, "
+        f"{len(delta.changed)} changed, {len(delta.deleted)} deleted "
+        f"({delta.dirs_listed} dirs listed, {delta.dirs_pruned} pruned)"
+    )
+    if full:
+        cursor["last_full_scan"] = now
+    if delta.deleted:
+        db.tombstone(
+            _bucket_key(bucket.bucket_path, path) for path in delta.deleted
+        )
+
+    # Versioned by size and mtime; reading the files is left to the run
+    return [
+        (_bucket_key(bucket.bucket_path, entry.path), entry.path,
+         f"{entry.size}-{entry.mtime_ns}", entry.size)
+        for entry in delta.added + delta.changed
+    ]
+
+
+def _scan_s3(
+    bucket: resources.BucketResource,
+    db: resources.SQLiteResource,
+    cursor: dict,
+    log: Callable[[str], None]
+) -> list[tuple[str, str, str | None, int]]:
+    """Like `_scan_local`, resuming the bucket listing from the cursor."""
+    from ..utils import s3_bucket
+    prefix = f"{bucket.org}/{bucket.usr}/"
+    delta = s3_bucket.list_changes(
+        db,
+        bucket.client(),
+        bucket.s3_bucket,
+        prefix,
+        token=cursor.get("s3_token"),
+        generation=cursor.get("s3_generation", 1),
+    )
+    log(
+        f"Listed s3://{bucket.s3_bucket}/{prefix}: {len(delta.added)} added, "
+        f"{len(delta.changed)} changed, {len(delta.deleted)} deleted"
+        + (" (listing continues next tick)" if delta.token else "")
+    )
+    cursor["s3_token"] = delta.token
+    cursor["s3_generation"] = delta.generation
+    if delta.deleted:
+        db.tombstone("/" + key for key in delta.deleted)
+
+    return [
+        ("/" + obj.key, f"s3://{bucket.s3_bucket}/{obj.key}", obj.etag,
+         obj.size)
+        for obj in delta.added + delta.changed
+    ]
@@ -0,0 +1,417 @@
+import os
+import threading
+from pathlib import Path
+from typing import NamedTuple, Sequence
+import sqlite3
+
+import numpy as np
+
+from .scan_index import Database
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Below this many vectors an index is not clustered and every search is
+# exact; the scan is cheaper than keeping centroids up to date
+TRAIN_MIN = 256
+NLIST_MAX = 1024
+# Centroids are trained on at most this many vectors per list
+TRAIN_PER_LIST = 64
+KMEANS_ITERS = 10
+NPROBE = 8
+# Retrain once the index holds this many times what it was trained on,
+# and compact once more than half the file is vectors of removed items
+RETRAIN_GROWTH = 4
+_BLOCK_ROWS = 65536
+_MAX_PARAMS = 500
+
+
+class Hit(NamedTuple):
+    doc_key: str
+    idx: int
+    score: float
+
+
+class _Meta(NamedTuple):
+    dim: int
+    generation: int
+    nlist: int
+    trained_on: int
+    centroids: np.ndarray | None
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def _kmeans(sample: np.ndarray,
+            nlist: int,
+            iters: int = KMEANS_ITERS,
+            seed: int = 0) -> np.ndarray:
+    """Spherical k-means: centroids are unit vectors, similarity is dot."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        # An empty list keeps its old centroid rather than collapsing
+        filled = np.bincount(assign, minlength=nlist) > 0
+        centroids[filled] = _normalize(sums[filled])
+    return centroids
+
+
+class IVFIndex:
+    """An inverted-file ANN index over unit vectors, kept on disk.
+
+    Vectors are appended to a raw float32 file that searches memory-map,
+    so only the pages of probed lists are ever read. The inverted lists
+    (which file row belongs to which chunk and which centroid) and the
+    centroids live in the `ann_items`/`ann_meta` tables, which makes each
+    update a single SQLite transaction; the file is only ever appended to
+    inside that transaction's write lock. Rows of removed items stay in
+    the file until the next rebuild, which compacts it into a new
+    generation and retrains the centroids.
+
+    A `resident` index reads the vectors into memory instead, for
+    long-lived readers that should not wait on disk: rows appended since
+    the last search are read on the next one, and a new generation is
+    read whole.
+    """
+
+    def __init__(self,
+                 db: Database,
+                 root: str | Path,
+                 name: str,
+                 dim: int,
+                 resident: bool = False) -> None:
+        self.db = db
+        self.root = Path(root)
+        self.name = name
+        self.dim = dim
+        self.resident = resident
+        self._loaded: tuple[int, np.ndarray] | None = None
+        self._load_lock = threading.Lock()
+
+    def _path(self, generation: int) -> Path:
+        return self.root / f"{self.name}.{generation}.f32"
+
+    def _rows_in(self, path: Path) -> int:
+        try:
+            return os.path.getsize(path) // (4 * self.dim)
+        except FileNotFoundError:
+            return 0
+
+    def _vectors(self, generation: int) -> np.ndarray:
+        path = self._path(generation)
+        rows = self._rows_in(path)
+        if rows == 0:
+            return np.empty((0, self.dim), dtype="<f4")
+        if not self.resident:
+            return np.memmap(path, dtype="<f4", mode="r",
+                             shape=(rows, self.dim))
+        with self._load_lock:
+            held = np.empty((0, self.dim), dtype="<f4")
+            if self._loaded is not None and self._loaded[0] == generation:
+                held = self._loaded[1]
+            if len(held) < rows:
+                try:
+                    tail = np.fromfile(
+                        path, dtype="<f4",
+                        count=(rows - len(held)) * self.dim,
+                        offset=len(held) * 4 * self.dim
+                    ).reshape(-1, self.dim)
+                except FileNotFoundError:
+                    # Replaced by a rebuild; the caller sees rows missing
+                    # and retries with the new generation
+                    return np.empty((0, self.dim), dtype="<f4")
+                held = np.concatenate([held, tail]) if len(held) else tail
+                self._loaded = (generation, held)
+            return held[:rows]
+
+    def _meta(self, conn: sqlite3.Connection) -> _Meta | None:
+        row = conn.execute(
+            """
+            SELECT dim, generation, nlist, trained_on, centroids
+            FROM ann_meta WHERE name=?
+            """,
+            (self.name,)
+        ).fetchone()
+        if row is None:
+            return None
+        dim, generation, nlist, trained_on, blob = row
+        centroids = None
+        if blob is not None:
+            centroids = np.frombuffer(blob, dtype="<f4").reshape(nlist, dim)
+        return _Meta(dim, generation, nlist, trained_on, centroids)
+
+    def _writable_meta(self, conn: sqlite3.Connection) -> _Meta:
+        meta = self._meta(conn)
+        if meta is not None and meta.dim == self.dim:
+            return meta
+        # New index, or the embedder changed and old vectors are useless
+        generation = 0 if meta is None else meta.generation + 1
+        conn.execute("DELETE FROM ann_items WHERE name=?", (self.name,))
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO ann_meta (name, dim, generation)
+            VALUES (?, ?, ?)
+            """,
+            (self.name, self.dim, generation)
+        )
+        return _Meta(self.dim, generation, 0, 0, None)
+
+    def _assign(self, vectors: np.ndarray, meta: _Meta) -> np.ndarray:
+        if meta.centroids is None:
+            return np.zeros(len(vectors), dtype=np.int64)
+        return np.argmax(vectors @ meta.centroids.T, axis=1)
+
+    def _drop_old_files(self, generation: int) -> None:
+        """Unlink the files of generations before a committed `generation`.
+
+        Runs after the commit, without the write lock, so another writer
+        may have moved on to a later generation meanwhile; generations
+        only grow, so anything older than ours is dead, while later ones
+        must be left alone. Readers that already mapped an old file keep
+        it alive until they are done; unlinking only removes its name.
+        """
+        for path in self.root.glob(f"{self.name}.*.f32"):
+            suffix = path.name[len(self.name) + 1:-len(".f32")]
+            if suffix.isdigit() and int(suffix) < generation:
+                path.unlink(missing_ok=True)
+
+    def remove(self, doc_keys: Sequence[str]) -> None:
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "DELETE FROM ann_items WHERE name=? AND doc_key=?",
+                ((self.name, doc_key) for doc_key in doc_keys)
+            )
+
+    def compact(self) -> bool:
+        """Rebuild if most of the file is vectors of removed items.
+
+        `add` does so as it goes; this catches indexes that only shrink.
+        Returns whether it rebuilt.
+        """
+        with self.db.transaction() as conn:
+            meta = self._meta(conn)
+            if meta is None or meta.dim != self.dim:
+                return False
+            live = conn.execute(
+                "SELECT COUNT(*) FROM ann_items WHERE name=?", (self.name,)
+            ).fetchone()[0]
+            total = self._rows_in(self._path(meta.generation))
+            if total <= 2 * max(live, TRAIN_MIN):
+                return False
+            meta = self._rebuild(conn, meta)
+        self._drop_old_files(meta.generation)
+        return True
+
+    def add(self,
+            items: Sequence[tuple[str, int]],
+            vectors: np.ndarray) -> None:
+        """Add `(doc_key, idx)` items with their unit vectors.
+
+        Items already in the index under the same key are replaced.
+        """
+        assert vectors.shape == (len(items), self.dim), \
+            f"Error: Expected {len(items)} vectors of dim {self.dim}"
+        os.makedirs(self.root, exist_ok=True)
+        vectors = np.ascontiguousarray(vectors, dtype="<f4")
+        with self.db.transaction() as conn:
+            old_generation = getattr(self._meta(conn), "generation", None)
+            meta = self._writable_meta(conn)
+            conn.executemany(
+                "DELETE FROM ann_items WHERE name=? AND doc_key=? AND idx=?",
+                ((self.name, doc_key, idx) for doc_key, idx in items)
+            )
+            path = self._path(meta.generation)
+            # Rows left by a write that never committed are skipped over,
+            # never reused
+            start = self._rows_in(path)
+            with open(path, "ab") as f:
+                f.truncate(start * 4 * self.dim)
+                f.write(vectors.tobytes())
+            conn.executemany(
+                """
+                INSERT INTO ann_items (name, row, doc_key, idx, list_no)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (
+                    (self.name, start + pos, doc_key, idx, int(list_no))
+                    for pos, ((doc_key, idx), list_no) in enumerate(
+                        zip(items, self._assign(vectors, meta))
+                    )
+                )
+            )
+            live = conn.execute(
+                "SELECT COUNT(*) FROM ann_items WHERE name=?", (self.name,)
+            ).fetchone()[0]
+            total = start + len(items)
+            needs_training = meta.centroids is None and live >= TRAIN_MIN
+            outgrown = meta.centroids is not None \
+                and live >= RETRAIN_GROWTH * meta.trained_on
+            if needs_training or outgrown or total > 2 * max(live, TRAIN_MIN):
+                meta = self._rebuild(conn, meta)
+        # Only a call that moved the index to a new generation (a rebuild,
+        # or a reset for a new dim) leaves files behind
+        if meta.generation != old_generation:
+            self._drop_old_files(meta.generation)
+
+    def _rebuild(self, conn: sqlite3.Connection, meta: _Meta) -> _Meta:
+        rows = conn.execute(
+            """
+            SELECT row, doc_key, idx FROM ann_items
+            WHERE name=? ORDER BY row
+            """,
+            (self.name,)
+        ).fetchall()
+        old = self._vectors(meta.generation)
+        live = np.fromiter((row for row, _, _ in rows), dtype=np.int64,
+                           count=len(rows))
+
+        centroids = None
+        nlist = 0
+        if len(rows) >= TRAIN_MIN:
+            nlist = int(min(NLIST_MAX, max(1, np.sqrt(len(rows)))))
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(
+                live, min(len(live), nlist * TRAIN_PER_LIST), replace=False
+            ))
+            centroids = _kmeans(np.asarray(old[sample], dtype=np.float32),
+                                nlist)
+        new_meta = _Meta(self.dim, meta.generation + 1,
+                         nlist, len(rows), centroids)
+
+        lists = np.empty(len(rows), dtype=np.int64)
+        with open(self._path(new_meta.generation), "wb") as f:
+            for pos in range(0, len(live), _BLOCK_ROWS):
+                block = np.asarray(old[live[pos:pos+_BLOCK_ROWS]])
+                lists[pos:pos+len(block)] = self._assign(block, new_meta)
+                f.write(block.tobytes())
+
+        conn.execute("DELETE FROM ann_items WHERE name=?", (self.name,))
+        conn.executemany(
+            """
+            INSERT INTO ann_items (name, row, doc_key, idx, list_no)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (
+                (self.name, pos, doc_key, idx, int(list_no))
+                for pos, ((_, doc_key, idx), list_no) in enumerate(
+                    zip(rows, lists)
+                )
+            )
+        )
+        conn.execute(
+            """
+            UPDATE ann_meta
+            SET generation=?, nlist=?, trained_on=?, centroids=?
+            WHERE name=?
+            """,
+            (
+                new_meta.generation,
+                nlist,
+                len(rows),
+                None if centroids is None else centroids.astype("<f4").tobytes(),
+                self.name,
+            )
+        )
+        logger.info(
+            f"Rebuilt ANN index {self.name}: {len(rows)} vectors, "
+            f"{nlist} lists"
+        )
+        return new_meta
+
+    def __len__(self) -> int:
+        with self.db.connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM ann_items WHERE name=?", (self.name,)
+            ).fetchone()[0]
+
+    def _candidates(
+        self,
+        queries: np.ndarray,
+        nprobe: int
+    ) -> tuple[np.ndarray, list[tuple], np.ndarray] | None:
+        """Probed lists, their rows and the mapped vectors, or None if the
+        file was replaced under us and the caller should retry."""
+        probes = np.zeros((len(queries), 1), dtype=np.int64)
+        with self.db.connection() as conn:
+            # One read transaction, so the meta and the rows agree
+            conn.execute("BEGIN")
+            meta = self._meta(conn)
+            if meta is None or meta.dim != self.dim:
+                return probes, [], np.empty((0, self.dim), dtype="<f4")
+            # Once mapped, the file outlives a rebuild unlinking it
+            vectors = self._vectors(meta.generation)
+            if meta.centroids is None:
+                rows = conn.execute(
+                    """
+                    SELECT row, doc_key, idx, list_no FROM ann_items
+                    WHERE name=?
+                    """,
+                    (self.name,)
+                ).fetchall()
+            else:
+                nprobe = min(nprobe, meta.nlist)
+                probes = np.argpartition(
+                    -(queries @ meta.centroids.T), nprobe - 1, axis=1
+                )[:, :nprobe]
+                lists = np.unique(probes).tolist()
+                rows = []
+                for pos in range(0, len(lists), _MAX_PARAMS):
+                    batch = lists[pos:pos+_MAX_PARAMS]
+                    rows.extend(conn.execute(
+                        f"""
+                        SELECT row, doc_key, idx, list_no FROM ann_items
+                        WHERE name=? AND list_no IN ({','.join('?' * len(batch))})
+                        """,
+                        (self.name, *batch)
+                    ))
+        if rows and max(row[0] for row in rows) >= len(vectors):
+            return None
+        return probes, rows, vectors
+
+    def search(self,
+               queries: np.ndarray,
+               k: int = 10,
+               nprobe: int = NPROBE) -> list[list[Hit]]:
+        """Top `k` items by dot product for each row of `queries`.
+
+        Each query scans only its `nprobe` nearest lists. Queries are
+        scored together against the union of their lists in one matrix
+        product, then masked back to their own lists.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        for _ in range(3):
+            found = self._candidates(queries, nprobe)
+            if found is not None:
+                break
+        else:
+            raise RuntimeError(f"ANN index {self.name} kept being rebuilt")
+        probes, rows, vectors = found
+        if not rows:
+            return [[] for _ in queries]
+
+        rows.sort()
+        row_ids = np.fromiter((row[0] for row in rows), dtype=np.int64,
+                              count=len(rows))
+        list_nos = np.fromiter((row[3] for row in rows), dtype=np.int64,
+                               count=len(rows))
+        scores = queries @ np.asarray(vectors[row_ids]).T
+        probed = (list_nos[None, None, :] == probes[:, :, None]).any(axis=1)
+        scores[~probed] = -np.inf
+
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        hits: list[list[Hit]] = []
+        for q, candidates in enumerate(top):
+            ordered = candidates[np.argsort(-scores[q, candidates])]
+            hits.append([
+                Hit(rows[c][1], rows[c][2], float(scores[q, c]))
+                for c in ordered if np.isfinite(scores[q, c])
+            ])
+        return hits
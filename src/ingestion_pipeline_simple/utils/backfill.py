@@ -0,0 +1,329 @@
+import argparse
+import copy
+import json
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+from typing import Any, Iterable
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Asset stages in materialization order; a backfill runs from one of them
+# to the end
+STAGES = (
+    "binary_files",
+    "markdown_files",
+    "json_files",
+    "plain_files",
+    "chunks",
+    "vec_embeddings",
+    "relationships",
+)
+# Every run also converts on a pool of its own, so by default half the
+# cores run batches and conversion pools split the cores between them
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+
+
+@dataclass
+class Target:
+    """What a backfill's runs materialize, and against which resources."""
+    db_path: str
+    bucket_path: str
+    org: str = "org"
+    usr: str = "usr"
+    store_root: str = "./tmp/"
+    export: bool = False
+    from_stage: str = "binary_files"
+    run_config: dict[str, Any] = field(default_factory=dict)
+
+
+def select(db: Any,
+           prefix: str = "",
+           file_types: Iterable[str] = (),
+           stale: str | None = None,
+           op_config: dict[str, Any] | None = None
+           ) -> list[tuple[str, str]]:
+    """`(bucket_key, file_path)` of known files to backfill, in key order.
+
+    Files are those under key `prefix`, only of `file_types` (extensions)
+    if given. With `stale` set to a stage, only files whose inputs to that
+    stage changed since it last ran on them (or that it never ran on) are
+    kept; `op_config` is the stage's op config for the backfill.
+    """
+    file_types = set(file_types)
+    files = [
+        (bucket_key, file_path)
+        for bucket_key, file_path in db.iter_files(prefix)
+        if not file_types or file_path.rsplit(".", 1)[-1] in file_types
+    ]
+    if stale is None:
+        return files
+    from ..defs import assets
+    assert stale in STAGES, \
+        f"Error: Unknown stage ({stale}), expected {list(STAGES)}"
+    bucket_keys = [bucket_key for bucket_key, _ in files]
+    recorded = db.get_stage_versions(stale, bucket_keys)
+    if stale == "binary_files":
+        # Only hashing the file again would tell; take never-run files
+        return [row for row in files if row[0] not in recorded]
+    inputs = assets.stage_input_versions(db, stale, bucket_keys, op_config)
+    return [
+        (bucket_key, file_path) for bucket_key, file_path in files
+        if bucket_key not in inputs
+        or recorded.get(bucket_key, ("",))[0] != inputs[bucket_key]
+    ]
+
+
+def plan(bucket_keys: list[str],
+         batch_size: int,
+         order: list[str] | None = None) -> list[list[str]]:
+    """Split keys into runs of at most `batch_size`.
+
+    A run covers a partition key range, so with `order` (the instance's
+    dynamic partition order) each run only holds keys adjacent in it.
+    """
+    if order is None:
+        return [
+            bucket_keys[pos:pos+batch_size]
+            for pos in range(0, len(bucket_keys), batch_size)
+        ]
+    position = {bucket_key: pos for pos, bucket_key in enumerate(order)}
+    batches: list[list[str]] = []
+    for bucket_key in sorted(bucket_keys, key=position.__getitem__):
+        if batches and len(batches[-1]) < batch_size \
+                and position[batches[-1][-1]] + 1 == position[bucket_key]:
+            batches[-1].append(bucket_key)
+        else:
+            batches.append([bucket_key])
+    return batches
+
+
+def _asset_defs(from_stage: str) -> list[Any]:
+    from ..defs import assets
+    asset_defs = [
+        getattr(assets, stage)
+        for stage in STAGES[STAGES.index(from_stage):]
+    ]
+    # The fused text stages are one definition under three names
+    return list({id(asset_def): asset_def for asset_def in asset_defs}.values())
+
+
+def _run_batch(target: Target,
+               batch: list[tuple[str, str | None]],
+               persist: bool) -> tuple[list[str], str | None]:
+    """Materialize one batch; return its keys and an error, if any."""
+    import dagster as dg
+    from dagster._core.storage.tags import (
+        ASSET_PARTITION_RANGE_START_TAG,
+        ASSET_PARTITION_RANGE_END_TAG,
+    )
+    from ..defs import assets, resources
+    bucket_keys = [bucket_key for bucket_key, _ in batch]
+    try:
+        if persist:
+            instance = dg.DagsterInstance.get()
+        else:
+            instance = dg.DagsterInstance.ephemeral()
+            instance.add_dynamic_partitions(
+                assets.files_partition_def.name, bucket_keys
+            )
+        run_config = copy.deepcopy(target.run_config)
+        if target.from_stage == "binary_files":
+            run_config.setdefault("ops", {}).setdefault(
+                "binary_files", {}
+            ).setdefault("config", {})["file_paths"] = dict(batch)
+        res = dg.materialize(
+            _asset_defs(target.from_stage),
+            instance=instance,
+            resources={
+                "db": resources.SQLiteResource(db_path=target.db_path),
+                "bucket": resources.BucketResource(
+                    bucket_path=target.bucket_path,
+                    org=target.org,
+                    usr=target.usr,
+                ),
+                "bucket_io_manager": resources.BucketIOManager(
+                    root=target.store_root, export=target.export
+                ),
+            },
+            tags={
+                ASSET_PARTITION_RANGE_START_TAG: bucket_keys[0],
+                ASSET_PARTITION_RANGE_END_TAG: bucket_keys[-1],
+            },
+            run_config=run_config,
+            raise_on_error=False,
+        )
+    except Exception as exc:
+        return bucket_keys, f"{type(exc).__name__}: {exc}"
+    return bucket_keys, None if res.success else "Run failed"
+
+
+def _init_worker(conversion_workers: int) -> None:
+    # Read when the conversion engine is first imported, which is later
+    os.environ["INGESTION_CONVERSION_WORKERS"] = str(conversion_workers)
+
+
+def run(db: Any,
+        name: str,
+        batch_size: int = 100,
+        workers: int = DEFAULT_WORKERS,
+        persist: bool = False) -> dict[str, int]:
+    """Run what is left of a checkpointed backfill; return key counts.
+
+    Batches go out to `workers` processes (spawned, so none inherits this
+    one's SQLite or Dagster state) and each key is checkpointed as done
+    or failed when its batch finishes. Failed keys are retried by the
+    next call. With `persist`, runs are recorded in the Dagster instance
+    at $DAGSTER_HOME, which must already have the partitions; otherwise
+    each batch runs against a throwaway instance.
+    """
+    backfill = db.get_backfill(name)
+    assert backfill is not None, f"Error: No backfill named {name}"
+    target = Target(**backfill["params"]["target"])
+    assert target.from_stage in STAGES, \
+        f"Error: Unknown stage ({target.from_stage}), expected {list(STAGES)}"
+    todo = dict(db.backfill_todo(name))
+    order = None
+    if persist:
+        import dagster as dg
+        from ..defs import assets
+        order = dg.DagsterInstance.get().get_dynamic_partitions(
+            assets.files_partition_def.name
+        )
+        missing = set(todo) - set(order)
+        assert not missing, \
+            f"Error: {len(missing)} keys are not partitions, e.g. {min(missing)}"
+    batches = [
+        [(bucket_key, todo[bucket_key]) for bucket_key in batch]
+        for batch in plan(list(todo), batch_size, order)
+    ]
+    logger.info(f"Backfill {name}: {len(todo)} keys in {len(batches)} runs")
+
+    start = time.perf_counter()
+    done = 0
+
+    def checkpoint(bucket_keys: list[str], error: str | None) -> None:
+        nonlocal done
+        db.mark_backfill(name, bucket_keys, "failed" if error else "done")
+        if error:
+            logger.warning(
+                f"Backfill {name}: {bucket_keys[0]}..{bucket_keys[-1]} "
+                f"failed: {error}"
+            )
+            return
+        done += len(bucket_keys)
+        rate = done / (time.perf_counter() - start)
+        logger.info(
+            f"Backfill {name}: {done}/{len(todo)} done, {rate:.1f} keys/s"
+        )
+
+    if workers <= 1:
+        for batch in batches:
+            checkpoint(*_run_batch(target, batch, persist))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(max(1, (os.cpu_count() or 1) // workers),),
+        ) as pool:
+            futures = [
+                pool.submit(_run_batch, target, batch, persist)
+                for batch in batches
+            ]
+            try:
+                for future in as_completed(futures):
+                    checkpoint(*future.result())
+            except BaseException:
+                # Interrupted: unstarted batches stay pending for a resume
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+    return db.get_backfill(name)["counts"]
+
+
+def start(db: Any,
+          name: str,
+          target: Target,
+          prefix: str = "",
+          file_types: Iterable[str] = (),
+          stale: str | None = None) -> int:
+    """Checkpoint a new backfill of the selected files; return its size.
+
+    Staleness is judged with the op config `target.run_config` gives the
+    stale stage.
+    """
+    file_types = sorted(file_types)
+    op_config = target.run_config.get("ops", {}).get(stale or "", {}) \
+        .get("config")
+    files = select(db, prefix, file_types, stale, op_config)
+    params = {
+        "target": asdict(target),
+        "prefix": prefix,
+        "file_types": file_types,
+        "stale": stale,
+    }
+    assert db.create_backfill(name, params, files), \
+        f"Error: Backfill {name} already exists"
+    return len(files)
+
+
+if __name__ == "__main__":
+    from ..defs import resources
+
+    parser = argparse.ArgumentParser(
+        description="Backfill partitions of the files partition set. "
+        "Run again with the same name to resume."
+    )
+    parser.add_argument("name", type=str)
+    parser.add_argument("--db", type=str, default="database/dummy.db")
+    parser.add_argument("--bucket_path", type=str, default="test_bucket")
+    parser.add_argument("--org", type=str, default="org")
+    parser.add_argument("--usr", type=str, default="usr")
+    parser.add_argument("--store", type=str, default="./tmp/")
+    parser.add_argument("--export", action="store_true",
+                        help="Also write each stage's tables under --store")
+    parser.add_argument("-p", "--prefix", type=str, default="",
+                        help="Only bucket keys starting with this")
+    parser.add_argument("-t", "--type", type=str, action="append",
+                        default=[], help="Only this file type, repeatable")
+    parser.add_argument("--stale", type=str, default=None, choices=STAGES,
+                        help="Only files this stage is out of date for")
+    parser.add_argument("--from_stage", type=str, default=None,
+                        choices=STAGES,
+                        help="First stage to run (default: --stale or "
+                        "binary_files)")
+    parser.add_argument("-c", "--config", type=str, default=None,
+                        help="Run config JSON file for every run")
+    parser.add_argument("-b", "--batch_size", type=int, default=100)
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--persist", action="store_true",
+                        help="Record runs in the instance at $DAGSTER_HOME")
+    parser.add_argument("--status", action="store_true",
+                        help="Only print the backfill's progress")
+    opt = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = resources.SQLiteResource(db_path=opt.db)
+    if db.get_backfill(opt.name) is None and not opt.status:
+        run_config = {}
+        if opt.config:
+            with open(opt.config, encoding="utf-8") as f:
+                run_config = json.load(f)
+        target = Target(
+            db_path=os.path.abspath(opt.db),
+            bucket_path=os.path.abspath(opt.bucket_path),
+            org=opt.org,
+            usr=opt.usr,
+            store_root=os.path.abspath(opt.store),
+            export=opt.export,
+            from_stage=opt.from_stage or opt.stale or "binary_files",
+            run_config=run_config,
+        )
+        count = start(db, opt.name, target, opt.prefix, opt.type, opt.stale)
+        print(f"Backfill {opt.name}: {count} files selected")
+    if not opt.status:
+        run(db, opt.name, opt.batch_size, opt.workers, opt.persist)
+    print(json.dumps(db.get_backfill(opt.name), indent=2))
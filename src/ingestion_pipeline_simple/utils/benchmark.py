@@ -0,0 +1,339 @@
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any
+
+# Allowed slowdown against the baseline before a metric is a regression
+TOLERANCE = 0.2
+# Latencies also get this much absolute slack, so millisecond stages do
+# not fail on scheduler noise
+LATENCY_SLACK_S = 0.05
+DOC_SUFFIXES = (".docx", ".pdf")
+# What a sensor daemon or run worker imports before doing any work
+STARTUP_MODULES = (
+    "ingestion_pipeline_simple.defs.sensors",
+    "ingestion_pipeline_simple.definitions",
+)
+# Only imported by the work that needs them: conversion libraries and
+# pyarrow.dataset (which pulls in pandas). Startup must load none of them.
+LAZY_MODULES = ("markitdown", "pdfminer", "pandas", "pyarrow.dataset")
+# Allowed startup time on top of importing Dagster itself
+IMPORT_BUDGET_S = 0.5
+
+
+@dataclass
+class StageLatency:
+    p50_s: float
+    p99_s: float
+    total_s: float
+    samples: int
+
+
+@dataclass
+class BenchResult:
+    docs: int
+    bytes_in: int
+    wall_s: float
+    docs_per_s: float
+    mb_per_s: float
+    peak_rss_bytes: int
+    stages: dict[str, StageLatency]
+    params: dict[str, Any] = field(default_factory=dict)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), indent=2, sort_keys=True)
+
+    @classmethod
+    def from_json(cls, text: str) -> "BenchResult":
+        data = json.loads(text)
+        data["stages"] = {
+            stage: StageLatency(**latency)
+            for stage, latency in data["stages"].items()
+        }
+        return cls(**data)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile; `q` in [0, 100]."""
+    assert values, "Error: No values"
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def run(corpus_dir: str | Path,
+        batch_size: int = 1,
+        fused: bool = False,
+        work_dir: str | None = None) -> BenchResult:
+    """Materialize the whole asset chain over every document in a corpus.
+
+    Documents go through in ranged runs of `batch_size` partitions with
+    `dg.materialize`, against a fresh database and store so nothing is
+    served from the content cache. Stage latencies are the `perf/wall_s`
+    each run reports per stage, i.e. per batch; throughput covers the
+    runs end to end, Dagster overhead included.
+    """
+    import dagster as dg
+    from dagster._core.storage.tags import (
+        ASSET_PARTITION_RANGE_START_TAG,
+        ASSET_PARTITION_RANGE_END_TAG,
+    )
+    from ..defs import assets, resources
+
+    files = sorted(
+        str(path) for path in Path(corpus_dir).iterdir()
+        if path.suffix in DOC_SUFFIXES
+    )
+    assert files, f"Error: No documents in {corpus_dir}"
+    file_paths = {f"/bench/{Path(path).name}": path for path in files}
+    bucket_keys = list(file_paths)
+
+    text_stages = [assets._fused_text_stages()] if fused \
+        else [assets.json_files, assets.plain_files, assets.chunks]
+    asset_defs = [
+        assets.binary_files,
+        assets.markdown_files,
+        # The three names are one definition when already fused
+        *{id(asset_def): asset_def for asset_def in text_stages}.values(),
+        assets.vec_embeddings,
+        assets.relationships,
+    ]
+
+    samples: dict[str, list[float]] = {}
+    peak_rss = 0
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        instance = dg.DagsterInstance.ephemeral()
+        instance.add_dynamic_partitions(
+            assets.files_partition_def.name, bucket_keys
+        )
+        run_resources = {
+            "db": resources.SQLiteResource(
+                db_path=os.path.join(tmp, "bench.db")
+            ),
+            "bucket": resources.BucketResource(
+                bucket_path=str(corpus_dir), org="bench", usr="bench"
+            ),
+            "bucket_io_manager": resources.BucketIOManager(
+                root=os.path.join(tmp, "store")
+            ),
+        }
+        start = time.perf_counter()
+        for pos in range(0, len(bucket_keys), batch_size):
+            batch = bucket_keys[pos:pos+batch_size]
+            res = dg.materialize(
+                asset_defs,
+                instance=instance,
+                resources=run_resources,
+                tags={
+                    ASSET_PARTITION_RANGE_START_TAG: batch[0],
+                    ASSET_PARTITION_RANGE_END_TAG: batch[-1],
+                },
+                run_config={"ops": {"binary_files": {
+                    "config": {"file_paths": {
+                        bucket_key: file_paths[bucket_key]
+                        for bucket_key in batch
+                    }}
+                }}},
+            )
+            assert res.success, "Error: Benchmark run failed"
+            # Every partition of a batch carries the same stage stats
+            seen: set[str] = set()
+            for event in res.get_asset_materialization_events():
+                materialization = \
+                    event.step_materialization_data.materialization
+                stage = materialization.asset_key.to_user_string()
+                if stage in seen:
+                    continue
+                seen.add(stage)
+                metadata = materialization.metadata
+                samples.setdefault(stage, []).append(
+                    metadata["perf/wall_s"].value
+                )
+                peak_rss = max(peak_rss,
+                               metadata["perf/process_peak_rss_bytes"].value)
+        wall_s = time.perf_counter() - start
+
+    bytes_in = sum(os.path.getsize(path) for path in files)
+    return BenchResult(
+        docs=len(files),
+        bytes_in=bytes_in,
+        wall_s=wall_s,
+        docs_per_s=len(files) / wall_s,
+        mb_per_s=bytes_in / (1024 * 1024) / wall_s,
+        peak_rss_bytes=peak_rss,
+        stages={
+            stage: StageLatency(
+                p50_s=percentile(values, 50),
+                p99_s=percentile(values, 99),
+                total_s=sum(values),
+                samples=len(values),
+            )
+            for stage, values in samples.items()
+        },
+        params={"batch_size": batch_size, "fused": fused},
+    )
+
+
+@dataclass
+class ImportTime:
+    module: str
+    seconds: float
+    dagster_s: float
+    lazy_loaded: list[str]
+
+    @property
+    def own_s(self) -> float:
+        """Startup time not spent importing Dagster."""
+        return self.seconds - self.dagster_s
+
+
+_IMPORT_SCRIPT = """
+import importlib, json, sys, time
+start = time.perf_counter()
+import dagster
+dagster_s = time.perf_counter() - start
+module = importlib.import_module(sys.argv[1])
+if hasattr(module, "defs"):
+    module.defs()
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "dagster_s": dagster_s,
+    "lazy_loaded": [name for name in sys.argv[2:] if name in sys.modules],
+}))
+"""
+
+
+def import_time(module: str,
+                repeat: int = 3,
+                cwd: str | Path | None = None) -> ImportTime:
+    """Time a cold import of `module` in fresh interpreters, best of `repeat`.
+
+    A module with a `defs` function (the code location's `definitions`)
+    also has it called, which loads the defs folder as Dagster does.
+    `lazy_loaded` lists the `LAZY_MODULES` the import loaded anyway.
+    """
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", _IMPORT_SCRIPT, module,
+             *LAZY_MODULES],
+            capture_output=True, text=True, check=True, cwd=cwd,
+        ).stdout
+        res = ImportTime(module=module, **json.loads(out.splitlines()[-1]))
+        if best is None or res.seconds < best.seconds:
+            best = res
+    assert best is not None, "Error: repeat must be at least 1"
+    return best
+
+
+def compare(result: BenchResult,
+            baseline: BenchResult,
+            tolerance: float = TOLERANCE) -> list[str]:
+    """Describe every metric of `result` that regressed from `baseline`."""
+    regressions = []
+    for name in ("docs_per_s", "mb_per_s"):
+        value, base = getattr(result, name), getattr(baseline, name)
+        if value < base * (1 - tolerance):
+            regressions.append(f"{name}: {value:.3f} < baseline {base:.3f}")
+    if result.peak_rss_bytes > baseline.peak_rss_bytes * (1 + tolerance):
+        regressions.append(
+            f"peak_rss_bytes: {result.peak_rss_bytes} "
+            f"> baseline {baseline.peak_rss_bytes}"
+        )
+    for stage, base in baseline.stages.items():
+        latency = result.stages.get(stage)
+        if latency is None:
+            continue
+        for name in ("p50_s", "p99_s"):
+            value, limit = getattr(latency, name), getattr(base, name)
+            if value > limit * (1 + tolerance) + LATENCY_SLACK_S:
+                regressions.append(
+                    f"{stage} {name}: {value:.3f} > baseline {limit:.3f}"
+                )
+    return regressions
+
+
+def report(result: BenchResult) -> str:
+    lines = [
+        f"{result.docs} docs, {result.bytes_in / (1024 * 1024):.1f} MB "
+        f"in {result.wall_s:.2f}s: {result.docs_per_s:.2f} docs/s, "
+        f"{result.mb_per_s:.2f} MB/s, "
+        f"peak RSS {result.peak_rss_bytes / (1024 * 1024):.0f} MB",
+        f"{'stage':<16}{'p50 s':>10}{'p99 s':>10}{'total s':>10}",
+    ]
+    for stage, latency in result.stages.items():
+        lines.append(
+            f"{stage:<16}{latency.p50_s:>10.3f}{latency.p99_s:>10.3f}"
+            f"{latency.total_s:>10.3f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from . import handle_files
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the asset chain on a seeded synthetic corpus."
+    )
+    parser.add_argument("-n", "--num_docs", type=int, default=50)
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("--mix", type=str,
+                        default="small:0.7,medium:0.25,large:0.05",
+                        help="Size profile weights, see SIZE_PROFILES")
+    parser.add_argument("--pdf_fraction", type=float, default=0.2)
+    parser.add_argument("-d", "--corpus_dir", type=str,
+                        default="./bench-corpus")
+    parser.add_argument("-b", "--batch_size", type=int, default=10)
+    parser.add_argument("--fused", action="store_true",
+                        help="Run the fused text_stages op")
+    parser.add_argument("-o", "--out", type=str, default=None,
+                        help="Write the result as JSON here")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Fail if the result regressed from this result")
+    parser.add_argument("--save_baseline", action="store_true",
+                        help="Write the result to --baseline instead")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--imports", action="store_true",
+                        help="Only time startup imports, failing on lazy "
+                        "imports or over IMPORT_BUDGET_S")
+    opt = parser.parse_args()
+
+    if opt.imports:
+        failed = False
+        for module in STARTUP_MODULES:
+            res = import_time(module)
+            print(f"{module}: {res.seconds:.3f}s, "
+                  f"{res.own_s:.3f}s over dagster")
+            for name in res.lazy_loaded:
+                print(f"REGRESSION {module} imports {name}")
+            if res.own_s > IMPORT_BUDGET_S:
+                print(f"REGRESSION {module}: {res.own_s:.3f}s "
+                      f"> budget {IMPORT_BUDGET_S}s")
+            failed |= bool(res.lazy_loaded) or res.own_s > IMPORT_BUDGET_S
+        sys.exit(1 if failed else 0)
+
+    handle_files.make_corpus(opt.corpus_dir, opt.num_docs, opt.seed,
+                             opt.mix, opt.pdf_fraction)
+    result = run(opt.corpus_dir, opt.batch_size, opt.fused)
+    result.params.update(num_docs=opt.num_docs, seed=opt.seed, mix=opt.mix,
+                         pdf_fraction=opt.pdf_fraction)
+    print(report(result))
+    if opt.out:
+        Path(opt.out).write_text(result.to_json(), encoding="utf-8")
+    if opt.baseline and opt.save_baseline:
+        Path(opt.baseline).write_text(result.to_json(), encoding="utf-8")
+    elif opt.baseline:
+        baseline = BenchResult.from_json(
+            Path(opt.baseline).read_text(encoding="utf-8")
+        )
+        regressions = compare(result, baseline, opt.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
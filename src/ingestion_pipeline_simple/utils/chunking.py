@@ -0,0 +1,121 @@
+import re
+from typing import Iterator, NamedTuple
+
+UNITS = ("chars", "words", "tokens")
+SNAPS = ("none", "sentence", "paragraph")
+
+_WORD = re.compile(r"\S+")
+# Without a model tokenizer this is the usual stand-in: runs of word
+# characters and single punctuation marks each count as one token
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+_PARAGRAPH = re.compile(r"\n[^\S\n]*\n")
+_SENTENCE = re.compile(r"[.!?][\"')\]]*(?=\s)|\n[^\S\n]*\n")
+# A snapped chunk is never cut shorter than this fraction of `size`
+MIN_FILL = 0.5
+
+
+class Chunk(NamedTuple):
+    idx: int
+    start: int
+    end: int
+    text: str
+
+
+def _boundary_pattern(snap: str) -> re.Pattern | None:
+    return {"sentence": _SENTENCE, "paragraph": _PARAGRAPH}.get(snap)
+
+
+def _check(size: int, overlap: int, unit: str, snap: str) -> None:
+    assert unit in UNITS, f"Error: Unknown unit ({unit}), expected {UNITS}"
+    assert snap in SNAPS, f"Error: Unknown snap ({snap}), expected {SNAPS}"
+    assert size > 0, "Error: Chunk size must be positive"
+    assert 0 <= overlap < size, "Error: Overlap must be in [0, size)"
+
+
+def iter_chunks(text: str,
+                size: int = 128,
+                overlap: int = 0,
+                unit: str = "chars",
+                snap: str = "none") -> Iterator[Chunk]:
+    """Lazily split `text` into chunks of `size` units.
+
+    Consecutive chunks share `overlap` units. With `snap` set, a chunk is
+    cut at the last sentence or paragraph boundary inside its window (as
+    long as that keeps it at least `MIN_FILL` full) rather than mid-way.
+    `start`/`end` are character offsets into `text`, so `text[start:end]`
+    is always the chunk's text. Only one window of units is held at a
+    time, whatever the length of `text`.
+    """
+    _check(size, overlap, unit, snap)
+    if unit == "chars":
+        yield from _iter_char_chunks(text, size, overlap, snap)
+    else:
+        pattern = _WORD if unit == "words" else _TOKEN
+        yield from _iter_span_chunks(text, pattern, size, overlap, snap)
+
+
+def _iter_char_chunks(text: str,
+                      size: int,
+                      overlap: int,
+                      snap: str) -> Iterator[Chunk]:
+    boundary = _boundary_pattern(snap)
+    idx = 0
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if boundary is not None and end < len(text):
+            cuts = [
+                m.end() for m in boundary.finditer(text, start, end)
+                if m.end() - start >= size * MIN_FILL
+            ]
+            if cuts:
+                end = cuts[-1]
+        yield Chunk(idx, start, end, text[start:end])
+        idx += 1
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+        if boundary is not None:
+            # Snapped chunks start on the next word, not on whitespace
+            while start < len(text) and text[start].isspace():
+                start += 1
+
+
+def _iter_span_chunks(text: str,
+                      pattern: re.Pattern,
+                      size: int,
+                      overlap: int,
+                      snap: str) -> Iterator[Chunk]:
+    boundary = _boundary_pattern(snap)
+    spans = ((m.start(), m.end()) for m in pattern.finditer(text))
+    # One unit of look-ahead so a boundary after the last unit of a full
+    # window can be seen
+    window: list[tuple[int, int]] = []
+    idx = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(window) <= size:
+            span = next(spans, None)
+            if span is None:
+                exhausted = True
+            else:
+                window.append(span)
+        if not window:
+            return
+
+        cut = min(size, len(window))
+        if boundary is not None and cut < len(window):
+            for k in range(cut, max(int(size * MIN_FILL), 1) - 1, -1):
+                gap_end = window[k][0] if k < len(window) else len(text)
+                # Sentence punctuation is its own unit in token mode, so
+                # look back over the last unit as well as the gap
+                if boundary.search(text, window[k - 1][0], gap_end):
+                    cut = k
+                    break
+
+        start, end = window[0][0], window[cut - 1][1]
+        yield Chunk(idx, start, end, text[start:end])
+        idx += 1
+        if exhausted and cut == len(window):
+            return
+        window = window[max(cut - overlap, 1):]
@@ -0,0 +1,202 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Iterable
+
+from .scan_index import Database
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Columns of `files` written through the codec, as are all values of
+# `content_cache`. `plain_rep` and chunk texts stay text: the full-text
+# indexes read them straight from their tables.
+COMPRESSED_STAGES: tuple[str, ...] = ("md_rep", "json_rep")
+# Codec ids are stored in every compressed value, so never renumber them
+CODEC_IDS: dict[str, int] = {"zlib": 1, "zstd": 2}
+# New values are written with this codec; stored values decode with
+# whichever codec they name
+DEFAULT_CODEC = os.environ.get(
+    "INGESTION_CODEC", "zlib" if zstandard is None else "zstd"
+)
+LEVEL = int(os.environ.get("INGESTION_CODEC_LEVEL", "3"))
+# Values shorter than this are stored as text; a frame and its header
+# would save little or nothing
+MIN_BYTES = 256
+# Trained dictionary size (zlib only ever looks at its last 32 KiB) and
+# the samples it is trained on
+DICT_BYTES = {"zlib": 32 * 1024, "zstd": 112 * 1024}
+TRAIN_SAMPLES = 2000
+# Codec id and dictionary id (0 for none) ahead of the frame
+_HEADER = struct.Struct("<BI")
+
+
+def _zlib_dict(samples: list[bytes], size: int) -> bytes:
+    """A zlib preset dictionary of sample slices.
+
+    zlib has no trainer; it matches against the dictionary as if it had
+    just been compressed, so slices of typical values (document openings
+    and common markup) are the next best thing. The ones most often seen
+    go last, nearest the data.
+    """
+    counts: dict[bytes, int] = {}
+    for sample in samples:
+        for pos in range(0, min(len(sample), 4096), 64):
+            piece = sample[pos:pos+64]
+            counts[piece] = counts.get(piece, 0) + 1
+    pieces = sorted(counts, key=counts.__getitem__)
+    out = bytearray()
+    for piece in reversed(pieces):
+        if len(out) + len(piece) > size:
+            break
+        out[:0] = piece
+    return bytes(out)
+
+
+class ValueCodec:
+    """Compresses large text values for one database, transparently.
+
+    `encode` turns text of at least `min_bytes` into a compressed BLOB
+    when that is smaller, and `decode` turns such a BLOB back into text;
+    anything else passes through untouched, so columns can hold a mix of
+    old text and new compressed values. Values are compressed with the
+    newest dictionary trained for the codec in `codec_dicts`, and every
+    value names its codec and dictionary, so older ones stay readable.
+    """
+
+    def __init__(self,
+                 db: Database,
+                 codec: str = DEFAULT_CODEC,
+                 level: int = LEVEL,
+                 min_bytes: int = MIN_BYTES) -> None:
+        assert codec in CODEC_IDS, \
+            f"Error: Unknown codec ({codec}), expected {list(CODEC_IDS)}"
+        assert codec != "zstd" or zstandard is not None, \
+            "Error: The zstd codec needs the zstandard package"
+        self.db = db
+        self.codec = codec
+        self.level = level
+        self.min_bytes = min_bytes
+        self.dict_id = 0
+        self._dicts: dict[int, tuple[str, bytes]] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def load(self) -> None:
+        """Read dictionaries trained since the last load."""
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                "SELECT id, codec, data FROM codec_dicts WHERE id > ?",
+                (max(self._dicts, default=0),)
+            ).fetchall()
+        with self._lock:
+            for dict_id, codec, data in rows:
+                self._dicts[dict_id] = (codec, data)
+                if codec == self.codec:
+                    self.dict_id = max(self.dict_id, dict_id)
+            self._loaded = True
+
+    def train(self, samples: Iterable[str]) -> int:
+        """Train and store a dictionary for new values; return its id."""
+        data = [sample.encode("utf-8") for sample in samples]
+        assert data, "Error: No samples to train a dictionary on"
+        size = DICT_BYTES[self.codec]
+        if self.codec == "zstd":
+            dictionary = zstandard.train_dictionary(size, data).as_bytes()
+        else:
+            dictionary = _zlib_dict(data, size)
+        with self.db.transaction() as conn:
+            dict_id = conn.execute(
+                """
+                INSERT INTO codec_dicts (codec, data, created_at)
+                VALUES (?, ?, ?)
+                """,
+                (self.codec, dictionary, time.time())
+            ).lastrowid
+        self.load()
+        logger.info(
+            f"Trained {self.codec} dictionary {dict_id} "
+            f"({len(dictionary)} bytes) on {len(data)} samples"
+        )
+        return dict_id
+
+    def _dictionary(self, dict_id: int) -> bytes:
+        if dict_id not in self._dicts:
+            # Trained by another process since we last looked
+            self.load()
+        assert dict_id in self._dicts, \
+            f"Error: No codec dictionary {dict_id} in this database"
+        return self._dicts[dict_id][1]
+
+    def _zstd(self, dict_id: int, compress: bool) -> Any:
+        # zstandard (de)compressors are not thread-safe; keep one per
+        # thread and dictionary, as building one digests the dictionary
+        cache = self._local.__dict__.setdefault("zstd", {})
+        key = (dict_id, compress)
+        if key not in cache:
+            kwargs = {}
+            if dict_id:
+                kwargs["dict_data"] = zstandard.ZstdCompressionDict(
+                    self._dictionary(dict_id)
+                )
+            cache[key] = zstandard.ZstdCompressor(level=self.level, **kwargs) \
+                if compress else zstandard.ZstdDecompressor(**kwargs)
+        return cache[key]
+
+    def encode(self, value: Any) -> Any:
+        if not isinstance(value, str) or len(value) < self.min_bytes:
+            return value
+        if not self._loaded:
+            self.load()
+        data = value.encode("utf-8")
+        dict_id = self.dict_id
+        if self.codec == "zstd":
+            frame = self._zstd(dict_id, True).compress(data)
+        else:
+            compressor = zlib.compressobj(
+                self.level, zdict=self._dictionary(dict_id)
+            ) if dict_id else zlib.compressobj(self.level)
+            frame = compressor.compress(data) + compressor.flush()
+        if _HEADER.size + len(frame) >= len(data):
+            return value
+        return _HEADER.pack(CODEC_IDS[self.codec], dict_id) + frame
+
+    def decode(self, value: Any) -> Any:
+        if not isinstance(value, bytes):
+            return value
+        codec_id, dict_id = _HEADER.unpack_from(value)
+        frame = memoryview(value)[_HEADER.size:]
+        if codec_id == CODEC_IDS["zstd"]:
+            assert zstandard is not None, \
+                "Error: Reading zstd values needs the zstandard package"
+            data = self._zstd(dict_id, False).decompress(frame)
+        else:
+            assert codec_id == CODEC_IDS["zlib"], \
+                f"Error: Unknown codec id {codec_id}"
+            decompressor = zlib.decompressobj(
+                zdict=self._dictionary(dict_id)
+            ) if dict_id else zlib.decompressobj()
+            data = decompressor.decompress(frame) + decompressor.flush()
+        return data.decode("utf-8")
+
+
+_CODECS: dict[tuple[int, str], ValueCodec] = {}
+_CODECS_LOCK = threading.Lock()
+
+def get_codec(db_path: str, db: Database, **kwargs) -> ValueCodec:
+    """This process's codec for `db_path`, made over `db` on first use."""
+    key = (os.getpid(), str(db_path))
+    with _CODECS_LOCK:
+        value_codec = _CODECS.get(key)
+        if value_codec is None:
+            value_codec = _CODECS[key] = ValueCodec(db, **kwargs)
+        return value_codec
+
@@ -0,0 +1,149 @@
+import os
+import shutil
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterable, Sequence
+from urllib.parse import quote
+
+import numpy as np
+import pyarrow as pa
+
+if TYPE_CHECKING:
+    import pyarrow.dataset as ds
+
+# Every stage table carries its partition in this column. On disk it is
+# the hive partition directory rather than a stored column.
+PARTITION_COLUMN = "bucket_key"
+_FILE_NAME = "part-0.arrow"
+
+
+# Column types of each stage's table, besides the partition column.
+# Vectors are fixed-size float32 lists whose size depends on the embedder.
+SCHEMAS: dict[str, dict[str, pa.DataType]] = {
+    "binary_files": {"file_path": pa.string(), "digest": pa.string()},
+    "markdown_files": {"md_rep": pa.large_string()},
+    "json_files": {"json_rep": pa.large_string()},
+    "plain_files": {"plain_rep": pa.large_string()},
+    "chunks": {
+        "idx": pa.int32(),
+        "start": pa.int64(),
+        "end": pa.int64(),
+        "text": pa.string(),
+    },
+    "vec_embeddings": {"idx": pa.int32()},
+    "relationships": {
+        "other_key": pa.string(),
+        "relationship": pa.string(),
+        "score": pa.float64(),
+    },
+}
+
+
+def table(stage: str, columns: dict[str, Any]) -> pa.Table:
+    """Build a stage's table from column name -> values.
+
+    Plain Python sequences are converted with the stage's column types, so
+    an empty table still has the right schema; Arrow arrays pass through.
+    """
+    types = {PARTITION_COLUMN: pa.string(), **SCHEMAS[stage]}
+    return pa.table({
+        name: values if isinstance(values, (pa.Array, pa.ChunkedArray))
+        else pa.array(values, type=types.get(name))
+        for name, values in columns.items()
+    })
+
+
+def vector_column(matrix: np.ndarray) -> pa.FixedSizeListArray:
+    """An `(n, dim)` float32 matrix as a list column, without copying."""
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    return pa.FixedSizeListArray.from_arrays(
+        pa.array(matrix.reshape(-1)), matrix.shape[1]
+    )
+
+
+def vectors(column: pa.ChunkedArray | pa.FixedSizeListArray) -> np.ndarray:
+    """The inverse of `vector_column`; zero-copy for a single chunk."""
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    dim = column.type.list_size
+    return column.flatten().to_numpy(zero_copy_only=False).reshape(-1, dim)
+
+
+def partition_dir(root: str | Path, stage: str, bucket_key: str) -> Path:
+    # Hive layout with URI-encoded values, which pyarrow decodes back
+    return Path(root, stage, f"{PARTITION_COLUMN}={quote(bucket_key, safe='')}")
+
+
+def write_partitions(root: str | Path,
+                     stage: str,
+                     tbl: pa.Table,
+                     bucket_keys: Iterable[str] = ()) -> None:
+    """Write one Arrow IPC file per partition of `tbl`.
+
+    Each partition is its own file, so a batched run adds or replaces only
+    its own partitions and never rewrites anyone else's. Files are written
+    uncompressed so readers can memory-map them without a decode step, and
+    swapped in atomically. Partitions in `bucket_keys` with no rows in
+    `tbl` get an empty file.
+    """
+    rows: dict[str, list[int]] = {bucket_key: [] for bucket_key in bucket_keys}
+    for pos, bucket_key in enumerate(tbl.column(PARTITION_COLUMN).to_pylist()):
+        rows.setdefault(bucket_key, []).append(pos)
+    data = tbl.drop_columns([PARTITION_COLUMN])
+    for bucket_key, positions in rows.items():
+        part = data.take(pa.array(positions, type=pa.int64()))
+        dest = partition_dir(root, stage, bucket_key) / _FILE_NAME
+        os.makedirs(dest.parent, exist_ok=True)
+        tmp = dest.with_name(f".{_FILE_NAME}.{os.getpid()}.tmp")
+        with pa.OSFile(str(tmp), "wb") as sink:
+            with pa.ipc.new_file(sink, part.schema) as writer:
+                writer.write_table(part)
+        os.replace(tmp, dest)
+
+
+def delete_partitions(root: str | Path,
+                      bucket_keys: Iterable[str],
+                      stages: Iterable[str] = SCHEMAS) -> int:
+    """Remove the partitions' files from every stage; return how many."""
+    removed = 0
+    for bucket_key in bucket_keys:
+        for stage in stages:
+            path = partition_dir(root, stage, bucket_key)
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+    return removed
+
+
+def read_partitions(root: str | Path,
+                    stage: str,
+                    bucket_keys: Sequence[str]) -> pa.Table:
+    """Memory-map the given partitions' files into one table.
+
+    Column buffers point straight into the mapped files; nothing is read
+    until a column is touched.
+    """
+    tables = []
+    for bucket_key in bucket_keys:
+        path = partition_dir(root, stage, bucket_key) / _FILE_NAME
+        # Left open: the table's buffers keep the mapping alive
+        part = pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+        tables.append(part.append_column(
+            PARTITION_COLUMN,
+            pa.array([bucket_key] * part.num_rows, type=pa.string())
+        ))
+    return pa.concat_tables(tables) if tables else pa.table({})
+
+
+def dataset(root: str | Path, stage: str) -> "ds.Dataset":
+    """Every partition of a stage as one lazily scanned dataset."""
+    # pyarrow.dataset pulls in pandas; only readers of whole stages pay
+    import pyarrow.dataset as ds
+    return ds.dataset(
+        str(Path(root, stage)),
+        format="arrow",
+        partitioning=ds.partitioning(
+            pa.schema([(PARTITION_COLUMN, pa.string())]),
+            flavor="hive"
+        ),
+        exclude_invalid_files=True,
+    )
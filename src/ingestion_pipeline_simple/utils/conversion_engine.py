@@ -0,0 +1,182 @@
+import atexit
+import multiprocessing as mp
+import os
+import queue
+import signal
+import threading
+import time
+from dataclasses import dataclass
+from multiprocessing.pool import Pool
+from pathlib import Path
+from typing import Iterator
+
+import logging
+logger = logging.getLogger(__name__)
+
+# One worker per core by default: PDF conversion is CPU bound
+CONVERSION_WORKERS = int(
+    os.environ.get("INGESTION_CONVERSION_WORKERS", os.cpu_count() or 1)
+)
+# Workers are replaced after this many documents to cap memory growth
+DOCS_PER_WORKER = 200
+# Per-file conversion timeout in seconds
+CONVERSION_TIMEOUT = 300.0
+# Extra wait on top of the timeout before a worker is presumed dead
+_DEAD_WORKER_GRACE = 30.0
+
+
+@dataclass
+class ConversionResult:
+    key: str
+    markdown: str | None = None
+    error: str | None = None
+    seconds: float = 0.0
+    pid: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class _Timeout(Exception):
+    pass
+
+
+def _on_alarm(signum, frame):
+    raise _Timeout()
+
+
+def _init_worker() -> None:
+    from . import converters
+    # Pay MarkItDown's start-up cost once per worker, not per document
+    converters.markitdown()
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _on_alarm)
+
+
+def _convert(key: str, file_path: str, timeout: float) -> ConversionResult:
+    from . import converters
+    start = time.perf_counter()
+    file_type = file_path.split(".")[-1]
+    # SIGALRM is POSIX only; elsewhere only the dead-worker guard applies
+    use_alarm = hasattr(signal, "setitimer") and timeout > 0
+    try:
+        if file_type not in converters.REGISTRY:
+            raise ValueError(
+                f"Unexpected file type ({file_type}). "
+                f"Accepted file types: {list(converters.REGISTRY.keys())}."
+            )
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            res = converters.REGISTRY[file_type](Path(file_path))
+        finally:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        return ConversionResult(
+            key=key,
+            markdown=res.markdown,
+            seconds=time.perf_counter() - start,
+            pid=os.getpid(),
+        )
+    except _Timeout:
+        error = f"Timed out after {timeout}s"
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+    return ConversionResult(
+        key=key,
+        error=error,
+        seconds=time.perf_counter() - start,
+        pid=os.getpid(),
+    )
+
+
+class ConversionEngine:
+    """A long-lived pool of conversion worker processes.
+
+    Each worker holds a warm MarkItDown instance and dispatches through
+    `converters.REGISTRY`. Workers are spawned rather than forked so they
+    never inherit the parent's Dagster or SQLite state.
+    """
+
+    def __init__(self,
+                 workers: int = CONVERSION_WORKERS,
+                 docs_per_worker: int = DOCS_PER_WORKER,
+                 timeout: float = CONVERSION_TIMEOUT) -> None:
+        self.workers = workers
+        self.docs_per_worker = docs_per_worker
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pool: Pool | None = None
+
+    def _get_pool(self) -> Pool:
+        with self._lock:
+            if self._pool is None:
+                self._pool = mp.get_context("spawn").Pool(
+                    processes=self.workers,
+                    initializer=_init_worker,
+                    maxtasksperchild=self.docs_per_worker,
+                )
+            return self._pool
+
+    def _restart(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def convert_many(
+        self,
+        file_paths: dict[str, str | Path],
+        timeout: float | None = None,
+    ) -> Iterator[ConversionResult]:
+        """Convert every file, yielding results in completion order."""
+        timeout = self.timeout if timeout is None else timeout
+        if not file_paths:
+            return
+        pool = self._get_pool()
+        done: queue.Queue[ConversionResult] = queue.Queue()
+        for key, file_path in file_paths.items():
+            pool.apply_async(
+                _convert,
+                (key, str(file_path), timeout),
+                callback=done.put,
+            )
+
+        pending = set(file_paths)
+        # A worker killed mid-task (OOM, segfault) never reports back, so
+        # stop waiting once nothing has finished for a full timeout
+        wait = timeout + _DEAD_WORKER_GRACE if timeout > 0 else None
+        while pending:
+            try:
+                res = done.get(timeout=wait)
+            except queue.Empty:
+                logger.warning(
+                    f"No conversion finished in {wait}s; "
+                    f"restarting workers and failing {len(pending)} files"
+                )
+                self._restart()
+                for key in sorted(pending):
+                    yield ConversionResult(key=key, error="Worker lost")
+                return
+            pending.discard(res.key)
+            yield res
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+_ENGINES: dict[int, ConversionEngine] = {}
+
+def get_engine() -> ConversionEngine:
+    """Return this process's shared engine, starting it on first use."""
+    engine = _ENGINES.get(os.getpid())
+    if engine is None:
+        engine = _ENGINES[os.getpid()] = ConversionEngine()
+        atexit.register(engine.close)
+    return engine
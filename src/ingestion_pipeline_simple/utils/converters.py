@@ -0,0 +1,96 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, TextIO
+
+if TYPE_CHECKING:
+    from markitdown import MarkItDown, DocumentConverterResult
+
+# Kept free of Dagster imports: conversion worker processes import this
+# module (and only this module) to get at the registry. MarkItDown and
+# pdfminer load all their converters on import, so they are only imported
+# by the first conversion, never by the code location or sensors.
+REGISTRY: dict[str, Callable[[str | Path], "DocumentConverterResult"]] = {}
+
+# Converters that write markdown to a text stream as they go, for files
+# too large to hold in memory at once
+STREAMING_REGISTRY: dict[str, Callable[[str | Path, TextIO], int]] = {}
+
+def register(file_type: str):
+    def inner(fn: Callable):
+        REGISTRY[file_type] = fn
+        return fn
+    return inner
+
+
+def register_streaming(file_type: str):
+    def inner(fn: Callable):
+        STREAMING_REGISTRY[file_type] = fn
+        return fn
+    return inner
+
+
+@lru_cache(maxsize=1)
+def markitdown() -> "MarkItDown":
+    """The process's MarkItDown instance, built once and kept warm."""
+    from markitdown import MarkItDown
+    return MarkItDown(enable_plugins=False)
+
+
+@register("bin")
+def convert_dummy(filepath: str | Path) -> "DocumentConverterResult":
+    assert os.path.isfile(filepath)
+    assert str(filepath).endswith("bin")
+    res = markitdown().convert(filepath)
+    # Extra steps go before/after conversion
+    return res
+
+
+@register("docx")
+def convert_docx(filepath: str | Path) -> "DocumentConverterResult":
+    assert os.path.isfile(filepath)
+    assert str(filepath).endswith("docx")
+    res = markitdown().convert(filepath)
+    # Extra steps go before/after conversion
+    return res
+
+
+@register("pdf")
+def convert_pdf(filepath: str | Path) -> "DocumentConverterResult":
+    assert os.path.isfile(filepath)
+    assert str(filepath).endswith("pdf")
+    res = markitdown().convert(filepath)
+    # Extra steps go before/after conversion
+    return res
+
+
+@register_streaming("pdf")
+def stream_pdf(filepath: str | Path, out: TextIO) -> int:
+    """Write a PDF's text to `out` one page at a time; return the page count.
+
+    MarkItDown reads the whole file into memory and keeps every page's
+    layout until the end. Here the file is read lazily, parsed objects are
+    not cached and each page's text is written out as soon as it is laid
+    out, so the parser's memory stays at about one page whatever the
+    document's size. The text written to `out` is not bounded by this.
+    The text is what pdfminer gives for the whole file, which is also what
+    MarkItDown returns for PDFs without forms or tables.
+    """
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+    assert os.path.isfile(filepath)
+    assert str(filepath).endswith("pdf")
+    rsrcmgr = PDFResourceManager(caching=False)
+    device = TextConverter(rsrcmgr, out, laparams=LAParams())
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+    pages = 0
+    with open(filepath, "rb") as fp:
+        try:
+            for page in PDFPage.get_pages(fp, caching=False):
+                interpreter.process_page(page)
+                pages += 1
+        finally:
+            device.close()
+    return pages
@@ -1,42 +1,996 @@
 import sqlite3
 import os
+import queue
+import re
+import sys
+import threading
+from array import array
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Callable, Iterator, NamedTuple, Sequence
 import argparse
 
 DIR_PATH = Path(os.getcwd())
 
+# Applied to every pooled connection. WAL lets readers run alongside the
+# single writer, and synchronous=NORMAL only fsyncs at checkpoints, which
+# is safe in WAL mode (a crash can lose the last commits, never corrupt).
+DEFAULT_PRAGMAS: dict[str, str | int] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 30_000,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "cache_size": -64_000,
+}
+
+# Tokenizer of the full-text indexes: case-folded, accents stripped
+FTS_TOKENIZE = "unicode61 remove_diacritics 2"
+# Work done by one `compact` call: free pages returned to the filesystem
+# and pages written merging each full-text index's segments
+COMPACT_PAGES = 4096
+FTS_MERGE_PAGES = 500
+
+
+def connect(db_path: str | Path,
+            pragmas: dict[str, str | int] | None = None,
+            cached_statements: int = 256) -> sqlite3.Connection:
+    """Open a tuned connection in autocommit mode.
+
+    Transactions are opened explicitly (see ``ConnectionPool.transaction``)
+    so writers can take the lock up front with ``BEGIN IMMEDIATE``.
+    """
+    new = not os.path.exists(db_path) or os.path.getsize(db_path) == 0
+    conn = sqlite3.connect(
+        db_path,
+        timeout=30,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=cached_statements,
+    )
+    if new:
+        # Lets `compact` return free pages a few at a time. It only takes
+        # on an empty database ahead of WAL, and setting it on one already
+        # incremental would wait for the write lock
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    for name, value in (pragmas or DEFAULT_PRAGMAS).items():
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+
+class ConnectionPool:
+    """A bounded pool of connections to one database file.
+
+    Connections are created lazily up to ``size`` and handed out LIFO so
+    the warmest connection (page cache, statement cache) is reused first.
+    """
+
+    def __init__(self,
+                 db_path: str | Path,
+                 size: int = 4,
+                 pragmas: dict[str, str | int] | None = None,
+                 cached_statements: int = 256) -> None:
+        self.db_path = str(db_path)
+        self.size = size
+        self.pragmas = pragmas
+        self.cached_statements = cached_statements
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.schema_ready = False
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return connect(self.db_path,
+                               self.pragmas,
+                               self.cached_statements)
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Hold the write lock for the block and commit at its end.
+
+        Nested calls on the same thread join the outer transaction, so a
+        group of writes can be made atomic by wrapping them in one.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.conn = conn
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._local.conn = None
+            conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._created = 0
+
+
+_POOLS: dict[tuple[int, str], ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+def get_pool(db_path: str | Path, **kwargs) -> ConnectionPool:
+    """Return this process's pool for ``db_path``, creating it on first use.
+
+    Pools are keyed on the pid as well, so a forked run worker never
+    inherits its parent's open connections.
+    """
+    key = (os.getpid(), str(db_path))
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = ConnectionPool(db_path, **kwargs)
+        return pool
+
+
+def _add_missing_columns(cur: sqlite3.Cursor,
+                         tbl_name: str,
+                         columns: dict[str, str]) -> None:
+    existing = {row[1] for row in cur.execute(f"PRAGMA table_info({tbl_name})")}
+    for name, decl in columns.items():
+        if name not in existing:
+            cur.execute(f"ALTER TABLE {tbl_name} ADD COLUMN {name} {decl}")
+
+
+def _create_base_schema(cur: sqlite3.Cursor) -> None:
+    """Version 1: every table up to the normalized chunk/embedding split.
+
+    Written with IF NOT EXISTS throughout, so it also adopts databases
+    made by `init_db` before schema versions were tracked.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS files (
+        bucket_key      VARCHAR(200) PRIMARY KEY NOT NULL,
+        file_path       VARCHAR(1000),
+        md_rep          TEXT,
+        json_rep        JSONB,
+        plain_rep       TEXT,
+        chunks          JSONB,
+        vec_embeddings  JSONB
+    )
+    """
+    cur.execute(query)
+    # Columns added after the first release of the table
+    _add_missing_columns(cur, "files", {
+        "digest": "VARCHAR(64)",
+    })
+    query = """
+    CREATE INDEX IF NOT EXISTS files_digest_idx ON files (digest)
+    """
+    cur.execute(query)
+
+    query = """
+    CREATE TABLE IF NOT EXISTS relationships (
+        doc_a_key       VARCHAR(200) NOT NULL,
+        doc_b_key       VARCHAR(200) NOT NULL,
+        relationship    TEXT CHECK(
+                            relationship IN ('A','B','C')
+                        ) NOT NULL DEFAULT 'A',
+        PRIMARY KEY (doc_a_key, doc_b_key),
+        FOREIGN KEY (doc_a_key) references files (doc_a_key),
+        FOREIGN KEY (doc_b_key) references files (doc_b_key)
+    )
+    """
+    cur.execute(query)
+
+    # Stage outputs keyed by the source file's content digest, shared by
+    # every bucket key holding the same bytes
+    query = """
+    CREATE TABLE IF NOT EXISTS content_cache (
+        digest          VARCHAR(64) NOT NULL,
+        stage           VARCHAR(50) NOT NULL,
+        value           TEXT,
+        PRIMARY KEY (digest, stage)
+    ) WITHOUT ROWID
+    """
+    cur.execute(query)
+
+    # One row per chunk; start/end are offsets into the document's plain_rep
+    query = """
+    CREATE TABLE IF NOT EXISTS chunks (
+        doc_key         VARCHAR(200) NOT NULL,
+        idx             INTEGER NOT NULL,
+        start           INTEGER NOT NULL,
+        end             INTEGER NOT NULL,
+        text            TEXT NOT NULL,
+        PRIMARY KEY (doc_key, idx)
+    )
+    """
+    cur.execute(query)
+
+    # Bucket scan index used by the file_monitor sensor
+    query = """
+    CREATE TABLE IF NOT EXISTS scan_files (
+        path            VARCHAR(1000) PRIMARY KEY NOT NULL,
+        dir             VARCHAR(1000) NOT NULL,
+        size            INTEGER NOT NULL,
+        mtime_ns        INTEGER NOT NULL,
+        inode           INTEGER NOT NULL,
+        digest          VARCHAR(64)
+    )
+    """
+    cur.execute(query)
+    query = """
+    CREATE INDEX IF NOT EXISTS scan_files_dir_idx ON scan_files (dir)
+    """
+    cur.execute(query)
+    query = """
+    CREATE TABLE IF NOT EXISTS scan_dirs (
+        path            VARCHAR(1000) PRIMARY KEY NOT NULL,
+        parent          VARCHAR(1000) NOT NULL,
+        mtime_ns        INTEGER NOT NULL
+    )
+    """
+    cur.execute(query)
+    query = """
+    CREATE TABLE IF NOT EXISTS s3_objects (
+        bucket          VARCHAR(200) NOT NULL,
+        key             VARCHAR(1000) NOT NULL,
+        etag            VARCHAR(100) NOT NULL,
+        size            INTEGER NOT NULL,
+        generation      INTEGER NOT NULL,
+        PRIMARY KEY (bucket, key)
+    )
+    """
+    cur.execute(query)
+
+
+def _create_embeddings(cur: sqlite3.Cursor) -> None:
+    """Version 2: one packed little-endian float32 vector per chunk."""
+    query = """
+    CREATE TABLE IF NOT EXISTS embeddings (
+        doc_key         VARCHAR(200) NOT NULL,
+        idx             INTEGER NOT NULL,
+        dim             INTEGER NOT NULL,
+        vector          BLOB NOT NULL,
+        PRIMARY KEY (doc_key, idx)
+    )
+    """
+    cur.execute(query)
+
+
+def _migrate_legacy_blobs(cur: sqlite3.Cursor) -> None:
+    """Version 3: move JSON chunk blobs in `files` into the chunks table.
+
+    Legacy `files.chunks` values are `{idx: text}` objects of contiguous
+    128-character slices; they become chunk rows plus the manifest the
+    chunks asset now writes. Legacy `vec_embeddings` held one random
+    number per character of that JSON, not per chunk, so there is nothing
+    worth keeping: they are cleared and the stage simply runs again.
+    """
+    import json
+    from . import hashing
+    rows = cur.execute(
+        "SELECT bucket_key, chunks FROM files WHERE chunks IS NOT NULL"
+    ).fetchall()
+    for bucket_key, blob in rows:
+        try:
+            legacy = json.loads(blob)
+        except ValueError:
+            continue
+        if not isinstance(legacy, dict) or "count" in legacy:
+            continue
+        texts = [legacy[idx] for idx in sorted(legacy, key=int)]
+        chunk_rows = []
+        start = 0
+        for idx, text in enumerate(texts):
+            chunk_rows.append((bucket_key, idx, start, start + len(text), text))
+            start += len(text)
+        cur.execute("DELETE FROM chunks WHERE doc_key=?", (bucket_key,))
+        cur.executemany(
+            """
+            INSERT INTO chunks (doc_key, idx, start, end, text)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            chunk_rows
+        )
+        manifest = {
+            "size": max((len(text) for text in texts), default=128),
+            "overlap": 0,
+            "unit": "chars",
+            "snap": "none",
+            "count": len(texts),
+            "digest": hashing.iter_digest(texts),
+        }
+        cur.execute(
+            """
+            UPDATE files SET chunks=?, vec_embeddings=NULL
+            WHERE bucket_key=?
+            """,
+            (json.dumps(manifest), bucket_key)
+        )
+
+
+def _create_ann_index(cur: sqlite3.Cursor) -> None:
+    """Version 4: inverted lists of the on-disk ANN indexes.
+
+    Vectors live in memory-mapped files next to the database (see
+    `ann_index`); these tables map file rows to chunks and to IVF lists,
+    and hold each index's centroids. Relationships gain a score.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS ann_meta (
+        name            TEXT PRIMARY KEY,
+        dim             INTEGER NOT NULL,
+        generation      INTEGER NOT NULL DEFAULT 0,
+        nlist           INTEGER NOT NULL DEFAULT 0,
+        trained_on      INTEGER NOT NULL DEFAULT 0,
+        centroids       BLOB
+    )
+    """
+    cur.execute(query)
+    query = """
+    CREATE TABLE IF NOT EXISTS ann_items (
+        name            TEXT NOT NULL,
+        row             INTEGER NOT NULL,
+        doc_key         VARCHAR(200) NOT NULL,
+        idx             INTEGER NOT NULL,
+        list_no         INTEGER NOT NULL,
+        PRIMARY KEY (name, row)
+    ) WITHOUT ROWID
+    """
+    cur.execute(query)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS ann_items_list_idx ON ann_items (name, list_no)
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS ann_items_doc_idx ON ann_items (name, doc_key)
+    """)
+    _add_missing_columns(cur, "relationships", {"score": "REAL"})
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS relationships_b_idx ON relationships (doc_b_key)
+    """)
+
+
+def _create_offset_maps(cur: sqlite3.Cursor) -> None:
+    """Version 5: plain text to markdown offset maps.
+
+    Maps are keyed like `content_cache`, by source digest (or bucket key
+    for rows without one), and stored packed (see `markdown_plain`).
+    Chunks gain the markdown span they were cut from.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS offset_maps (
+        content_id      VARCHAR(200) PRIMARY KEY NOT NULL,
+        offsets         BLOB NOT NULL
+    ) WITHOUT ROWID
+    """
+    cur.execute(query)
+    _add_missing_columns(cur, "chunks", {
+        "md_start": "INTEGER",
+        "md_end": "INTEGER",
+    })
+
+
+def _create_backlog(cur: sqlite3.Cursor) -> None:
+    """Version 6: the sensor's admission backlog and per-stage run stats.
+
+    `ingest_backlog` holds detected files until the sensor admits them;
+    `admitted_seq` is the sensor tick that admitted a row, settled against
+    the sensor cursor on the next tick. `stage_stats` keeps one row per
+    asset execution, which admission uses to size runs.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS ingest_backlog (
+        bucket_key      VARCHAR(200) PRIMARY KEY NOT NULL,
+        file_path       VARCHAR(1000) NOT NULL,
+        version         VARCHAR(100),
+        size            INTEGER NOT NULL DEFAULT 0,
+        enqueued_at     REAL NOT NULL,
+        admitted_seq    INTEGER
+    )
+    """
+    cur.execute(query)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS ingest_backlog_admitted_idx
+    ON ingest_backlog (admitted_seq)
+    """)
+    query = """
+    CREATE TABLE IF NOT EXISTS stage_stats (
+        id              INTEGER PRIMARY KEY,
+        stage           VARCHAR(50) NOT NULL,
+        finished_at     REAL NOT NULL,
+        partitions      INTEGER NOT NULL,
+        wall_s          REAL NOT NULL,
+        cpu_s           REAL NOT NULL,
+        db_s            REAL NOT NULL,
+        bytes_in        INTEGER NOT NULL,
+        bytes_out       INTEGER NOT NULL
+    )
+    """
+    cur.execute(query)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS stage_stats_finished_idx
+    ON stage_stats (finished_at)
+    """)
+
+
+def _create_stage_versions(cur: sqlite3.Cursor) -> None:
+    """Version 7: what each partition was last materialized from.
+
+    `stage_versions` holds, per stage and partition, the version of the
+    inputs it was last computed from and the data version that produced,
+    so a stage can skip partitions whose inputs have not changed.
+    `stage_epochs` counts changes to a stage's outputs across all
+    partitions, for stages that read every partition's output.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS stage_versions (
+        stage           VARCHAR(50) NOT NULL,
+        bucket_key      VARCHAR(200) NOT NULL,
+        input_version   VARCHAR(100) NOT NULL,
+        output_version  VARCHAR(100) NOT NULL,
+        PRIMARY KEY (stage, bucket_key)
+    ) WITHOUT ROWID
+    """
+    cur.execute(query)
+    query = """
+    CREATE TABLE IF NOT EXISTS stage_epochs (
+        stage           VARCHAR(50) PRIMARY KEY NOT NULL,
+        epoch           INTEGER NOT NULL DEFAULT 0
+    )
+    """
+    cur.execute(query)
+
+
+def _create_backfills(cur: sqlite3.Cursor) -> None:
+    """Version 8: checkpoints of backfills run with `utils.backfill`.
+
+    A backfill's partitions are listed up front in `backfill_keys`, and
+    each is marked done (or failed) as its batch finishes, so a stopped
+    backfill resumes with whatever is left.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS backfills (
+        name            VARCHAR(100) PRIMARY KEY NOT NULL,
+        params          TEXT NOT NULL,
+        created_at      REAL NOT NULL,
+        finished_at     REAL
+    )
+    """
+    cur.execute(query)
+    query = """
+    CREATE TABLE IF NOT EXISTS backfill_keys (
+        name            VARCHAR(100) NOT NULL,
+        pos             INTEGER NOT NULL,
+        bucket_key      VARCHAR(200) NOT NULL,
+        file_path       VARCHAR(1000),
+        status          TEXT CHECK(
+                            status IN ('pending', 'done', 'failed')
+                        ) NOT NULL DEFAULT 'pending',
+        PRIMARY KEY (name, bucket_key)
+    ) WITHOUT ROWID
+    """
+    cur.execute(query)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS backfill_keys_pos_idx
+    ON backfill_keys (name, pos)
+    """)
+
+
+def _create_fts(cur: sqlite3.Cursor) -> None:
+    """Version 9: FTS5 keyword indexes over chunks and plain text.
+
+    Both are external-content tables reading their text from `chunks` and
+    `files.plain_rep` by rowid, so nothing is stored twice; triggers keep
+    them in step with every write. Rows present before the migration are
+    indexed by a rebuild. The rowids are implicit, which VACUUM may
+    renumber, so run `rebuild_fts` after one.
+    """
+    cur.execute(f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+        doc_key UNINDEXED,
+        text,
+        content='chunks',
+        content_rowid='rowid',
+        tokenize='{FTS_TOKENIZE}'
+    )
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chunks_fts_insert AFTER INSERT ON chunks
+    BEGIN
+        INSERT INTO chunks_fts (rowid, doc_key, text)
+        VALUES (new.rowid, new.doc_key, new.text);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chunks_fts_delete AFTER DELETE ON chunks
+    BEGIN
+        INSERT INTO chunks_fts (chunks_fts, rowid, doc_key, text)
+        VALUES ('delete', old.rowid, old.doc_key, old.text);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chunks_fts_update
+    AFTER UPDATE OF doc_key, text ON chunks
+    BEGIN
+        INSERT INTO chunks_fts (chunks_fts, rowid, doc_key, text)
+        VALUES ('delete', old.rowid, old.doc_key, old.text);
+        INSERT INTO chunks_fts (rowid, doc_key, text)
+        VALUES (new.rowid, new.doc_key, new.text);
+    END
+    """)
+
+    # Most files rows have no plain text yet when inserted, and every
+    # other stage's upsert leaves it alone, so only index actual text
+    cur.execute(f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS plain_fts USING fts5(
+        bucket_key UNINDEXED,
+        plain_rep,
+        content='files',
+        content_rowid='rowid',
+        tokenize='{FTS_TOKENIZE}'
+    )
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS plain_fts_insert AFTER INSERT ON files
+    WHEN new.plain_rep IS NOT NULL
+    BEGIN
+        INSERT INTO plain_fts (rowid, bucket_key, plain_rep)
+        VALUES (new.rowid, new.bucket_key, new.plain_rep);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS plain_fts_delete AFTER DELETE ON files
+    WHEN old.plain_rep IS NOT NULL
+    BEGIN
+        INSERT INTO plain_fts (plain_fts, rowid, bucket_key, plain_rep)
+        VALUES ('delete', old.rowid, old.bucket_key, old.plain_rep);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS plain_fts_update
+    AFTER UPDATE OF bucket_key, plain_rep ON files
+    BEGIN
+        INSERT INTO plain_fts (plain_fts, rowid, bucket_key, plain_rep)
+        SELECT 'delete', old.rowid, old.bucket_key, old.plain_rep
+        WHERE old.plain_rep IS NOT NULL;
+        INSERT INTO plain_fts (rowid, bucket_key, plain_rep)
+        SELECT new.rowid, new.bucket_key, new.plain_rep
+        WHERE new.plain_rep IS NOT NULL;
+    END
+    """)
+    rebuild_fts(cur)
+
+
+def _create_stage_changes(cur: sqlite3.Cursor) -> None:
+    """Version 10: a feed of partitions whose stage outputs changed.
+
+    `put_stage_versions` appends a row whenever a partition's output
+    version changes, so readers in other processes (the query service's
+    cache) can follow what was re-materialized by polling past the last
+    `seq` they saw. Rows older than a day are pruned as new ones come.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS stage_changes (
+        seq             INTEGER PRIMARY KEY AUTOINCREMENT,
+        stage           VARCHAR(50) NOT NULL,
+        bucket_key      VARCHAR(200) NOT NULL,
+        changed_at      REAL NOT NULL
+    )
+    """
+    cur.execute(query)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS stage_changes_changed_idx
+    ON stage_changes (changed_at)
+    """)
+
+
+def _create_codec_dicts(cur: sqlite3.Cursor) -> None:
+    """Version 11: compression dictionaries of the value codec.
+
+    Large text columns (see `resources.COMPRESSED_STAGES`) and cached
+    stage outputs are now written compressed (see `codec`), naming the
+    dictionary they were compressed with. Existing rows stay readable as
+    they are; `compress_db` rewrites them.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS codec_dicts (
+        id              INTEGER PRIMARY KEY,
+        codec           VARCHAR(20) NOT NULL,
+        data            BLOB NOT NULL,
+        created_at      REAL NOT NULL
+    )
+    """
+    cur.execute(query)
+
+
+def _create_tombstones(cur: sqlite3.Cursor) -> None:
+    """Version 12: files deleted from the bucket.
+
+    Detection records a tombstone per deleted key; the key's rows are
+    then purged from every stage's tables (`purged_at`) and its dynamic
+    partition deleted. Tombstones are kept a while after the purge, so
+    rows written back by a run that was in flight can be purged again.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS tombstones (
+        bucket_key      VARCHAR(200) PRIMARY KEY NOT NULL,
+        deleted_at      REAL NOT NULL,
+        purged_at       REAL
+    )
+    """
+    cur.execute(query)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS tombstones_purged_idx
+    ON tombstones (purged_at)
+    """)
+
+
+# Schema migrations in order; PRAGMA user_version records how many of
+# them a database has had applied. Only ever append to this list.
+MIGRATIONS: list[Callable[[sqlite3.Cursor], None]] = [
+    _create_base_schema,
+    _create_embeddings,
+    _migrate_legacy_blobs,
+    _create_ann_index,
+    _create_offset_maps,
+    _create_backlog,
+    _create_stage_versions,
+    _create_backfills,
+    _create_fts,
+    _create_stage_changes,
+    _create_codec_dicts,
+    _create_tombstones,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def ensure_schema(conn: sqlite3.Connection) -> tuple[int, int]:
+    """Apply any pending migrations, returning (old, new) versions.
+
+    Run it inside a transaction: user_version is transactional, so a
+    failed migration leaves the database at its previous version.
+    """
+    cur = conn.cursor()
+    version: int = cur.execute("PRAGMA user_version").fetchone()[0]
+    for number in range(version, SCHEMA_VERSION):
+        MIGRATIONS[number](cur)
+        cur.execute(f"PRAGMA user_version={number + 1}")
+    cur.close()
+    return version, max(version, SCHEMA_VERSION)
+
+
+def pack_vector(values: Sequence[float]) -> bytes:
+    """Pack floats as little-endian float32, the `embeddings` format."""
+    vec = array("f", values)
+    if sys.byteorder == "big":
+        vec.byteswap()
+    return vec.tobytes()
+
+
+def unpack_vector(blob: bytes) -> array:
+    vec = array("f")
+    vec.frombytes(blob)
+    if sys.byteorder == "big":
+        vec.byteswap()
+    return vec
+
+
+class SearchHit(NamedTuple):
+    """A chunk matching a keyword search, best first.
+
+    `start`/`end` are offsets into the document's plain text and
+    `md_start`/`md_end` into its markdown, when known. `score` is the
+    negated BM25 rank, so higher is better.
+    """
+    doc_key: str
+    idx: int
+    start: int
+    end: int
+    md_start: int | None
+    md_end: int | None
+    score: float
+    snippet: str
+
+
+class DocHit(NamedTuple):
+    """A document whose plain text matches a keyword search."""
+    bucket_key: str
+    score: float
+    snippet: str
+
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query matching all of its words.
+
+    Each word is quoted, so operators in user input are searched for
+    rather than parsed; punctuation is dropped, as the tokenizer would.
+    """
+    return " ".join(f'"{word}"' for word in re.findall(r"\w+", text))
+
+
+def rebuild_fts(conn: sqlite3.Connection | sqlite3.Cursor) -> None:
+    """Reindex `chunks_fts` and `plain_fts` from their content tables."""
+    conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO plain_fts (plain_fts) VALUES ('rebuild')")
+
+
+def optimize_fts(conn: sqlite3.Connection) -> None:
+    """Merge each full-text index into one b-tree for faster queries."""
+    conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('optimize')")
+    conn.execute("INSERT INTO plain_fts (plain_fts) VALUES ('optimize')")
+
+
+def _fts_prefix(column: str, prefix: str) -> tuple[str, tuple]:
+    # Unindexed columns are read from the content table for every match,
+    # so only filter on them when asked to
+    if not prefix:
+        return "", ()
+    return f" AND substr({column}, 1, ?) = ?", (len(prefix), prefix)
+
+
+def search_chunks(conn: sqlite3.Connection,
+                  query: str,
+                  limit: int = 10,
+                  prefix: str = "",
+                  raw: bool = False,
+                  snippet_tokens: int = 12) -> list[SearchHit]:
+    """The `limit` chunks best matching `query` by BM25.
+
+    `query` is free text, every word of which must match, unless `raw`
+    is set, in which case it is passed to FTS5 as is (phrases, `OR`,
+    `NEAR`, prefix `term*`). Only documents under key `prefix` are
+    searched. The ranking runs inside the index and only the top hits
+    are joined back to `chunks`.
+    """
+    match = query if raw else fts_query(query)
+    if not match:
+        return []
+    where, params = _fts_prefix("doc_key", prefix)
+    rows = conn.execute(
+        f"""
+        SELECT c.doc_key, c.idx, c.start, c.end, c.md_start, c.md_end,
+               -f.rank, f.snip
+        FROM (
+            SELECT rowid, rank,
+                   snippet(chunks_fts, 1, '[', ']', '...', ?) AS snip
+            FROM chunks_fts
+            WHERE chunks_fts MATCH ?{where}
+            ORDER BY rank LIMIT ?
+        ) AS f
+        JOIN chunks AS c ON c.rowid = f.rowid
+        ORDER BY f.rank
+        """,
+        (snippet_tokens, match, *params, limit)
+    ).fetchall()
+    return [SearchHit(*row) for row in rows]
+
+
+def search_docs(conn: sqlite3.Connection,
+                query: str,
+                limit: int = 10,
+                prefix: str = "",
+                raw: bool = False,
+                snippet_tokens: int = 12) -> list[DocHit]:
+    """The `limit` documents whose plain text best matches `query`.
+
+    Takes the same arguments as `search_chunks`.
+    """
+    match = query if raw else fts_query(query)
+    if not match:
+        return []
+    where, params = _fts_prefix("bucket_key", prefix)
+    rows = conn.execute(
+        f"""
+        SELECT bucket_key, -rank,
+               snippet(plain_fts, 1, '[', ']', '...', ?)
+        FROM plain_fts
+        WHERE plain_fts MATCH ?{where}
+        ORDER BY rank LIMIT ?
+        """,
+        (snippet_tokens, match, *params, limit)
+    ).fetchall()
+    return [DocHit(*row) for row in rows]
+
+
+def _stored_size(value: object) -> int:
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return len(value) if isinstance(value, bytes) else 0
+
+
+def compress_db(db_path: str | Path,
+                train: bool = True,
+                batch_size: int = 500) -> dict[str, int]:
+    """Rewrite stored values with the value codec, in batches.
+
+    New writes are compressed already; this converts what was written
+    before, and with `train` first trains a dictionary on a sample of
+    the compressed columns, so later writes use it too. Each batch is its
+    own transaction, so ingestion can go on meanwhile. Returns the rows
+    rewritten and the stored bytes before and after. Pages freed are only
+    returned to the filesystem by `vacuum`.
+    """
+    from . import codec
+    pool = get_pool(db_path)
+    with pool.transaction() as conn:
+        ensure_schema(conn)
+    value_codec = codec.get_codec(str(db_path), pool)
+    value_codec.load()
+    columns = codec.COMPRESSED_STAGES
+    if train:
+        with pool.connection() as conn:
+            samples = [
+                value_codec.decode(value)
+                for column in columns
+                for (value,) in conn.execute(
+                    f"""
+                    SELECT {column} FROM files WHERE rowid IN (
+                        SELECT rowid FROM files WHERE {column} IS NOT NULL
+                        ORDER BY random() LIMIT ?
+                    )
+                    """,
+                    (codec.TRAIN_SAMPLES // len(columns),)
+                )
+            ]
+        if samples:
+            value_codec.train(samples)
+
+    stats = {"rows": 0, "bytes_before": 0, "bytes_after": 0}
+
+    def rewrite(values: Sequence[object]) -> list[object]:
+        new = [value_codec.encode(value_codec.decode(value))
+               for value in values]
+        stats["bytes_before"] += sum(map(_stored_size, values))
+        stats["bytes_after"] += sum(map(_stored_size, new))
+        return new
+
+    last_rowid = 0
+    while True:
+        with pool.transaction() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT rowid, {', '.join(columns)} FROM files
+                WHERE rowid > ? ORDER BY rowid LIMIT ?
+                """,
+                (last_rowid, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for rowid, *values in rows:
+                new = rewrite(values)
+                if new != values:
+                    updates.append((*new, rowid))
+            conn.executemany(
+                f"""
+                UPDATE files SET {', '.join(f'{c}=?' for c in columns)}
+                WHERE rowid=?
+                """,
+                updates
+            )
+            stats["rows"] += len(updates)
+            last_rowid = rows[-1][0]
+
+    last_key: tuple[str, str] = ("", "")
+    while True:
+        with pool.transaction() as conn:
+            rows = conn.execute(
+                """
+                SELECT digest, stage, value FROM content_cache
+                WHERE (digest, stage) > (?, ?)
+                ORDER BY digest, stage LIMIT ?
+                """,
+                (*last_key, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for digest, stage, value in rows:
+                [new] = rewrite([value])
+                if new != value:
+                    updates.append((new, digest, stage))
+            conn.executemany(
+                "UPDATE content_cache SET value=? WHERE digest=? AND stage=?",
+                updates
+            )
+            stats["rows"] += len(updates)
+            last_key = rows[-1][:2]
+    return stats
+
+
+def compact(conn: sqlite3.Connection,
+            pages: int = COMPACT_PAGES,
+            fts_pages: int = FTS_MERGE_PAGES) -> dict[str, int]:
+    """One bounded round of upkeep, short enough to run on a schedule.
+
+    Merges some of each full-text index's segments, refreshes the query
+    planner's statistics, returns up to `pages` free pages to the
+    filesystem and checkpoints the WAL without waiting on readers. Free
+    pages are only returned on databases with incremental auto_vacuum,
+    which new ones have; `vacuum` converts older ones. `conn` must be in
+    autocommit mode.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table in ("chunks_fts", "plain_fts"):
+            conn.execute(
+                f"INSERT INTO {table} ({table}, rank) VALUES ('merge', ?)",
+                (fts_pages,)
+            )
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    conn.execute("PRAGMA optimize")
+    # Counted after the merge, which frees the segments it merged
+    free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    if incremental and free_before:
+        # Each step of the pragma frees one page; only executescript
+        # steps it to the end
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    _, wal_pages, _ = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    free_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return {
+        "incremental": int(incremental),
+        "pages_freed": free_before - free_after,
+        "free_pages": free_after,
+        "wal_pages": wal_pages,
+    }
+
+
+def vacuum(db_name: str = "dummy.db") -> None:
+    """Return free pages to the filesystem, then reindex full text.
+
+    The database is switched to incremental auto_vacuum on the way, so
+    `compact` can keep it small from then on. VACUUM may renumber the
+    implicit rowids the FTS indexes point at.
+    """
+    conn = sqlite3.connect(DIR_PATH / db_name, isolation_level=None)
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("BEGIN IMMEDIATE")
+        rebuild_fts(conn)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
 def init_db(db_name: str = "dummy.db") -> None:
     with sqlite3.connect(DIR_PATH / db_name) as conn:
         cur = conn.cursor()
-        query = """
-        CREATE TABLE IF NOT EXISTS files (
-            bucket_key      VARCHAR(200) PRIMARY KEY NOT NULL,
-            file_path       VARCHAR(1000),
-            md_rep          TEXT,
-            json_rep        JSONB,
-            plain_rep       TEXT,
-            chunks          JSONB,
-            vec_embeddings  JSONB
-        )
-        """
-        cur.execute(query)
+        # Only takes before the first table and the switch to WAL
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # journal_mode is persistent, so every later connection gets WAL
+        cur.execute("PRAGMA journal_mode=WAL").fetchall()
+        old, new = ensure_schema(conn)
         conn.commit()
+    if old != new:
+        print(f"Migrated {db_name} from schema version {old} to {new}")
 
-        query = """
-        CREATE TABLE IF NOT EXISTS relationships (
-            doc_a_key       VARCHAR(200) NOT NULL,
-            doc_b_key       VARCHAR(200) NOT NULL,
-            relationship    TEXT CHECK(
-                                relationship IN ('A','B','C')
-                            ) NOT NULL DEFAULT 'A',
-            PRIMARY KEY (doc_a_key, doc_b_key),
-            FOREIGN KEY (doc_a_key) references files (doc_a_key),
-            FOREIGN KEY (doc_b_key) references files (doc_b_key)
-        )
-        """
-        cur.execute(query)
-        conn.commit()
-        
 def check_db(db_name: str = "dummy.db") -> None:
     with sqlite3.connect(DIR_PATH / db_name) as conn:
         cur = conn.cursor()
@@ -77,7 +1031,58 @@ if __name__ == "__main__":
     parser.add_argument("-i", "--init", action="store_true")
     parser.add_argument("-t", "--table", type=str, default="files")
     parser.add_argument("-n", "--name", type=str, default="dummy.db")
+    parser.add_argument("-q", "--query", type=str, default="",
+                        help="Keyword search over chunks and print the hits")
+    parser.add_argument("-k", "--limit", type=int, default=10)
+    parser.add_argument("-p", "--prefix", type=str, default="",
+                        help="Only search bucket keys starting with this")
+    parser.add_argument("--raw", action="store_true",
+                        help="Pass --query to FTS5 unquoted")
+    parser.add_argument("--docs", action="store_true",
+                        help="Search whole documents instead of chunks")
+    parser.add_argument("--rebuild_fts", action="store_true",
+                        help="Reindex the full-text indexes, e.g. after VACUUM")
+    parser.add_argument("--optimize_fts", action="store_true")
+    parser.add_argument("--compress", action="store_true",
+                        help="Train a codec dictionary and compress the "
+                        "values written before compression existed")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="Shrink the file, e.g. after --compress")
+    parser.add_argument("--compact", action="store_true",
+                        help="Run one round of the scheduled compaction")
     opt = parser.parse_args()
+    if opt.compact:
+        import json
+        conn = connect(DIR_PATH / opt.name)
+        try:
+            print(json.dumps(compact(conn)))
+        finally:
+            conn.close()
+        sys.exit(0)
+    if opt.compress or opt.vacuum:
+        import json
+        if opt.compress:
+            print(json.dumps(compress_db(DIR_PATH / opt.name)))
+        if opt.vacuum:
+            vacuum(opt.name)
+        print(f"{os.path.getsize(DIR_PATH / opt.name)} bytes")
+        sys.exit(0)
+    if opt.query or opt.rebuild_fts or opt.optimize_fts:
+        import time
+        with sqlite3.connect(DIR_PATH / opt.name) as conn:
+            if opt.rebuild_fts:
+                rebuild_fts(conn)
+            if opt.optimize_fts:
+                optimize_fts(conn)
+            if opt.query:
+                search = search_docs if opt.docs else search_chunks
+                start = time.perf_counter()
+                hits = search(conn, opt.query, opt.limit, opt.prefix, opt.raw)
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                for hit in hits:
+                    print("\t".join(str(value) for value in hit))
+                print(f"{len(hits)} hits in {elapsed_ms:.1f} ms")
+        sys.exit(0)
     if opt.init is True:
         init_db(opt.name)
     check_db(opt.name)
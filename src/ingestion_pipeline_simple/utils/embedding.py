@@ -0,0 +1,125 @@
+import hashlib
+import re
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator, Protocol, Sequence, TypeVar
+
+import numpy as np
+
+# Chunks are embedded this many at a time, across documents
+EMBED_BATCH_SIZE = 1024
+EMBED_DIM = 256
+
+_TOKEN = re.compile(r"\w+")
+T = TypeVar("T")
+
+
+class Embedder(Protocol):
+    """Turns a batch of texts into an `(n, dim)` float32 matrix.
+
+    Rows need not be normalized; the embedding stage L2-normalizes the
+    whole matrix at once. `name` identifies the embedder and its settings
+    so stored vectors can be told apart from another embedder's.
+    """
+    name: str
+    dim: int
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray: ...
+
+
+REGISTRY: dict[str, Callable[..., Embedder]] = {}
+
+def register(name: str):
+    def inner(factory: Callable[..., Embedder]):
+        REGISTRY[name] = factory
+        return factory
+    return inner
+
+
+def get_embedder(name: str = "hashing", **kwargs) -> Embedder:
+    assert name in REGISTRY, \
+        f"Error: Unknown embedder ({name}), expected {list(REGISTRY)}"
+    return REGISTRY[name](**kwargs)
+
+
+@lru_cache(maxsize=1 << 16)
+def _token_slot(token: str, dim: int) -> tuple[int, float]:
+    # A keyed hash rather than hash(): str hashes are salted per process,
+    # so they would give every worker different vectors
+    h = int.from_bytes(
+        hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(),
+        "little"
+    )
+    return h % dim, (1.0 if h >> 63 else -1.0)
+
+
+@register("hashing")
+class HashingEmbedder:
+    """Signed hashing-trick bag of words with sublinear term frequency.
+
+    Every token lands in one of `dim` columns with a +/-1 sign taken from
+    a stable hash, so collisions tend to cancel rather than pile up.
+    Summed counts are damped to `1 + log(tf)`. No vocabulary or network
+    access is needed and a text always gets the same vector, whatever it
+    is batched with; corpus-level IDF weights are deliberately left out
+    for that reason.
+    """
+
+    def __init__(self, dim: int = EMBED_DIM, sublinear_tf: bool = True) -> None:
+        assert dim > 0, "Error: Embedding dim must be positive"
+        self.dim = dim
+        self.sublinear_tf = sublinear_tf
+        self.name = f"hashing-{dim}" + ("-log" if sublinear_tf else "")
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        tokens: list[str] = []
+        lengths = np.empty(len(texts), dtype=np.int64)
+        for row, text in enumerate(texts):
+            found = _TOKEN.findall(text.lower())
+            tokens.extend(found)
+            lengths[row] = len(found)
+
+        # Hash each distinct token once per batch, then scatter every
+        # occurrence with a single vectorized add
+        vocab, inverse = np.unique(np.array(tokens, dtype=object),
+                                   return_inverse=True)
+        slots = np.array(
+            [_token_slot(token, self.dim) for token in vocab],
+            dtype=np.float64
+        ).reshape(-1, 2)
+        cols = slots[inverse, 0].astype(np.int64)
+        rows = np.repeat(np.arange(len(texts)), lengths)
+
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        np.add.at(matrix, (rows, cols), slots[inverse, 1])
+        if self.sublinear_tf:
+            # sign(x) * (1 + log|x|) on the non-zero cells
+            mags = np.abs(matrix)
+            nonzero = mags > 0
+            np.log(mags, out=mags, where=nonzero)
+            mags[nonzero] += 1.0
+            matrix = np.copysign(mags, matrix)
+        return matrix
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize the rows of `matrix` in place; zero rows stay zero."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    batch: list[T] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def pack_rows(matrix: np.ndarray) -> list[bytes]:
+    """Rows as little-endian float32 blobs, the `embeddings` format."""
+    packed = np.ascontiguousarray(matrix, dtype="<f4")
+    return [row.tobytes() for row in packed]
@@ -1,50 +1,169 @@
 from docx import Document
 import pypandoc
+import json
 import os
 import random
 import string
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
 
-WORDS = "./words_alpha.txt"
+# Word list documents are generated from, one word per line
+WORDS = os.environ.get("INGESTION_WORDS", "./words_alpha.txt")
 
-def make_new_doc(dir: str) -> None:
+# Document sizes as (paragraphs, words per paragraph) ranges
+SIZE_PROFILES: dict[str, tuple[tuple[int, int], tuple[int, int]]] = {
+    "small": ((5, 10), (30, 100)),
+    "medium": ((40, 80), (60, 150)),
+    "large": ((300, 500), (80, 200)),
+}
+CORPUS_MANIFEST = "corpus.json"
+
+
+@lru_cache(maxsize=4)
+def load_words(words: str | None = None) -> tuple[str, ...]:
+    with open(words or WORDS, mode="rt") as f:
+        return tuple(f.read().splitlines())
+
+
+def make_new_doc(dir: str,
+                 rng: random.Random | None = None,
+                 size: str = "small",
+                 words: str | None = None,
+                 prefix: str = "") -> str:
+    """Write a random DOCX of the given size profile; return its path.
+
+    Pass a seeded `rng` for the same document (name and text) every time.
+    """
+    rng = rng if rng is not None else random.Random()
+    contents = load_words(words)
+    (min_paras, max_paras), (min_len, max_len) = SIZE_PROFILES[size]
     doc = Document()
-    with open(WORDS, mode="rt") as f:
-        contents = f.read().splitlines()
 
-        file_name = "_".join([
-            random.choice(contents)
-            for _ in range(random.randint(2,5))
+    file_name = "_".join([
+        rng.choice(contents)
+        for _ in range(rng.randint(2,5))
+    ])
+    doc.add_heading(file_name.replace("_"," ").title())
+
+    num_paragraphs = rng.randint(min_paras, max_paras)
+    for _ in range(num_paragraphs):
+        para_len = rng.randint(min_len, max_len)
+        para = " ".join([
+            rng.choice(contents)
+            for _ in range(para_len)
         ])
-        doc.add_heading(file_name.replace("_"," ").title())
-
-        num_paragraphs = random.randint(5,10)
-        for _ in range(num_paragraphs):
-            para_len = random.randint(30,100)
-            para = " ".join([
-                random.choice(contents)
-                for _ in range(para_len)
-            ])
-            doc.add_paragraph(para)
-    
+        doc.add_paragraph(para)
+
     rand_bits = "".join([
-        random.choice(string.ascii_lowercase)
+        rng.choice(string.ascii_lowercase)
         for _ in range(4)
     ])
-    save_name = file_name + "_" + rand_bits + ".docx"
+    save_name = prefix + file_name + "_" + rand_bits + ".docx"
     save_path = os.path.join(dir, save_name)
     doc.save(save_path)
+    return save_path
+
+
+def _docx_to_pdf(docx_path: str) -> str:
+    pdf_path = docx_path[:-len(".docx")] + ".pdf"
+    pypandoc.convert_file(docx_path, "pdf", outputfile=pdf_path)
+    return pdf_path
+
 
-def convert_to_pdf(dir: str) -> None:
+def convert_to_pdf(dir: str, workers: int | None = None) -> None:
+    """Add a PDF next to every DOCX in `dir`.
+
+    Each conversion is a pandoc subprocess, so threads run them in parallel.
+    """
     assert os.path.isdir(dir)
-    for file in os.listdir(dir):
-        if file.endswith(".docx"):
-            pdf_file = file.replace(".docx",".pdf")
-            pypandoc.convert_file(
-                os.path.join(dir, file),
-                "pdf",
-                outputfile=os.path.join(dir, pdf_file)
-            )
+    docx_paths = [
+        os.path.join(dir, file)
+        for file in os.listdir(dir)
+        if file.endswith(".docx")
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_docx_to_pdf, docx_paths))
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """`"small:0.8,large:0.2"` -> size profile weights; a bare name is 1."""
+    weights: dict[str, float] = {}
+    for part in mix.split(","):
+        name, _, weight = part.strip().partition(":")
+        assert name in SIZE_PROFILES, \
+            f"Error: Unknown size ({name}), expected {list(SIZE_PROFILES)}"
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def _make_corpus_doc(args: tuple[str, int, int, str, float, str]) -> str:
+    dir, seed, number, mix, pdf_fraction, words = args
+    # Seeded per document, so the corpus does not depend on worker order
+    rng = random.Random(f"{seed}:{number}")
+    weights = parse_mix(mix)
+    [size] = rng.choices(list(weights), weights=list(weights.values()))
+    path = make_new_doc(dir, rng, size, words, prefix=f"{number:06d}_")
+    if rng.random() < pdf_fraction:
+        pdf_path = _docx_to_pdf(path)
+        os.remove(path)
+        return pdf_path
+    return path
+
+
+def make_corpus(dir: str,
+                num_docs: int,
+                seed: int = 0,
+                mix: str = "small",
+                pdf_fraction: float = 0.0,
+                workers: int | None = None,
+                words: str | None = None) -> list[str]:
+    """Generate a seeded corpus of `num_docs` documents in parallel.
+
+    The same arguments always give the same file names and text. A
+    manifest of the arguments is kept in `dir`, so asking again for an
+    existing corpus returns it without regenerating anything. Asking for
+    a different one replaces only the files the manifest lists; a
+    non-empty `dir` without a manifest is refused rather than touched.
+    """
+    os.makedirs(dir, exist_ok=True)
+    params = {
+        "num_docs": num_docs,
+        "seed": seed,
+        "mix": mix,
+        "pdf_fraction": pdf_fraction,
+    }
+    manifest = Path(dir, CORPUS_MANIFEST)
+    if manifest.exists():
+        existing = json.loads(manifest.read_text(encoding="utf-8"))
+        if existing["params"] == params \
+                and all(os.path.exists(path) for path in existing["files"]):
+            return existing["files"]
+        for path in existing["files"]:
+            Path(path).unlink(missing_ok=True)
+    else:
+        assert not os.listdir(dir), \
+            f"Error: {dir} is not empty and holds no corpus manifest; " \
+            "generate the corpus into an empty directory"
+
+    parse_mix(mix)
+    # Resolved here, as spawned workers would not see a changed WORDS
+    words = words or WORDS
+    load_words(words)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        files = list(pool.map(
+            _make_corpus_doc,
+            [(dir, seed, number, mix, pdf_fraction, words)
+             for number in range(num_docs)],
+            chunksize=max(1, num_docs // (4 * (os.cpu_count() or 1))),
+        ))
+    manifest.write_text(
+        json.dumps({"params": params, "files": files}, indent=2),
+        encoding="utf-8"
+    )
+    return files
+
 
 def clean_dir(dir: str) -> None:
     assert os.path.isdir(dir)
@@ -58,10 +177,18 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--num_to_make", type=int, default=1)
     parser.add_argument("-c", "--clean", action="store_true")
     parser.add_argument("-d", "--dir", type=str, default=".")
+    parser.add_argument("-s", "--seed", type=int, default=None,
+                        help="Generate a reproducible corpus with this seed")
+    parser.add_argument("--mix", type=str, default="small",
+                        help="Size profile weights, e.g. small:0.8,large:0.2")
+    parser.add_argument("--pdf_fraction", type=float, default=0.0)
     opt = parser.parse_args()
-    if opt.make:
+    if opt.make and opt.seed is not None:
+        make_corpus(opt.dir, opt.num_to_make, opt.seed, opt.mix,
+                    opt.pdf_fraction)
+    elif opt.make:
         for _ in range(opt.num_to_make):
             make_new_doc(opt.dir)
         convert_to_pdf(opt.dir)
     if opt.clean:
-        clean_dir(opt.dir)
\ No newline at end of file
+        clean_dir(opt.dir)
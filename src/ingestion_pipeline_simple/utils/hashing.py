@@ -0,0 +1,54 @@
+import hashlib
+from pathlib import Path
+from typing import Iterable
+
+# Read size for streaming digests; large enough to amortise syscalls
+# without holding much of a big file in memory
+READ_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+
+
+def file_digest(file_path: str | Path) -> str:
+    """BLAKE2b digest of a file's bytes, streamed in `READ_SIZE` blocks."""
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    buf = bytearray(READ_SIZE)
+    view = memoryview(buf)
+    with open(file_path, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def text_digest(text: str) -> str:
+    """BLAKE2b digest of a string's UTF-8 encoding."""
+    return hashlib.blake2b(
+        text.encode("utf-8"),
+        digest_size=DIGEST_SIZE
+    ).hexdigest()
+
+
+class StreamDigest:
+    """Incremental BLAKE2b over a sequence of strings or bytes.
+
+    Each part is length-prefixed, so different splits of the same text
+    hash differently.
+    """
+
+    def __init__(self) -> None:
+        self._h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+    def update(self, part: str | bytes) -> None:
+        data = part.encode("utf-8") if isinstance(part, str) else part
+        self._h.update(len(data).to_bytes(8, "little"))
+        self._h.update(data)
+
+    def hexdigest(self) -> str:
+        return self._h.hexdigest()
+
+
+def iter_digest(parts: Iterable[str]) -> str:
+    """`StreamDigest` of every string in `parts`."""
+    h = StreamDigest()
+    for part in parts:
+        h.update(part)
+    return h.hexdigest()
@@ -0,0 +1,373 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import logging
+logger = logging.getLogger(__name__)
+
+# How often the bucket is scanned for new and changed files
+POLL_SECONDS = float(os.environ.get("INGESTION_DAEMON_POLL_SECONDS", "0.5"))
+# Documents inside the pipeline at once; detected files beyond this wait
+# in the `ingest_backlog` table, like the sensor's
+MAX_IN_FLIGHT_DOCS = int(
+    os.environ.get("INGESTION_DAEMON_MAX_IN_FLIGHT_DOCS", "64")
+)
+# Most documents a stage takes off its queue for one call. A stage takes
+# whatever is waiting, so a lone upload is never held back for a batch.
+STAGE_BATCH_SIZE = 16
+# Documents each queue between stages holds before the stage feeding it
+# waits, so a slow stage backs the pipeline up to admission
+QUEUE_DEPTH = 32
+# Calls to the conversion stage in flight at once. Each fans its batch
+# out over the conversion engine's process pool.
+CONVERT_CONCURRENCY = 2
+# Ingestion latencies kept for `Daemon.latency`
+LATENCY_WINDOW = 1000
+
+
+@dataclass
+class Doc:
+    bucket_key: str
+    file_path: str
+    seq: int
+    detected_at: float
+
+
+@dataclass
+class Stage:
+    """One step of the pipeline: `fn` runs on a batch in an executor thread.
+
+    Conversion fans out to worker processes from there; chunking and
+    embedding run numpy and SQLite calls that release the GIL.
+    """
+    name: str
+    fn: Callable[[list[Doc]], Any]
+    workers: int = 1
+
+
+def _config(schema: dict[str, Any],
+            overrides: dict[str, Any] | None) -> dict[str, Any]:
+    """An op config with every field of `schema`, defaults filled in."""
+    return {
+        **{name: field.default_value for name, field in schema.items()},
+        **(overrides or {}),
+    }
+
+
+async def _take(queue: asyncio.Queue, limit: int) -> list[Doc]:
+    """Wait for one item, then take whatever else is ready, up to `limit`."""
+    items = [await queue.get()]
+    while len(items) < limit and not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+class Daemon:
+    """Long-running ingestion without a Dagster run per file.
+
+    Changes are detected as by the `file_monitor` sensor and queued in the
+    same backlog table. Admitted documents flow through a pipeline of
+    stages joined by bounded queues; each stage runs the same compute
+    function as its asset, so the `files` rows, caches and data versions
+    it writes are those a Dagster run would write, and later runs skip
+    these partitions as unchanged. `config` is the op config of `chunks`,
+    `vec_embeddings` and `relationships` by asset name. With `store_root`
+    each stage's table also goes where `BucketIOManager` keeps it.
+
+    Run it instead of the sensor, not next to it: both consume the same
+    scan index and backlog.
+    """
+
+    def __init__(self,
+                 db: Any,
+                 bucket: Any,
+                 config: dict[str, dict[str, Any]] | None = None,
+                 store_root: str | None = None,
+                 poll_seconds: float = POLL_SECONDS,
+                 max_in_flight: int = MAX_IN_FLIGHT_DOCS) -> None:
+        from ..defs import assets
+        config = config or {}
+        self.db = db
+        self.bucket = bucket
+        self.store_root = store_root
+        self.poll_seconds = poll_seconds
+        self.max_in_flight = max_in_flight
+        self.chunk_args = _config(assets.CHUNK_CONFIG, config.get("chunks"))
+        self.embed_config = _config(assets.EMBED_CONFIG,
+                                    config.get("vec_embeddings"))
+        self.relationship_config = _config(assets.RELATIONSHIP_CONFIG,
+                                           config.get("relationships"))
+        self.stages = [
+            Stage("binary_files", self._binary_files),
+            Stage("markdown_files",
+                  self._keys("markdown_files",
+                             assets.compute_markdown_files),
+                  workers=CONVERT_CONCURRENCY),
+            Stage("text_stages",
+                  self._keys("text_stages", assets.compute_text_stages,
+                             self.chunk_args)),
+            Stage("vec_embeddings",
+                  self._keys("vec_embeddings", assets.compute_vec_embeddings,
+                             self.embed_config)),
+            # The ANN indexes take one writer at a time
+            Stage("relationships",
+                  self._keys("relationships", assets.compute_relationships,
+                             self.relationship_config)),
+        ]
+        self.in_flight: dict[str, Doc] = {}
+        self.done = 0
+        self.failed = 0
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._cursor: dict = {}
+        self._seq = 0
+        self._wake = asyncio.Event()
+
+    def _store(self, stage: str, docs: list[Doc], res: Any) -> None:
+        if self.store_root is None:
+            return
+        from . import columnar
+        columnar.write_partitions(self.store_root, stage, res.table, [
+            doc.bucket_key for doc in docs
+            if doc.bucket_key not in res.unchanged
+        ])
+
+    def _keys(self, stage: str, compute: Callable, *args: Any) -> Callable:
+        """Run an asset's compute function on a batch's keys."""
+        def fn(docs: list[Doc]) -> None:
+            res = compute(self.db, [doc.bucket_key for doc in docs], *args,
+                          export=self.store_root is not None)
+            # The fused text stages return a result per asset
+            for name, stage_res in (res if isinstance(res, dict)
+                                    else {stage: res}).items():
+                self._store(name, docs, stage_res)
+        return fn
+
+    def _binary_files(self, docs: list[Doc]) -> None:
+        from ..defs import assets
+        res = assets.compute_binary_files(self.db, self.bucket, {
+            doc.bucket_key: doc.file_path for doc in docs
+        }, export=self.store_root is not None)
+        self._store("binary_files", docs, res)
+
+    def _run_stage(self, stage: Stage, docs: list[Doc]) -> None:
+        from . import instrumentation
+        with instrumentation.measure(stage.name, len(docs)) as stats:
+            stage.fn(docs)
+        # Keeps the sensor's cost model current for when it takes over
+        self.db.record_stage_stats(stats)
+
+    async def _stage_worker(self,
+                            stage: Stage,
+                            executor: ThreadPoolExecutor,
+                            inbox: asyncio.Queue,
+                            outbox: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            docs = await _take(inbox, STAGE_BATCH_SIZE)
+            try:
+                await loop.run_in_executor(
+                    executor, self._run_stage, stage, docs
+                )
+            except Exception:
+                logger.exception(
+                    f"{stage.name} failed for "
+                    f"{[doc.bucket_key for doc in docs]}"
+                )
+                await self._finish(docs, False)
+                continue
+            for doc in docs:
+                await outbox.put(doc)
+
+    def _drop(self, docs: list[Doc]) -> None:
+        by_seq: dict[int, list[str]] = {}
+        for doc in docs:
+            by_seq.setdefault(doc.seq, []).append(doc.bucket_key)
+        for seq, bucket_keys in by_seq.items():
+            self.db.drop_backlog(bucket_keys, seq)
+
+    async def _finish(self, docs: list[Doc], ok: bool) -> None:
+        """Drop finished documents from the backlog and the pipeline.
+
+        Failed ones are dropped too, as the sensor drops the files of a
+        failed run; they come back when they change again.
+        """
+        await asyncio.to_thread(self._drop, docs)
+        now = time.time()
+        for doc in docs:
+            del self.in_flight[doc.bucket_key]
+            if ok:
+                self.latencies.append(now - doc.detected_at)
+        if ok:
+            self.done += len(docs)
+            logger.info(
+                f"Ingested {len(docs)} files, latest in "
+                f"{self.latencies[-1]:.3f}s"
+            )
+        else:
+            self.failed += len(docs)
+        # Freed capacity admits more straight away
+        self._wake.set()
+
+    async def _finisher(self, inbox: asyncio.Queue) -> None:
+        while True:
+            await self._finish(await _take(inbox, STAGE_BATCH_SIZE), True)
+
+    def _detect(self, in_flight: frozenset[str]) -> None:
+        """Queue new and changed files and purge deleted ones.
+
+        A deleted file still in the pipeline is purged once it is out, so
+        its later stages cannot write it back.
+        """
+        from ..defs import sensors
+        detected = sensors.detect_changes(
+            self.bucket, self.db, self._cursor, logger.debug
+        )
+        if detected:
+            self.db.enqueue_backlog(detected)
+        sensors.purge_deleted(self.db, logger.info, self.store_root,
+                              skip=in_flight, bucket=self.bucket)
+
+    def _admit(self, in_flight: frozenset[str]) -> list[Doc]:
+        """Admit pending backlog files, up to the room left in the pipeline.
+
+        A file still in the pipeline waits until its current pass is done.
+        """
+        room = self.max_in_flight - len(in_flight)
+        if room <= 0:
+            return []
+        entries = [
+            entry for entry in self.db.pending_backlog(room + len(in_flight))
+            if entry.bucket_key not in in_flight
+        ][:room]
+        if not entries:
+            return []
+        self._seq += 1
+        self.db.admit_backlog(
+            [entry.bucket_key for entry in entries], self._seq
+        )
+        return [
+            Doc(entry.bucket_key, entry.file_path, self._seq,
+                entry.enqueued_at)
+            for entry in entries
+        ]
+
+    async def _admitter(self, outbox: asyncio.Queue, once: bool) -> None:
+        while True:
+            self._wake.clear()
+            await asyncio.to_thread(self._detect, frozenset(self.in_flight))
+            docs = await asyncio.to_thread(
+                self._admit, frozenset(self.in_flight)
+            )
+            for doc in docs:
+                self.in_flight[doc.bucket_key] = doc
+                await outbox.put(doc)
+            if once and not self.in_flight \
+                    and not await asyncio.to_thread(self.db.backlog_size):
+                return
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self,
+                  once: bool = False,
+                  stop: asyncio.Event | None = None) -> dict[str, int]:
+        """Ingest until `stop` is set; return file counts.
+
+        With `once`, return as soon as everything detected by then is
+        done. Files admitted but unfinished when the daemon stops go back
+        in line on the next start.
+        """
+        # A previous daemon's unfinished files are pending again
+        await asyncio.to_thread(self.db.settle_backlog, 0)
+        queues: list[asyncio.Queue] = [
+            asyncio.Queue(QUEUE_DEPTH) for _ in range(len(self.stages) + 1)
+        ]
+        executors = [
+            ThreadPoolExecutor(max_workers=stage.workers,
+                               thread_name_prefix=stage.name)
+            for stage in self.stages
+        ]
+        tasks = [
+            asyncio.create_task(self._stage_worker(
+                stage, executor, queues[pos], queues[pos + 1]
+            ))
+            for pos, (stage, executor)
+            in enumerate(zip(self.stages, executors))
+            for _ in range(stage.workers)
+        ]
+        tasks.append(asyncio.create_task(self._finisher(queues[-1])))
+        admitter = asyncio.create_task(self._admitter(queues[0], once))
+        waiters = [admitter]
+        if stop is not None:
+            waiters.append(asyncio.create_task(stop.wait()))
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            if admitter.done():
+                admitter.result()
+        finally:
+            for task in tasks + waiters:
+                task.cancel()
+            await asyncio.gather(*tasks, *waiters, return_exceptions=True)
+            for executor in executors:
+                executor.shutdown(wait=True, cancel_futures=True)
+        return {"done": self.done, "failed": self.failed}
+
+    def latency(self) -> dict[str, float]:
+        """p50/p99 seconds from detection to ingested, recent files."""
+        from .benchmark import percentile
+        if not self.latencies:
+            return {}
+        values = list(self.latencies)
+        return {"p50_s": percentile(values, 50),
+                "p99_s": percentile(values, 99)}
+
+
+if __name__ == "__main__":
+    from ..defs import resources
+
+    parser = argparse.ArgumentParser(
+        description="Ingest bucket uploads continuously without Dagster "
+        "runs. Stop the file_monitor sensor first."
+    )
+    parser.add_argument("--db", type=str, default="database/dummy.db")
+    parser.add_argument("--bucket_path", type=str, default="test_bucket")
+    parser.add_argument("--org", type=str, default="org")
+    parser.add_argument("--usr", type=str, default="usr")
+    parser.add_argument("--store", type=str, default=None,
+                        help="Also write stage tables here, like the "
+                        "bucket_io_manager")
+    parser.add_argument("-c", "--config", type=str, default=None,
+                        help="JSON file of op config by asset name")
+    parser.add_argument("--poll", type=float, default=POLL_SECONDS)
+    parser.add_argument("--max_in_flight", type=int,
+                        default=MAX_IN_FLIGHT_DOCS)
+    parser.add_argument("--once", action="store_true",
+                        help="Exit once everything detected is ingested")
+    opt = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    config = {}
+    if opt.config:
+        with open(opt.config, encoding="utf-8") as f:
+            config = json.load(f)
+    daemon = Daemon(
+        resources.SQLiteResource(db_path=opt.db),
+        resources.BucketResource(bucket_path=opt.bucket_path, org=opt.org,
+                                 usr=opt.usr),
+        config,
+        opt.store,
+        opt.poll,
+        opt.max_in_flight,
+    )
+    try:
+        counts = asyncio.run(daemon.run(once=opt.once))
+    except KeyboardInterrupt:
+        counts = {"done": daemon.done, "failed": daemon.failed}
+    print(json.dumps({**counts, **daemon.latency()}, indent=2))
@@ -0,0 +1,202 @@
+import contextvars
+import os
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Prometheus name, help text and type of each `StageStats` field
+METRICS: dict[str, tuple[str, str, str]] = {
+    "partitions": ("partitions_total", "Partitions processed.", "counter"),
+    "wall_s": ("wall_seconds_total", "Wall time in the stage.", "counter"),
+    "cpu_s": ("cpu_seconds_total",
+              "CPU time of the stage's own process.", "counter"),
+    "db_s": ("db_seconds_total", "Wall time spent in SQLite.", "counter"),
+    "conversion_s": ("conversion_seconds_total",
+                     "Wall time spent converting files to markdown.",
+                     "counter"),
+    "conversion_worker_s": ("conversion_worker_seconds_total",
+                            "Conversion time summed over worker processes.",
+                            "counter"),
+    "bytes_in": ("bytes_in_total",
+                 "Bytes read from SQLite and source files.", "counter"),
+    "bytes_out": ("bytes_out_total",
+                  "Bytes in the stage's exported tables.", "counter"),
+    "rss_delta_bytes": ("rss_delta_bytes",
+                        "Change in resident set size over the stage.",
+                        "gauge"),
+    "process_peak_rss_bytes": ("process_peak_rss_bytes",
+                               "Lifetime peak resident set size of the "
+                               "stage's process.", "gauge"),
+}
+_PREFIX = "ingestion_stage_"
+
+
+@dataclass
+class StageStats:
+    """Resource use of one execution of a stage.
+
+    `db_s` and `conversion_s` only count the outermost timed block of each
+    kind, so nested calls are not counted twice. Rows streamed lazily into
+    a write are produced inside it and count as DB time. Text is counted
+    in `bytes_in` by length.
+
+    `rss_delta_bytes` is the resident set size at the end of the stage
+    less that at its start, so it also counts other threads of the
+    process. `process_peak_rss_bytes` is the process's lifetime peak,
+    which an earlier, larger stage may have set.
+    """
+    stage: str
+    partitions: int = 0
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    db_s: float = 0.0
+    conversion_s: float = 0.0
+    conversion_worker_s: float = 0.0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    rss_delta_bytes: int = 0
+    process_peak_rss_bytes: int = 0
+    _depth: dict[str, int] = field(default_factory=dict, repr=False)
+
+    def metadata(self) -> dict[str, float | int]:
+        """The stats as flat asset metadata, e.g. `perf/db_s`."""
+        return {
+            f"perf/{name}": round(value, 6) if isinstance(value, float)
+            else value
+            for name, value in vars(self).items()
+            if name in METRICS
+        }
+
+
+_CURRENT: contextvars.ContextVar[StageStats | None] = \
+    contextvars.ContextVar("stage_stats", default=None)
+
+
+def current() -> StageStats | None:
+    return _CURRENT.get()
+
+
+def current_rss() -> int:
+    """This process's resident set size in bytes, or 0 if unknown."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, AttributeError, ValueError, IndexError):
+        # No procfs, as on macOS and Windows
+        return 0
+
+
+def peak_rss() -> int:
+    """High-water mark of this process's RSS in bytes, or 0 if unknown."""
+    if resource is None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+@contextmanager
+def measure(stage: str, partitions: int = 0) -> Iterator[StageStats]:
+    """Collect a `StageStats` for the code run inside the block."""
+    stats = StageStats(stage, partitions)
+    token = _CURRENT.set(stats)
+    wall, cpu = time.perf_counter(), time.process_time()
+    rss = current_rss()
+    try:
+        yield stats
+    finally:
+        stats.wall_s += time.perf_counter() - wall
+        stats.cpu_s += time.process_time() - cpu
+        if rss:
+            stats.rss_delta_bytes = current_rss() - rss
+        stats.process_peak_rss_bytes = peak_rss()
+        _CURRENT.reset(token)
+
+
+@contextmanager
+def timed(kind: str) -> Iterator[None]:
+    """Add the block's wall time to the current stage's `<kind>_s`."""
+    stats = _CURRENT.get()
+    if stats is None:
+        yield
+        return
+    depth = stats._depth.get(kind, 0)
+    stats._depth[kind] = depth + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats._depth[kind] = depth
+        if depth == 0:
+            name = f"{kind}_s"
+            setattr(stats, name,
+                    getattr(stats, name) + time.perf_counter() - start)
+
+
+def add(name: str, amount: float) -> None:
+    """Add to a counter of the current stage; a no-op outside `measure`."""
+    stats = _CURRENT.get()
+    if stats is not None:
+        setattr(stats, name, getattr(stats, name) + amount)
+
+
+def size_of(value: Any) -> int:
+    return len(value) if isinstance(value, (str, bytes)) else 0
+
+
+def _read_totals(path: Path) -> dict[str, float]:
+    totals: dict[str, float] = {}
+    if not path.exists():
+        return totals
+    for line in path.read_text(encoding="utf-8").splitlines():
+        if line and not line.startswith("#"):
+            series, _, value = line.rpartition(" ")
+            totals[series] = float(value)
+    return totals
+
+
+def write_textfile(stats: StageStats, directory: str | Path) -> Path:
+    """Fold `stats` into `<directory>/ingestion_<stage>.prom`.
+
+    The file is in the Prometheus text format read by node_exporter's
+    textfile collector. Counters accumulate across runs, so the previous
+    file is read back under a lock and the new one swapped in atomically.
+    """
+    directory = Path(directory)
+    os.makedirs(directory, exist_ok=True)
+    path = directory / f"ingestion_{stats.stage}.prom"
+    with open(directory / f".ingestion_{stats.stage}.lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        totals = _read_totals(path)
+        label = f'{{stage="{stats.stage}"}}'
+        lines = []
+        for attr, (name, help_text, kind) in {
+            **METRICS,
+            "runs": ("runs_total", "Executions of the stage.", "counter"),
+        }.items():
+            series = f"{_PREFIX}{name}{label}"
+            value = 1 if attr == "runs" else getattr(stats, attr)
+            if kind == "counter":
+                value += totals.get(series, 0.0)
+            lines += [
+                f"# HELP {_PREFIX}{name} {help_text}",
+                f"# TYPE {_PREFIX}{name} {kind}",
+                f"{series} {value}",
+            ]
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        os.replace(tmp, path)
+    return path
@@ -0,0 +1,339 @@
+import argparse
+import re
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from typing import NamedTuple
+
+# Block-level syntax, matched at the start of each line
+_FENCE = re.compile(r" {0,3}(`{3,}|~{3,})")
+_BLANK = re.compile(r"[ \t]*$")
+_INDENT = re.compile(r"[ \t]+")
+_RULE = re.compile(r" {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")
+_SETEXT = re.compile(r" {0,3}(?:=+|-+)[ \t]*$")
+_LINK_DEF = re.compile(r" {0,3}\[[^\]]+\]:[ \t]+\S")
+_QUOTE = re.compile(r"(?: {0,3}>[ \t]?)+")
+_HEADING = re.compile(r" {0,3}#{1,6}(?:[ \t]+|$)")
+_HEADING_CLOSE = re.compile(r"[ \t]+#+[ \t]*$")
+_LIST = re.compile(r"[ \t]*(?:[-+*]|\d{1,9}[.)])[ \t]+(?:\[[ xX]\][ \t]+)?")
+_TABLE_SEP = re.compile(
+    r"[ \t]*\|?[ \t]*:?-+:?[ \t]*(?:\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$"
+)
+_CELL = re.compile(r"(?:\\.|[^|\\])*")
+
+# Inline syntax; the outer group of each alternative names the construct.
+# The leading lookahead lets most positions fail on a single class test.
+_INLINE = re.compile(
+    r"(?=[\\`!\[<*_~])"
+    r"(?:(?P<escape>\\[!-/:-@\[-`{-~])"
+    r"|(?P<code>(?P<ticks>`+)(?P<code_text>.+?)(?P=ticks))"
+    r"|(?P<image>!\[(?P<alt>[^\]]*)\]\([^)]*\))"
+    r"|(?P<link>\[(?P<link_text>[^\]]*)\](?:\([^)]*\)|\[[^\]]*\]))"
+    r"|(?P<autolink><(?P<url>(?:https?|mailto):[^>\s]+)>)"
+    r"|(?P<html></?[A-Za-z][^>\n]*>|<!--.*?-->)"
+    # Emphasis needs a closing run just like its opening one; the opener
+    # must be followed and the closer preceded by non-space, so a lone or
+    # spaced `*` (`5 * 3`, `a*b`) is text. A closer pairs with the nearest
+    # opener of its run, so the text cannot hold another.
+    r"|(?P<emphasis>(?P<stars>\*{1,3}|~~)(?=\S)"
+    r"(?P<em_text>(?:(?!(?<![*~])(?P=stars)(?=[^\s*~]))(?s:.))+?)"
+    r"(?<![\s\\*~])(?P=stars)(?![*~]))"
+    # Intraword underscores (snake_case) are text, not emphasis
+    r"|(?P<underscore>(?<![A-Za-z0-9])(?P<unders>_{1,3})(?=\S)"
+    r"(?P<under_text>(?:(?!(?<![A-Za-z0-9_])(?P=unders)(?=[^\s_]))(?s:.))+?)"
+    r"(?<![\s\\_])(?P=unders)(?![A-Za-z0-9_])))"
+)
+
+# Cell separator emitted for table pipes
+CELL_SEP = "\t"
+
+
+class OffsetMap:
+    """Maps positions in plain text back to the markdown they came from.
+
+    Plain text is a sequence of runs copied verbatim from the markdown,
+    so only each run's start is stored: two arrays of `(plain, markdown)`
+    start offsets, searched with bisect.
+    """
+    __slots__ = ("plain_starts", "md_starts", "length", "md_length")
+
+    def __init__(self,
+                 plain_starts: array,
+                 md_starts: array,
+                 length: int,
+                 md_length: int) -> None:
+        self.plain_starts = plain_starts
+        self.md_starts = md_starts
+        self.length = length
+        self.md_length = md_length
+
+    def to_source(self, pos: int) -> int:
+        """Markdown offset of the plain-text character at `pos`."""
+        if pos >= self.length or not self.plain_starts:
+            return self.md_length
+        run = bisect_right(self.plain_starts, pos) - 1
+        return self.md_starts[run] + pos - self.plain_starts[run]
+
+    def source_span(self, start: int, end: int) -> tuple[int, int]:
+        """Markdown `[start, end)` covering plain-text `[start, end)`."""
+        if end <= start:
+            source = self.to_source(start)
+            return source, source
+        return self.to_source(start), self.to_source(end - 1) + 1
+
+    def pack(self) -> bytes:
+        header = array("q", (self.length, self.md_length, len(self.md_starts)))
+        data = header + self.plain_starts + self.md_starts
+        if sys.byteorder == "big":
+            data.byteswap()
+        return data.tobytes()
+
+    @classmethod
+    def unpack(cls, blob: bytes) -> "OffsetMap":
+        data = array("q")
+        data.frombytes(blob)
+        if sys.byteorder == "big":
+            data.byteswap()
+        length, md_length, runs = data[:3]
+        return cls(data[3:3+runs], data[3+runs:], length, md_length)
+
+
+class PlainText(NamedTuple):
+    text: str
+    offsets: OffsetMap
+
+
+class _Builder:
+    def __init__(self, md: str) -> None:
+        self.md = md
+        self.parts: list[str] = []
+        self.plain_starts = array("q")
+        self.md_starts = array("q")
+        self.length = 0
+        self._next = -1
+
+    def copy(self, start: int, end: int) -> None:
+        if start >= end:
+            return
+        if start != self._next:
+            self.plain_starts.append(self.length)
+            self.md_starts.append(start)
+        self.parts.append(self.md[start:end])
+        self.length += end - start
+        self._next = end
+
+    def put(self, char: str, anchor: int) -> None:
+        self.plain_starts.append(self.length)
+        self.md_starts.append(anchor)
+        self.parts.append(char)
+        self.length += 1
+        self._next = -1
+
+    def inline(self, start: int, end: int) -> None:
+        md = self.md
+        pos = start
+        for m in _INLINE.finditer(md, start, end):
+            self.copy(pos, m.start())
+            kind = m.lastgroup
+            if kind == "escape":
+                self.copy(m.start() + 1, m.end())
+            elif kind == "code":
+                self.copy(*m.span("code_text"))
+            elif kind == "image":
+                self.inline(*m.span("alt"))
+            elif kind == "link":
+                self.inline(*m.span("link_text"))
+            elif kind == "autolink":
+                self.copy(*m.span("url"))
+            elif kind == "emphasis":
+                self.inline(*m.span("em_text"))
+            elif kind == "underscore":
+                self.inline(*m.span("under_text"))
+            # HTML tags and emphasis markers are dropped
+            pos = m.end()
+        self.copy(pos, end)
+
+    def table_row(self, start: int, end: int) -> None:
+        md = self.md
+        cells = [m.span() for m in _CELL.finditer(md, start, end)]
+        # finditer yields an empty match after each cell; the ones before
+        # a leading pipe and after a trailing pipe are not cells either
+        cells = [span for pos, span in enumerate(cells)
+                 if span[0] < span[1] or (0 < pos < len(cells) - 1
+                                          and cells[pos - 1][1] < span[0])]
+        first = True
+        for cell_start, cell_end in cells:
+            stripped = md[cell_start:cell_end]
+            lead = len(stripped) - len(stripped.lstrip())
+            trail = len(stripped.rstrip())
+            if not first:
+                # Anchored on the pipe it replaces
+                self.put(CELL_SEP, cell_start - 1)
+            first = False
+            self.inline(cell_start + lead, cell_start + trail)
+
+    def result(self) -> PlainText:
+        return PlainText(
+            "".join(self.parts),
+            OffsetMap(self.plain_starts, self.md_starts,
+                      self.length, len(self.md))
+        )
+
+
+def _lines(md: str) -> list[tuple[int, int, int]]:
+    """`(start, end, next)` of each line; `end` excludes the line break."""
+    lines = []
+    pos = 0
+    while pos < len(md):
+        nl = md.find("\n", pos)
+        nxt = len(md) if nl == -1 else nl + 1
+        end = len(md) if nl == -1 else nl
+        if end > pos and md[end - 1] == "\r":
+            end -= 1
+        lines.append((pos, end, nxt))
+        pos = nxt
+    return lines
+
+
+def to_plain(md: str) -> PlainText:
+    """Strip markdown syntax from `md` in one pass over its lines.
+
+    Text is kept, syntax is dropped: heading, quote and list markers,
+    emphasis, code fences and backticks, link and image targets (their
+    text and alt text stay), HTML tags, rules and link definitions. Table
+    pipes become `CELL_SEP` and separator rows go. Every plain character
+    was copied from the markdown, apart from the cell separators, so
+    `offsets` can map any plain-text span back to its source.
+    """
+    out = _Builder(md)
+    lines = _lines(md)
+    fence: str | None = None
+    in_table = False
+    skip = -1
+    # Consecutive paragraph lines are scanned for inline syntax as one run
+    para = -1
+    for i, (start, end, nxt) in enumerate(lines):
+        if i == skip:
+            continue
+        if fence is None and md[start].isalpha() \
+                and md.find("|", start, end) == -1:
+            if para == -1:
+                para = start
+            in_table = False
+            continue
+        if para != -1:
+            out.inline(para, start)
+            para = -1
+
+        if fence is not None:
+            m = _FENCE.match(md, start, end)
+            if m and m.group(1).startswith(fence) \
+                    and _BLANK.match(md, m.end(), end):
+                fence = None
+            else:
+                out.copy(start, nxt)
+            continue
+        m = _FENCE.match(md, start, end)
+        if m:
+            fence = m.group(1)
+            continue
+        if _BLANK.match(md, start, end):
+            in_table = False
+            out.copy(end, nxt)
+            continue
+
+        if md.find("|", start, end) != -1:
+            if not in_table and i + 1 < len(lines):
+                sep_start, sep_end, _ = lines[i + 1]
+                if md.find("|", sep_start, sep_end) != -1 \
+                        and _TABLE_SEP.match(md, sep_start, sep_end):
+                    in_table = True
+                    skip = i + 1
+            if in_table:
+                out.table_row(start, end)
+                out.copy(end, nxt)
+                continue
+        in_table = False
+
+        if _RULE.match(md, start, end) or _SETEXT.match(md, start, end) \
+                or _LINK_DEF.match(md, start, end):
+            continue
+        pos = start
+        content_end = end
+        m = _QUOTE.match(md, pos, end)
+        if m:
+            pos = m.end()
+        m = _HEADING.match(md, pos, end)
+        if m:
+            pos = m.end()
+            close = _HEADING_CLOSE.search(md, pos, end)
+            if close:
+                content_end = close.start()
+        else:
+            m = _LIST.match(md, pos, end) or _INDENT.match(md, pos, end)
+            if m:
+                pos = m.end()
+        out.inline(pos, content_end)
+        out.copy(end, nxt)
+    if para != -1:
+        out.inline(para, len(md))
+    return out.result()
+
+
+def sample_markdown(size: int) -> str:
+    """Roughly `size` characters of markdown using every construct.
+
+    Mostly wrapped prose, like the documents the converters produce, with
+    each kind of block and inline syntax mixed in.
+    """
+    prose = (
+        "The quarterly figures were reviewed by the committee and the "
+        "results\nare summarised below, with **bold** remarks, _emphasis_, "
+        "a `code span`,\na [link](https://example.com/page \"title\") and "
+        "snake_case_words that\nstay as they are. Totals are rounded to the "
+        "nearest unit throughout.\n\n"
+    )
+    block = (
+        "# Quarterly *report* ##\n\n"
+        + prose * 3
+        + "![diagram of the flow](images/flow.png) and <https://example.org>.\n\n"
+        "> Quoted line with \\*escaped\\* stars.\n"
+        "- first item\n"
+        "- [x] done item\n"
+        "1. numbered <b>item</b>\n\n"
+        + prose * 2
+        + "| Name | Value |\n"
+        "| ---- | ----: |\n"
+        "| alpha | 1 |\n"
+        "| beta | 2 |\n\n"
+        "```python\n"
+        "print('code * kept')\n"
+        "```\n\n"
+        "---\n\n"
+    )
+    return block * max(1, size // len(block))
+
+
+def bench(size_mb: float = 8.0, repeat: int = 3) -> float:
+    """Best-of-`repeat` throughput of `to_plain` in MB/s of markdown."""
+    md = sample_markdown(int(size_mb * 1024 * 1024))
+    megabytes = len(md.encode("utf-8")) / (1024 * 1024)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        to_plain(md)
+        best = min(best, time.perf_counter() - start)
+    return megabytes / best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark markdown to plain text conversion."
+    )
+    parser.add_argument("-s", "--size-mb", type=float, default=8.0,
+                        help="Size of the generated document in MB")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(f"to_plain: {bench(args.size_mb, args.repeat):.1f} MB/s "
+          f"on {args.size_mb} MB")
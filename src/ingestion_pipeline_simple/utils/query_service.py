@@ -0,0 +1,365 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, NamedTuple, Sequence
+
+import numpy as np
+
+from . import ann_index, db_utils, embedding
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Query results kept, and for how long. The TTL bounds how long a result
+# can miss a document that would newly enter it, which invalidation by
+# bucket key cannot see; keep it well under the change feed's retention.
+CACHE_SIZE = int(os.environ.get("INGESTION_QUERY_CACHE_SIZE", "1024"))
+CACHE_TTL_S = float(os.environ.get("INGESTION_QUERY_CACHE_TTL_S", "300"))
+# How often queries look at the change feed for re-materialized documents
+REFRESH_SECONDS = 0.5
+# Stages whose changes alter what a query over a document returns; the
+# chunk vectors reach the ANN index in `relationships`, and "deleted"
+# (`resources.DELETED_STAGE`) marks documents purged outright
+QUERY_STAGES = frozenset({"chunks", "vec_embeddings", "relationships",
+                          "deleted"})
+# Each ranking contributes this many candidates per requested hit
+CANDIDATE_FACTOR = 4
+# Reciprocal rank fusion constant: larger flattens the rank weights
+RRF_K = 60
+SNIPPET_CHARS = 160
+MODES = ("hybrid", "vector", "keyword")
+
+
+class QueryHit(NamedTuple):
+    """A chunk in fused results, best first.
+
+    `score` is the fused score; `vector_score` (cosine) and
+    `keyword_score` (negated BM25) are None for chunks the ranking did
+    not return. Offsets are as in `db_utils.SearchHit`.
+    """
+    doc_key: str
+    idx: int
+    start: int
+    end: int
+    md_start: int | None
+    md_end: int | None
+    score: float
+    vector_score: float | None
+    keyword_score: float | None
+    snippet: str
+
+
+def fuse(rankings: Sequence[Sequence[Hashable]],
+         k: int = RRF_K) -> list[tuple[Hashable, float]]:
+    """Reciprocal rank fusion: items by the sum of `1 / (k + rank)`.
+
+    Scores of different rankings (cosine, BM25) are not comparable, so
+    only the ranks are used. Ties keep the order items were first seen.
+    """
+    scores: dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda kv: -kv[1])
+
+
+class ResultCache:
+    """An LRU cache of query results with a TTL and per-key invalidation.
+
+    Each entry remembers the bucket keys its result holds, and
+    `invalidate` drops the entries holding any of the given keys. A
+    result computed while an invalidation ran may predate it, so `put`
+    takes the `token` from before the computation and discards results
+    that raced an invalidation.
+    """
+
+    def __init__(self,
+                 maxsize: int = CACHE_SIZE,
+                 ttl_s: float = CACHE_TTL_S,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[
+            Hashable, tuple[float, Any, frozenset[str]]
+        ] = OrderedDict()
+        self._by_key: dict[str, set[Hashable]] = {}
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def token(self) -> int:
+        return self._invalidations
+
+    def get(self, query: Hashable) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is not None and entry[0] <= self.clock():
+                self._remove(query)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(query)
+            self.hits += 1
+            return entry[1]
+
+    def put(self,
+            query: Hashable,
+            value: Any,
+            bucket_keys: Iterable[str],
+            token: int) -> bool:
+        """Cache `value` unless an invalidation ran since `token`."""
+        bucket_keys = frozenset(bucket_keys)
+        with self._lock:
+            if token != self._invalidations or self.maxsize <= 0:
+                return False
+            self._remove(query)
+            self._entries[query] = (self.clock() + self.ttl_s, value,
+                                    bucket_keys)
+            for bucket_key in bucket_keys:
+                self._by_key.setdefault(bucket_key, set()).add(query)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+            return True
+
+    def invalidate(self, bucket_keys: Iterable[str]) -> int:
+        """Drop results holding any of `bucket_keys`; return how many."""
+        with self._lock:
+            self._invalidations += 1
+            queries = set()
+            for bucket_key in bucket_keys:
+                queries |= self._by_key.get(bucket_key, set())
+            for query in queries:
+                self._remove(query)
+            return len(queries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+            self._by_key.clear()
+
+    def _remove(self, query: Hashable) -> None:
+        entry = self._entries.pop(query, None)
+        if entry is None:
+            return
+        for bucket_key in entry[2]:
+            queries = self._by_key[bucket_key]
+            queries.discard(query)
+            if not queries:
+                del self._by_key[bucket_key]
+
+
+class QueryService:
+    """Hybrid chunk retrieval over what the pipeline ingested.
+
+    A query is embedded with the embedder `vec_embeddings` used (pass the
+    same `embedder` and `dim`) and searched in the `chunks` ANN index,
+    whose vectors are held in memory, while the same text is searched in
+    the `chunks_fts` keyword index; the two rankings are fused. Results
+    are cached, and each query first drops cached results holding
+    documents that the pipeline, in this process or any other, has
+    re-materialized since (see `stage_changes`).
+
+    Only reads are made, which WAL mode never blocks, so queries go on
+    while ingestion holds the write lock.
+    """
+
+    def __init__(self,
+                 db: Any,
+                 embedder: str = "hashing",
+                 dim: int = embedding.EMBED_DIM,
+                 nprobe: int = ann_index.NPROBE,
+                 cache_size: int = CACHE_SIZE,
+                 cache_ttl_s: float = CACHE_TTL_S,
+                 refresh_seconds: float = REFRESH_SECONDS) -> None:
+        self.db = db
+        self.embedder = embedding.get_embedder(embedder, dim=dim)
+        self.index = ann_index.IVFIndex(db, db.ann_dir, "chunks",
+                                        self.embedder.dim, resident=True)
+        self.nprobe = nprobe
+        self.cache = ResultCache(cache_size, cache_ttl_s)
+        self.refresh_seconds = refresh_seconds
+        self._seq = db.last_change_seq()
+        self._refreshed_at = time.monotonic()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self) -> int:
+        """Invalidate results of documents changed since the last call.
+
+        Returns how many cached results were dropped.
+        """
+        with self._refresh_lock:
+            self._refreshed_at = time.monotonic()
+            changes = self.db.stage_changes(self._seq)
+            if not changes:
+                return 0
+            if changes[0][0] > self._seq + 1:
+                # Pruned before we saw them; anything may have changed
+                logger.warning("Query cache fell behind the change feed")
+                dropped = len(self.cache)
+                self.cache.clear()
+            else:
+                dropped = self.cache.invalidate({
+                    bucket_key for _, stage, bucket_key in changes
+                    if stage in QUERY_STAGES
+                })
+            self._seq = changes[-1][0]
+            return dropped
+
+    def vector_search(self,
+                      query: str,
+                      k: int = 10,
+                      prefix: str = "") -> list[ann_index.Hit]:
+        """The `k` chunks nearest the embedded query, under `prefix`."""
+        vector = embedding.normalize(self.embedder.embed([query]))
+        # The index cannot filter by key; ask for more and filter here
+        depth = k if not prefix else k * CANDIDATE_FACTOR
+        hits = self.index.search(vector, depth, self.nprobe)[0]
+        return [hit for hit in hits if hit.doc_key.startswith(prefix)][:k]
+
+    def keyword_search(self,
+                       query: str,
+                       k: int = 10,
+                       prefix: str = "") -> list[db_utils.SearchHit]:
+        return self.db.search_chunks(query, k, prefix)
+
+    def search(self,
+               query: str,
+               k: int = 10,
+               prefix: str = "",
+               mode: str = "hybrid") -> list[QueryHit]:
+        """The `k` best chunks for free-text `query`, fused by rank.
+
+        `mode` is one of MODES; "vector" and "keyword" return a single
+        ranking, in the same form.
+        """
+        assert mode in MODES, f"Error: Unknown mode ({mode}), expected {MODES}"
+        if time.monotonic() - self._refreshed_at >= self.refresh_seconds:
+            self.refresh()
+        cache_key = (query, k, prefix, mode)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+        token = self.cache.token()
+
+        depth = k * CANDIDATE_FACTOR if mode == "hybrid" else k
+        vector_hits = [] if mode == "keyword" \
+            else self.vector_search(query, depth, prefix)
+        keyword_hits = [] if mode == "vector" \
+            else self.keyword_search(query, depth, prefix)
+        vector_scores = {(hit.doc_key, hit.idx): hit.score
+                         for hit in vector_hits}
+        keywords = {(hit.doc_key, hit.idx): hit for hit in keyword_hits}
+        fused = fuse([list(vector_scores), list(keywords)])[:k]
+
+        chunks = self.db.get_chunks(item for item, _ in fused)
+        hits = []
+        for (doc_key, idx), score in fused:
+            if (doc_key, idx) not in chunks:
+                # Removed since the index was read
+                continue
+            start, end, md_start, md_end, text = chunks[doc_key, idx]
+            keyword = keywords.get((doc_key, idx))
+            hits.append(QueryHit(
+                doc_key, idx, start, end, md_start, md_end, score,
+                vector_scores.get((doc_key, idx)),
+                None if keyword is None else keyword.score,
+                text[:SNIPPET_CHARS] if keyword is None else keyword.snippet,
+            ))
+        self.cache.put(cache_key, hits, {hit.doc_key for hit in hits}, token)
+        return hits
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "cached": len(self.cache),
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "change_seq": self._seq,
+        }
+
+
+def serve(service: QueryService, host: str, port: int) -> None:
+    """Answer `GET /search?q=...&k=&prefix=&mode=` and `GET /stats` as
+    JSON, one thread per request, until interrupted."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            url = urlparse(self.path)
+            params = {name: values[-1]
+                      for name, values in parse_qs(url.query).items()}
+            if url.path == "/stats":
+                self._reply(200, service.stats())
+            elif url.path == "/search" and params.get("q"):
+                start = time.perf_counter()
+                try:
+                    hits = service.search(params["q"],
+                                          int(params.get("k", 10)),
+                                          params.get("prefix", ""),
+                                          params.get("mode", "hybrid"))
+                except (AssertionError, ValueError) as exc:
+                    self._reply(400, {"error": str(exc)})
+                    return
+                self._reply(200, {
+                    "hits": [hit._asdict() for hit in hits],
+                    "elapsed_ms": (time.perf_counter() - start) * 1000,
+                })
+            else:
+                self._reply(404, {"error": "Expected /search?q=... or /stats"})
+
+        def _reply(self, status: int, body: dict[str, Any]) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    logger.info(f"Query service on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    from ..defs import resources
+
+    parser = argparse.ArgumentParser(
+        description="Hybrid vector and keyword search over ingested chunks."
+    )
+    parser.add_argument("--db", type=str, default="database/dummy.db")
+    parser.add_argument("--embedder", type=str, default="hashing")
+    parser.add_argument("--dim", type=int, default=embedding.EMBED_DIM)
+    parser.add_argument("-q", "--query", type=str, default="",
+                        help="Run one query and print the hits")
+    parser.add_argument("-k", "--limit", type=int, default=10)
+    parser.add_argument("-p", "--prefix", type=str, default="")
+    parser.add_argument("-m", "--mode", type=str, default="hybrid",
+                        choices=MODES)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    opt = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    service = QueryService(resources.SQLiteResource(db_path=opt.db),
+                           opt.embedder, opt.dim)
+    if opt.query:
+        for hit in service.search(opt.query, opt.limit, opt.prefix, opt.mode):
+            print(json.dumps(hit._asdict()))
+    else:
+        serve(service, opt.host, opt.port)
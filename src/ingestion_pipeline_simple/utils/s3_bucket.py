@@ -0,0 +1,251 @@
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterable
+from urllib.parse import quote
+
+import boto3
+from botocore.config import Config
+
+from .scan_index import Database
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Objects are fetched as parallel ranged GETs of this size
+PART_SIZE = 8 * 1024 * 1024
+FETCH_WORKERS = 8
+# Shared by listing and fetching threads; sized for FETCH_WORKERS across
+# a few concurrent fetches
+MAX_POOL_CONNECTIONS = 32
+# ListObjectsV2 returns up to 1000 keys a page; a tick stops after this
+# many pages and resumes from the saved continuation token next tick
+MAX_PAGES_PER_TICK = 10
+_COPY_SIZE = 1024 * 1024
+
+_CLIENTS: dict[tuple[int, str | None, str], Any] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(endpoint_url: str | None = None,
+               region_name: str = "us-east-1") -> Any:
+    """Return this process's shared S3 client for an endpoint.
+
+    boto3 clients are thread safe; sharing one keeps a single pool of
+    keep-alive HTTP connections instead of a handshake per request.
+    """
+    key = (os.getpid(), endpoint_url, region_name)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = _CLIENTS[key] = boto3.client(
+                "s3",
+                endpoint_url=endpoint_url,
+                region_name=region_name,
+                config=Config(
+                    max_pool_connections=MAX_POOL_CONNECTIONS,
+                    retries={"mode": "adaptive", "max_attempts": 5},
+                ),
+            )
+        return client
+
+
+def parse_uri(uri: str) -> tuple[str, str]:
+    """Split `s3://bucket/key` into its bucket and key."""
+    assert uri.startswith("s3://"), f"Error: Not an S3 URI ({uri})"
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+
+@dataclass
+class S3Object:
+    key: str
+    etag: str
+    size: int
+
+
+@dataclass
+class S3Delta:
+    added: list[S3Object]
+    changed: list[S3Object]
+    deleted: list[str]
+    # Where the next tick resumes; None once a listing pass is complete
+    token: str | None
+    generation: int
+
+
+def list_changes(db: Database,
+                 client: Any,
+                 bucket: str,
+                 prefix: str,
+                 token: str | None = None,
+                 generation: int = 1,
+                 max_pages: int = MAX_PAGES_PER_TICK,
+                 page_size: int = 1000) -> S3Delta:
+    """List up to `max_pages` pages and diff them against `s3_objects`.
+
+    Every object seen in a listing pass is stamped with the pass's
+    `generation`. When a pass reaches the last page, objects still on an
+    older generation were not listed and are reported deleted, and the
+    returned generation moves on for the next pass. Changes are detected
+    by ETag.
+    """
+    delta = S3Delta(added=[], changed=[], deleted=[],
+                    token=token, generation=generation)
+    for _ in range(max_pages):
+        kwargs: dict[str, Any] = dict(
+            Bucket=bucket,
+            Prefix=prefix,
+            MaxKeys=page_size
+        )
+        if delta.token:
+            kwargs["ContinuationToken"] = delta.token
+        page = client.list_objects_v2(**kwargs)
+        objects = [
+            S3Object(
+                key=obj["Key"],
+                etag=obj["ETag"].strip('"'),
+                size=obj["Size"],
+            )
+            for obj in page.get("Contents", [])
+            if not obj["Key"].endswith("/")
+        ]
+
+        with db.transaction() as conn:
+            stored: dict[str, str] = {}
+            for pos in range(0, len(objects), 500):
+                batch = [obj.key for obj in objects[pos:pos+500]]
+                stored.update(conn.execute(
+                    f"""
+                    SELECT key, etag FROM s3_objects
+                    WHERE bucket=? AND key IN ({','.join('?' * len(batch))})
+                    """,
+                    (bucket, *batch)
+                ).fetchall())
+            for obj in objects:
+                if obj.key not in stored:
+                    delta.added.append(obj)
+                elif stored[obj.key] != obj.etag:
+                    delta.changed.append(obj)
+            conn.executemany(
+                """
+                INSERT INTO s3_objects (bucket, key, etag, size, generation)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(bucket, key) DO UPDATE SET
+                    etag=excluded.etag,
+                    size=excluded.size,
+                    generation=excluded.generation
+                """,
+                (
+                    (bucket, obj.key, obj.etag, obj.size, generation)
+                    for obj in objects
+                )
+            )
+
+            if page.get("IsTruncated"):
+                delta.token = page["NextContinuationToken"]
+                continue
+
+            # The pass is complete: anything not re-stamped is gone
+            delta.deleted = [
+                key for (key,) in conn.execute(
+                    """
+                    SELECT key FROM s3_objects
+                    WHERE bucket=? AND substr(key, 1, ?)=? AND generation<?
+                    """,
+                    (bucket, len(prefix), prefix, generation)
+                )
+            ]
+            conn.executemany(
+                "DELETE FROM s3_objects WHERE bucket=? AND key=?",
+                ((bucket, key) for key in delta.deleted)
+            )
+        delta.token = None
+        delta.generation = generation + 1
+        break
+    return delta
+
+
+def _fetch_range(client: Any,
+                 bucket: str,
+                 key: str,
+                 etag: str,
+                 dest: Path,
+                 start: int,
+                 end: int) -> None:
+    body = client.get_object(
+        Bucket=bucket,
+        Key=key,
+        Range=f"bytes={start}-{end}",
+        # Fail rather than stitch together parts of two object versions
+        IfMatch=etag,
+    )["Body"]
+    with open(dest, "r+b") as f:
+        f.seek(start)
+        while chunk := body.read(_COPY_SIZE):
+            f.write(chunk)
+
+
+def _spool_dir(spool_dir: str | Path, bucket: str, key: str) -> Path:
+    # One directory per key holding a subdirectory per spooled ETag
+    return Path(spool_dir, bucket, quote(key, safe=""))
+
+
+def fetch(client: Any,
+          bucket: str,
+          key: str,
+          spool_dir: str | Path,
+          part_size: int = PART_SIZE,
+          workers: int = FETCH_WORKERS) -> Path:
+    """Download an object into the local spool and return its path.
+
+    Objects are spooled under their ETag, so a re-fetch of unchanged
+    content is free and a changed object never reads a stale copy. The
+    object is split into `part_size` ranges fetched concurrently straight
+    into their offsets of a pre-sized file. Once a new ETag is spooled,
+    the copies of the key's older ones are deleted.
+    """
+    head = client.head_object(Bucket=bucket, Key=key)
+    etag: str = head["ETag"].strip('"')
+    size: int = head["ContentLength"]
+    key_dir = _spool_dir(spool_dir, bucket, key)
+    dest = key_dir / etag / os.path.basename(key)
+    if dest.exists():
+        return dest
+
+    os.makedirs(dest.parent, exist_ok=True)
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}.part")
+    with open(tmp, "wb") as f:
+        f.truncate(size)
+    ranges = [
+        (start, min(start + part_size, size) - 1)
+        for start in range(0, size, part_size)
+    ]
+    try:
+        with ThreadPoolExecutor(max_workers=min(workers, len(ranges) or 1)) as pool:
+            list(pool.map(
+                lambda r: _fetch_range(client, bucket, key, etag, tmp, *r),
+                ranges
+            ))
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, dest)
+    for entry in key_dir.iterdir():
+        if entry.name != etag:
+            shutil.rmtree(entry, ignore_errors=True)
+    return dest
+
+
+def evict(spool_dir: str | Path, bucket: str, keys: Iterable[str]) -> int:
+    """Delete every spooled copy of the keys; return how many had one."""
+    evicted = 0
+    for key in keys:
+        key_dir = _spool_dir(spool_dir, bucket, key)
+        if key_dir.exists():
+            shutil.rmtree(key_dir, ignore_errors=True)
+            evicted += 1
+    return evicted
@@ -0,0 +1,215 @@
+import os
+from contextlib import AbstractContextManager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Protocol
+import sqlite3
+
+from . import hashing
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Database(Protocol):
+    """Anything handing out pooled connections, e.g. `SQLiteResource`."""
+    def connection(self) -> AbstractContextManager[sqlite3.Connection]: ...
+    def transaction(self) -> AbstractContextManager[sqlite3.Connection]: ...
+
+
+@dataclass
+class ScanEntry:
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+    digest: str | None = None
+
+
+@dataclass
+class ScanDelta:
+    added: list[ScanEntry]
+    changed: list[ScanEntry]
+    deleted: list[str]
+    dirs_listed: int = 0
+    dirs_pruned: int = 0
+
+
+def _stat_entry(entry: os.DirEntry) -> ScanEntry:
+    st = entry.stat(follow_symlinks=False)
+    return ScanEntry(
+        path=entry.path,
+        size=st.st_size,
+        mtime_ns=st.st_mtime_ns,
+        inode=entry.inode(),
+    )
+
+
+def _digest(entry: ScanEntry) -> str | None:
+    try:
+        return hashing.file_digest(entry.path)
+    except FileNotFoundError:
+        # Removed between listing and hashing; the next tick sees it gone
+        return None
+
+
+def _under(path: str, root: str) -> bool:
+    return path == root or path.startswith(root + os.sep)
+
+
+def scan(db: Database,
+         root: str | Path,
+         full: bool = False,
+         compute_digests: bool = False) -> ScanDelta:
+    """Update the persisted index of files under `root` and diff it.
+
+    A directory's mtime changes whenever an entry is added, removed or
+    renamed in it, so directories whose mtime matches the index are not
+    listed again; only their known subdirectories are visited. The cost
+    of a tick is therefore one stat per directory plus one listing per
+    directory that actually changed.
+
+    Rewriting a file in place does not touch its directory's mtime, so
+    those edits are only seen by a `full` scan, which lists everything.
+    A file changed if its size/mtime/inode moved. With `compute_digests`
+    new and moved files are also read and hashed, and those whose digest
+    did not move (e.g. a `touch`) are not reported as changed; that reads
+    every new byte, so the sensor leaves hashing to `binary_files`.
+    """
+    root = str(root)
+    if not os.path.isdir(root):
+        # A missing root is far more likely an unmounted volume than a
+        # deleted bucket; report nothing rather than deleting everything
+        logger.warning(f"Scan root {root} does not exist")
+        return ScanDelta(added=[], changed=[], deleted=[])
+
+    with db.connection() as conn:
+        stored_dirs: dict[str, int] = {}
+        children: dict[str, list[str]] = {}
+        for path, parent, mtime_ns in conn.execute(
+            "SELECT path, parent, mtime_ns FROM scan_dirs"
+        ):
+            if not _under(path, root):
+                continue
+            stored_dirs[path] = mtime_ns
+            children.setdefault(parent, []).append(path)
+
+        delta = ScanDelta(added=[], changed=[], deleted=[])
+        dir_rows: list[tuple[str, str, int]] = []
+        file_rows: list[ScanEntry] = []
+        removed_dirs: list[str] = []
+
+        stack = [root]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                # Taken before listing, so a change made while we list
+                # leaves a stale mtime and is picked up next tick
+                mtime_ns = os.stat(dirpath).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if not full and stored_dirs.get(dirpath) == mtime_ns:
+                delta.dirs_pruned += 1
+                stack.extend(children.get(dirpath, ()))
+                continue
+
+            delta.dirs_listed += 1
+            listed: dict[str, ScanEntry] = {}
+            subdirs: list[str] = []
+            try:
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            listed[entry.path] = _stat_entry(entry)
+            except FileNotFoundError:
+                continue
+
+            stored_files = {
+                row[0]: ScanEntry(*row)
+                for row in conn.execute(
+                    """
+                    SELECT path, size, mtime_ns, inode, digest
+                    FROM scan_files WHERE dir=?
+                    """,
+                    (dirpath,)
+                )
+            }
+            for path, entry in listed.items():
+                old = stored_files.get(path)
+                if old is not None and (old.size, old.mtime_ns, old.inode) \
+                        == (entry.size, entry.mtime_ns, entry.inode):
+                    continue
+                if compute_digests:
+                    entry.digest = _digest(entry)
+                    if entry.digest is None:
+                        continue
+                file_rows.append(entry)
+                if old is None:
+                    delta.added.append(entry)
+                elif not compute_digests or old.digest != entry.digest:
+                    delta.changed.append(entry)
+            delta.deleted.extend(
+                path for path in stored_files if path not in listed
+            )
+
+            parent = os.path.dirname(dirpath) if dirpath != root else ""
+            dir_rows.append((dirpath, parent, mtime_ns))
+            gone = set(children.get(dirpath, ())) - set(subdirs)
+            removed_dirs.extend(gone)
+            stack.extend(subdirs)
+
+        for dirpath in removed_dirs:
+            delta.deleted.extend(
+                path for (path,) in conn.execute(
+                    """
+                    SELECT path FROM scan_files
+                    WHERE dir=? OR substr(dir, 1, ?)=?
+                    """,
+                    (dirpath, len(dirpath) + 1, dirpath + os.sep)
+                )
+            )
+
+    # Hashing happened outside any transaction; the write lock is only
+    # held for the short bulk update below
+    with db.transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO scan_files (path, dir, size, mtime_ns, inode, digest)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                size=excluded.size,
+                mtime_ns=excluded.mtime_ns,
+                inode=excluded.inode,
+                digest=excluded.digest
+            """,
+            (
+                (e.path, os.path.dirname(e.path), e.size,
+                 e.mtime_ns, e.inode, e.digest)
+                for e in file_rows
+            )
+        )
+        conn.executemany(
+            "DELETE FROM scan_files WHERE path=?",
+            ((path,) for path in delta.deleted)
+        )
+        conn.executemany(
+            """
+            DELETE FROM scan_dirs WHERE path=? OR substr(path, 1, ?)=?
+            """,
+            (
+                (dirpath, len(dirpath) + 1, dirpath + os.sep)
+                for dirpath in removed_dirs
+            )
+        )
+        conn.executemany(
+            """
+            INSERT INTO scan_dirs (path, parent, mtime_ns) VALUES (?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                parent=excluded.parent,
+                mtime_ns=excluded.mtime_ns
+            """,
+            dir_rows
+        )
+    return delta
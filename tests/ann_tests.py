@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from ingestion_pipeline_simple.defs import resources
+from ingestion_pipeline_simple.utils import ann_index, db_utils
+
+DIM = 32
+
+
+@pytest.fixture
+def db(tmp_path: Path):
+    db_path = tmp_path / "test.db"
+    db_utils.init_db(str(db_path))
+    yield resources.SQLiteResource(db_path=str(db_path))
+    db_utils.get_pool(db_path).close()
+
+
+def _unit(rng: np.random.Generator, n: int) -> np.ndarray:
+    vectors = rng.standard_normal((n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _clustered(rng: np.random.Generator, n: int) -> np.ndarray:
+    centres = _unit(rng, 20)
+    noise = 0.1 * rng.standard_normal((n, DIM)).astype(np.float32)
+    vectors = centres[rng.integers(0, len(centres), n)] + noise
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_exact_when_small(db: resources.SQLiteResource, tmp_path: Path):
+    rng = np.random.default_rng(1)
+    vectors = _unit(rng, 50)
+    index = ann_index.IVFIndex(db, tmp_path / "ann", "chunks", DIM)
+    index.add([("doc", idx) for idx in range(50)], vectors)
+    hits = index.search(vectors[:5], k=3)
+    assert [h[0].idx for h in hits] == list(range(5))
+    assert hits[0][0].score == pytest.approx(1.0, abs=1e-5)
+    assert all(a.score >= b.score for a, b in zip(hits[0], hits[0][1:]))
+
+
+def test_recall(db: resources.SQLiteResource, tmp_path: Path):
+    rng = np.random.default_rng(2)
+    vectors = _clustered(rng, 3000)
+    index = ann_index.IVFIndex(db, tmp_path / "ann", "chunks", DIM)
+    # Added in batches so training and retraining both happen
+    for pos in range(0, len(vectors), 500):
+        index.add(
+            [(f"doc{idx}", 0) for idx in range(pos, pos + 500)],
+            vectors[pos:pos+500]
+        )
+    assert len(index) == len(vectors)
+
+    queries = _clustered(rng, 50)
+    exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :10]
+    hits = index.search(queries, k=10, nprobe=8)
+    recall = np.mean([
+        len({int(h.doc_key[3:]) for h in found} & set(truth)) / 10
+        for found, truth in zip(hits, exact.tolist())
+    ])
+    assert recall >= 0.9
+
+
+def test_replace_and_remove(db: resources.SQLiteResource, tmp_path: Path):
+    rng = np.random.default_rng(3)
+    vectors = _unit(rng, 4)
+    index = ann_index.IVFIndex(db, tmp_path / "ann", "docs", DIM)
+    index.add([("a", 0), ("b", 0)], vectors[:2])
+    index.add([("a", 0)], vectors[2:3])
+    assert len(index) == 2
+    [[top, *_]] = index.search(vectors[2:3], k=2)
+    assert (top.doc_key, round(top.score, 4)) == ("a", 1.0)
+
+    index.remove(["a"])
+    assert [h.doc_key for h in index.search(vectors[2:3], k=2)[0]] == ["b"]
+
+
+def test_compacts_removed_rows(db: resources.SQLiteResource, tmp_path: Path):
+    rng = np.random.default_rng(4)
+    root = tmp_path / "ann"
+    index = ann_index.IVFIndex(db, root, "docs", DIM)
+    for _ in range(3):
+        index.add([(f"doc{idx}", 0) for idx in range(300)], _unit(rng, 300))
+    files = list(root.glob("docs.*.f32"))
+    assert len(files) == 1
+    assert files[0].stat().st_size <= 2 * 300 * DIM * 4
+
+
+def test_keeps_later_generations(db: resources.SQLiteResource,
+                                 tmp_path: Path):
+    rng = np.random.default_rng(7)
+    root = tmp_path / "ann"
+    index = ann_index.IVFIndex(db, root, "docs", DIM)
+    index.add([("a", 0)], _unit(rng, 1))
+    [path] = root.glob("docs.*.f32")
+    # Another writer rebuilt to a later generation after this one's
+    # commit; neither an append nor a late cleanup may remove its file
+    later = root / "docs.99.f32"
+    later.write_bytes(b"")
+    index.add([("b", 0)], _unit(rng, 1))
+    index._drop_old_files(int(path.name.split(".")[1]))
+    assert later.exists() and path.exists()
+    index._drop_old_files(99)
+    assert not path.exists() and later.exists()
+
+def test_compact_after_removals(db: resources.SQLiteResource,
+                                tmp_path: Path):
+    rng = np.random.default_rng(6)
+    root = tmp_path / "ann"
+    index = ann_index.IVFIndex(db, root, "docs", DIM)
+    vectors = _unit(rng, 1200)
+    index.add([(f"doc{idx}", 0) for idx in range(1200)], vectors)
+    # Removing leaves the rows in the file until compacted
+    index.remove([f"doc{idx}" for idx in range(1000)])
+    assert index.compact()
+    [path] = root.glob("docs.*.f32")
+    assert path.stat().st_size == 200 * DIM * 4
+    assert not index.compact()
+    [[top]] = index.search(vectors[1100:1101], k=1)
+    assert top.doc_key == "doc1100"
+
+
+def test_dim_change_resets(db: resources.SQLiteResource, tmp_path: Path):
+    rng = np.random.default_rng(5)
+    ann_index.IVFIndex(db, tmp_path / "ann", "docs", DIM).add(
+        [("a", 0)], _unit(rng, 1)
+    )
+    index = ann_index.IVFIndex(db, tmp_path / "ann", "docs", 8)
+    assert index.search(np.ones(8), k=1) == [[]]
+    index.add([("b", 0)], np.eye(1, 8, dtype=np.float32))
+    assert len(index) == 1
+
+
+def test_resident_follows_writer(db: resources.SQLiteResource,
+                                 tmp_path: Path):
+    rng = np.random.default_rng(6)
+    vectors = _unit(rng, 600)
+    writer = ann_index.IVFIndex(db, tmp_path / "ann", "chunks", DIM)
+    reader = ann_index.IVFIndex(db, tmp_path / "ann", "chunks", DIM,
+                                resident=True)
+    writer.add([("a", idx) for idx in range(100)], vectors[:100])
+    assert reader.search(vectors[99], k=1)[0][0].idx == 99
+    # Appended rows are read on the next search, a rebuild's file whole
+    writer.add([("b", idx) for idx in range(100)], vectors[100:200])
+    assert reader.search(vectors[150], k=1)[0][0][:2] == ("b", 50)
+    writer.add([("c", idx) for idx in range(400)], vectors[200:])
+    assert reader.search(vectors[500], k=1)[0][0][:2] == ("c", 300)
+    assert reader.search(vectors[5], k=1)[0][0][:2] == ("a", 5)
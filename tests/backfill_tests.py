@@ -0,0 +1,81 @@
+import pytest
+from pathlib import Path
+from ingestion_pipeline_simple.defs import resources
+from ingestion_pipeline_simple.utils import backfill
+
+
+def _bucket(tmp_path: Path) -> tuple[resources.SQLiteResource, dict[str, str]]:
+    files_dir = tmp_path / "bucket" / "org" / "usr"
+    files_dir.mkdir(parents=True)
+    file_paths = {}
+    for idx, name in enumerate(["a.bin", "b.bin", "c.bin", "d.docx"]):
+        path = files_dir / name
+        path.write_text(f"Hello World {idx}!", encoding="utf-8")
+        file_paths[f"/org/usr/{name}"] = str(path)
+    db = resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
+    # Known to the database, as after an earlier ingest
+    db.put_stages("file_path", file_paths.items())
+    return db, file_paths
+
+
+def test_plan():
+    keys = ["a", "b", "c", "d", "e"]
+    assert backfill.plan(keys, 2) == [["a", "b"], ["c", "d"], ["e"]]
+    # Runs are key ranges, so only neighbours in the partition order mix
+    order = ["a", "x", "b", "c", "d", "y", "e"]
+    assert backfill.plan(keys, 3, order) == [["a"], ["b", "c", "d"], ["e"]]
+
+
+def test_select(tmp_path: Path):
+    db, file_paths = _bucket(tmp_path)
+    assert [key for key, _ in backfill.select(db)] == sorted(file_paths)
+    assert [key for key, _ in backfill.select(db, file_types=["docx"])] \
+        == ["/org/usr/d.docx"]
+    assert backfill.select(db, prefix="/org/usr/b") \
+        == [("/org/usr/b.bin", file_paths["/org/usr/b.bin"])]
+    # Nothing has run yet, so everything is stale
+    assert len(backfill.select(db, stale="chunks")) == 4
+
+
+def test_backfill_resumes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    db, file_paths = _bucket(tmp_path)
+    target = backfill.Target(
+        db_path=db.db_path,
+        bucket_path=str(tmp_path / "bucket"),
+        store_root=str(tmp_path / "store"),
+    )
+    assert backfill.start(db, "all", target, file_types=["bin"]) == 3
+    with pytest.raises(AssertionError):
+        backfill.start(db, "all", target)
+
+    # The second run dies: its key is checkpointed as failed
+    run_batch = backfill._run_batch
+    calls = []
+
+    def flaky(target, batch, persist):
+        calls.append([key for key, _ in batch])
+        if len(calls) == 2:
+            return [key for key, _ in batch], "Run failed"
+        return run_batch(target, batch, persist)
+
+    monkeypatch.setattr(backfill, "_run_batch", flaky)
+    counts = backfill.run(db, "all", batch_size=2, workers=1)
+    assert counts == {"done": 2, "failed": 1}
+    assert db.get_backfill("all")["finished_at"] is None
+
+    # Resuming only runs what is left, here in a worker process, which
+    # logs to ./logs like the code location does
+    monkeypatch.setattr(backfill, "_run_batch", run_batch)
+    monkeypatch.chdir(tmp_path)
+    assert backfill.run(db, "all", batch_size=2, workers=2) == {"done": 3}
+    assert db.get_backfill("all")["finished_at"] is not None
+    assert backfill.run(db, "all", workers=1) == {"done": 3}
+
+    bin_keys = sorted(key for key in file_paths if key.endswith(".bin"))
+    assert sorted(db.get_stage_versions("relationships", file_paths)) \
+        == bin_keys
+    # Up to date, until the embedder changes
+    assert backfill.select(db, file_types=["bin"], stale="vec_embeddings") \
+        == []
+    assert len(backfill.select(db, file_types=["bin"], stale="vec_embeddings",
+                               op_config={"dim": 64})) == 3
@@ -0,0 +1,88 @@
+import dataclasses
+import os
+import pytest
+from pathlib import Path
+from docx import Document
+from ingestion_pipeline_simple.utils import benchmark, handle_files
+
+
+def _texts(files: list[str]) -> list[tuple[str, list[str]]]:
+    return [
+        (Path(path).name,
+         [para.text for para in Document(path).paragraphs])
+        for path in files
+    ]
+
+
+def test_corpus_is_reproducible(tmp_path: Path):
+    args = dict(num_docs=4, seed=7, mix="small:0.5,medium:0.5")
+    first = handle_files.make_corpus(str(tmp_path / "a"), **args)
+    second = handle_files.make_corpus(str(tmp_path / "b"), **args)
+    assert len(first) == 4
+    assert _texts(first) == _texts(second)
+    other = handle_files.make_corpus(str(tmp_path / "c"), 4, seed=8)
+    assert _texts(other) != _texts(first)
+
+    # An existing corpus with the same parameters is reused as is
+    mtimes = [os.stat(path).st_mtime_ns for path in first]
+    assert handle_files.make_corpus(str(tmp_path / "a"), **args) == first
+    assert [os.stat(path).st_mtime_ns for path in first] == mtimes
+
+
+def test_corpus_only_replaces_its_own_files(tmp_path: Path):
+    corpus = tmp_path / "corpus"
+    old = handle_files.make_corpus(str(corpus), 2, seed=1)
+    (corpus / "mine.docx").write_text("not generated", encoding="utf-8")
+    new = handle_files.make_corpus(str(corpus), 2, seed=2)
+    assert not any(os.path.exists(path) for path in old)
+    assert all(os.path.exists(path) for path in new)
+    assert (corpus / "mine.docx").exists()
+
+    # A directory holding anything but a corpus is left alone
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "report.pdf").write_text("x", encoding="utf-8")
+    with pytest.raises(AssertionError):
+        handle_files.make_corpus(str(tmp_path / "docs"), 2, seed=1)
+    assert os.listdir(tmp_path / "docs") == ["report.pdf"]
+
+def test_run_and_compare(tmp_path: Path):
+    corpus = tmp_path / "corpus"
+    handle_files.make_corpus(str(corpus), 3, seed=1)
+    result = benchmark.run(corpus, batch_size=2, work_dir=str(tmp_path))
+    assert result.docs == 3
+    assert result.docs_per_s > 0 and result.peak_rss_bytes > 0
+    assert result.stages["markdown_files"].samples == 2
+    assert set(result.stages) == {
+        "binary_files", "markdown_files", "json_files", "plain_files",
+        "chunks", "vec_embeddings", "relationships",
+    }
+    assert benchmark.BenchResult.from_json(result.to_json()) == result
+
+    assert benchmark.compare(result, result) == []
+    faster = dataclasses.replace(
+        result,
+        docs_per_s=result.docs_per_s * 2,
+        stages={
+            **result.stages,
+            "chunks": dataclasses.replace(result.stages["chunks"],
+                                          p99_s=0.0),
+        },
+    )
+    regressions = benchmark.compare(result, faster)
+    assert any(r.startswith("docs_per_s") for r in regressions)
+    assert any(r.startswith("chunks p99_s") for r in regressions) \
+        == (result.stages["chunks"].p99_s > benchmark.LATENCY_SLACK_S)
+
+
+def test_percentile():
+    values = [float(v) for v in range(1, 101)]
+    assert benchmark.percentile(values, 50) == 50.0
+    assert benchmark.percentile(values, 99) == 99.0
+    assert benchmark.percentile([3.0], 99) == 3.0
+
+
+def test_startup_skips_lazy_modules(tmp_path: Path):
+    for module in benchmark.STARTUP_MODULES:
+        res = benchmark.import_time(module, repeat=1, cwd=str(tmp_path))
+        assert res.lazy_loaded == []
+        assert res.seconds >= res.dagster_s > 0
@@ -0,0 +1,61 @@
+import pytest
+from ingestion_pipeline_simple.utils import chunking
+
+TEXT = (
+    "The first sentence is here. A second one follows it! "
+    "Does a third ask something?\n\n"
+    "A new paragraph starts. It has two sentences."
+)
+
+
+@pytest.mark.parametrize("unit", chunking.UNITS)
+@pytest.mark.parametrize("snap", chunking.SNAPS)
+@pytest.mark.parametrize("overlap", [0, 3])
+def test_offsets(unit: str, snap: str, overlap: int):
+    chunks = list(chunking.iter_chunks(TEXT, size=8, overlap=overlap,
+                                       unit=unit, snap=snap))
+    assert [chunk.idx for chunk in chunks] == list(range(len(chunks)))
+    for chunk in chunks:
+        assert TEXT[chunk.start:chunk.end] == chunk.text
+    # Every unit of text ends up in some chunk
+    assert chunks[0].start <= TEXT.index("The")
+    assert chunks[-1].end == len(TEXT)
+
+
+def test_chars_match_fixed_slicing():
+    chunks = chunking.iter_chunks(TEXT, size=16)
+    assert [chunk.text for chunk in chunks] == [
+        TEXT[pos:pos+16] for pos in range(0, len(TEXT), 16)
+    ]
+
+
+def test_overlap():
+    chunks = list(chunking.iter_chunks(TEXT, size=5, overlap=2, unit="words"))
+    for prev, chunk in zip(chunks, chunks[1:]):
+        assert prev.text.split()[-2:] == chunk.text.split()[:2]
+
+
+def test_snap_sentence():
+    chunks = list(chunking.iter_chunks(TEXT, size=12, unit="words",
+                                       snap="sentence"))
+    for chunk in chunks[:-1]:
+        assert chunk.text.rstrip()[-1] in ".!?"
+
+
+def test_snap_paragraph():
+    chunks = list(chunking.iter_chunks(TEXT, size=100, snap="paragraph"))
+    assert chunks[0].text.endswith("\n\n")
+    assert chunks[1].text.startswith("A new paragraph")
+
+
+def test_generator():
+    # Chunks are produced lazily, not materialized up front
+    chunks = chunking.iter_chunks("word " * 10**6, size=4, unit="words")
+    assert next(chunks).text == "word word word word"
+
+
+def test_bad_args():
+    with pytest.raises(AssertionError):
+        list(chunking.iter_chunks(TEXT, size=4, overlap=4))
+    with pytest.raises(AssertionError):
+        list(chunking.iter_chunks(TEXT, unit="lines"))
@@ -0,0 +1,68 @@
+import pytest
+from pathlib import Path
+from ingestion_pipeline_simple.defs import resources
+from ingestion_pipeline_simple.utils import codec, db_utils
+
+MARKDOWN = "\n".join(
+    f"## Section {idx}\n\nThe quarterly report lists revenue of {idx * 7} "
+    f"units for region {idx % 5}, see table {idx}." for idx in range(40)
+)
+
+
+@pytest.fixture
+def db(tmp_path: Path):
+    db_path = tmp_path / "test.db"
+    db_utils.init_db(str(db_path))
+    yield resources.SQLiteResource(db_path=str(db_path))
+    db_utils.get_pool(db_path).close()
+
+
+def test_round_trip(db: resources.SQLiteResource):
+    value_codec = codec.ValueCodec(db, "zlib")
+    encoded = value_codec.encode(MARKDOWN)
+    assert isinstance(encoded, bytes) and len(encoded) < len(MARKDOWN) / 3
+    assert value_codec.decode(encoded) == MARKDOWN
+    # Short and non-text values are left alone
+    assert value_codec.encode("# A") == "# A"
+    assert value_codec.encode(None) is None
+    assert value_codec.decode("text") == "text"
+
+
+def test_dictionary(db: resources.SQLiteResource):
+    plain = codec.ValueCodec(db, "zlib")
+    plain.load()
+    trainer = codec.ValueCodec(db, "zlib")
+    samples = [MARKDOWN.replace("quarterly", f"q{idx}") for idx in range(20)]
+    dict_id = trainer.train(samples)
+    value = MARKDOWN[:600]
+    encoded = trainer.encode(value)
+    assert len(encoded) < len(plain.encode(value))
+    # Another process learns of the dictionary when it first meets it
+    assert plain.decode(encoded) == value
+    assert plain.dict_id == dict_id
+
+
+def test_zstd(db: resources.SQLiteResource):
+    pytest.importorskip("zstandard")
+    value_codec = codec.ValueCodec(db, "zstd")
+    value_codec.train([MARKDOWN[pos:] for pos in range(0, 2000, 20)])
+    encoded = value_codec.encode(MARKDOWN)
+    assert encoded[0] == codec.CODEC_IDS["zstd"]
+    assert codec.ValueCodec(db, "zlib").decode(encoded) == MARKDOWN
+
+
+def test_resource_compresses(db: resources.SQLiteResource):
+    db.put_stage("/a", "md_rep", MARKDOWN)
+    db.put_stages("json_rep", [("/a", MARKDOWN), ("/b", "{}")])
+    db.put_stage("/a", "plain_rep", MARKDOWN)
+    db.put_cached("md_rep", [("digest", MARKDOWN)])
+    with db.connection() as conn:
+        stored = conn.execute(
+            "SELECT md_rep, json_rep, plain_rep FROM files WHERE bucket_key=?",
+            ("/a",)
+        ).fetchone()
+    assert [type(value) for value in stored] == [bytes, bytes, str]
+    assert db.get_stage("/a", "md_rep") == MARKDOWN
+    assert db.get_stages(["/a", "/b"], "json_rep") \
+        == {"/a": MARKDOWN, "/b": "{}"}
+    assert db.get_cached(["digest"], "md_rep") == {"digest": MARKDOWN}
@@ -0,0 +1,24 @@
+import random
+import shutil
+import string
+import tempfile
+from pathlib import Path
+from ingestion_pipeline_simple.utils import handle_files
+
+# Generated documents draw from a word list; the tests make their own
+# rather than depend on one in the working directory
+_WORDS_DIR = Path(tempfile.mkdtemp(prefix="ingestion-words-"))
+
+
+def pytest_configure(config):
+    rng = random.Random(0)
+    words = _WORDS_DIR / "words.txt"
+    words.write_text("\n".join(
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+        for _ in range(3000)
+    ), encoding="utf-8")
+    handle_files.WORDS = str(words)
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_WORDS_DIR, ignore_errors=True)
@@ -0,0 +1,91 @@
+import io
+import pytest
+from pathlib import Path
+from ingestion_pipeline_simple.utils import conversion_engine, converters
+
+
+@pytest.fixture(scope="module")
+def engine():
+    engine = conversion_engine.ConversionEngine(workers=2, docs_per_worker=2)
+    yield engine
+    engine.close()
+
+
+def test_convert_many(engine: conversion_engine.ConversionEngine,
+                      tmp_path: Path):
+    file_paths: dict[str, Path] = {}
+    for idx in range(5):
+        file_path = tmp_path / f"dummy{idx}.bin"
+        file_path.write_text(f"Hello World {idx}!", encoding="utf-8")
+        file_paths[f"/files/dummy{idx}.bin"] = file_path
+
+    results = list(engine.convert_many(file_paths))
+    assert sorted(res.key for res in results) == sorted(file_paths)
+    assert all(res.ok for res in results)
+    for res in results:
+        idx = res.key.removeprefix("/files/dummy").removesuffix(".bin")
+        assert res.markdown is not None and f"Hello World {idx}!" in res.markdown
+    # Workers are recycled after two documents each
+    assert len({res.pid for res in results}) >= 3
+
+
+def test_convert_many_errors(engine: conversion_engine.ConversionEngine,
+                             tmp_path: Path):
+    unknown = tmp_path / "notes.xyz"
+    unknown.write_text("?", encoding="utf-8")
+    missing = tmp_path / "missing.bin"
+    results = {
+        res.key: res
+        for res in engine.convert_many({"unknown": unknown, "missing": missing})
+    }
+    assert results["unknown"].error is not None \
+        and "Unexpected file type" in results["unknown"].error
+    assert results["missing"].error is not None
+
+
+def _write_pdf(path: Path, pages: list[str]) -> None:
+    """A minimal PDF with one line of Helvetica text per page."""
+    count = len(pages)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids ["
+        + b" ".join(b"%d 0 R" % (4 + 2 * idx) for idx in range(count))
+        + b"] /Count %d >>" % count,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for idx, text in enumerate(pages):
+        stream = b"BT /F1 12 Tf 72 720 Td (%s) Tj ET" % text.encode()
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (5 + 2 * idx)
+        )
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" \
+        % (len(objects) + 1, xref)
+    path.write_bytes(out)
+
+
+def test_stream_pdf(tmp_path: Path):
+    from pdfminer.high_level import extract_text
+    pages = [f"Page number {idx} of the report" for idx in range(30)]
+    pdf_path = tmp_path / "report.pdf"
+    _write_pdf(pdf_path, pages)
+
+    out = io.StringIO()
+    assert converters.stream_pdf(pdf_path, out) == 30
+    text = out.getvalue()
+    assert text == extract_text(pdf_path)
+    # Pages end in a form feed
+    assert [page.strip() for page in text.split("\x0c")][:-1] == pages
+    assert pages[0] in converters.convert_pdf(pdf_path).markdown
@@ -0,0 +1,298 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from ingestion_pipeline_simple.defs import resources
+from ingestion_pipeline_simple.utils import db_utils
+
+
+@pytest.fixture
+def db(tmp_path: Path):
+    db_path = tmp_path / "test.db"
+    db_utils.init_db(str(db_path))
+    yield resources.SQLiteResource(db_path=str(db_path))
+    db_utils.get_pool(db_path).close()
+
+
+def test_wal_mode(db: resources.SQLiteResource):
+    with db.connection() as conn:
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+
+
+def test_put_get_stage(db: resources.SQLiteResource):
+    db.put_stage("/org/usr/files/a.bin", "file_path", "/tmp/a.bin")
+    db.put_stage("/org/usr/files/a.bin", "md_rep", "# A")
+    assert db.get_stage("/org/usr/files/a.bin", "file_path") == "/tmp/a.bin"
+    assert db.get_stage("/org/usr/files/a.bin", "md_rep") == "# A"
+    assert db.get_stage("/org/usr/files/missing.bin", "md_rep") is None
+
+
+def test_unknown_stage(db: resources.SQLiteResource):
+    with pytest.raises(ValueError):
+        db.put_stage("/org/usr/files/a.bin", "bucket_key; DROP", "x")
+
+
+def test_concurrent_writers(db: resources.SQLiteResource):
+    keys = [f"/org/usr/files/{idx}.bin" for idx in range(200)]
+
+    def write(key: str) -> None:
+        db.put_stage(key, "file_path", key)
+        db.put_stage(key, "md_rep", key.upper())
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(write, keys))
+
+    with db.connection() as conn:
+        count = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    assert count == len(keys)
+    assert db.pool._created <= db.pool_size
+
+
+def test_migrates_legacy_chunk_blobs(tmp_path: Path):
+    import json
+    import sqlite3
+    db_path = tmp_path / "legacy.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        """
+        CREATE TABLE files (
+            bucket_key TEXT PRIMARY KEY,
+            file_path TEXT,
+            md_rep TEXT,
+            json_rep TEXT,
+            plain_rep TEXT,
+            chunks TEXT,
+            vec_embeddings TEXT
+        )
+        """
+    )
+    conn.execute(
+        "INSERT INTO files (bucket_key, chunks, vec_embeddings) VALUES (?, ?, ?)",
+        ("/org/usr/files/a.pdf", json.dumps({"0": "abc", "1": "de"}), "[0.5]")
+    )
+    conn.commit()
+    conn.close()
+
+    db_utils.init_db(str(db_path))
+    db = resources.SQLiteResource(db_path=str(db_path))
+    with db.connection() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        chunks, vecs = conn.execute(
+            "SELECT chunks, vec_embeddings FROM files"
+        ).fetchone()
+    assert version == db_utils.SCHEMA_VERSION
+    assert vecs is None
+    assert json.loads(chunks)["count"] == 2
+    assert list(db.iter_chunks("/org/usr/files/a.pdf")) == [(0, 0, 3, "abc"), (1, 3, 5, "de")]
+    # Rows from before the full-text index exist are indexed too
+    assert [hit.idx for hit in db.search_chunks("ABC")] == [0]
+    db_utils.get_pool(db_path).close()
+
+
+def test_put_embeddings(db: resources.SQLiteResource):
+    vectors = [[0.25, -1.0], [0.5, 2.0]]
+    count = db.put_embeddings(
+        ("/org/usr/files/a.pdf", idx, 2, db_utils.pack_vector(vec))
+        for idx, vec in enumerate(vectors)
+    )
+    assert count == 2
+    rows = list(db.iter_embeddings(["/org/usr/files/a.pdf"]))
+    assert [db_utils.unpack_vector(blob).tolist() for *_, blob in rows] == vectors
+    db.delete_embeddings(["/org/usr/files/a.pdf"])
+    assert list(db.iter_embeddings()) == []
+
+
+def test_nested_transaction_is_atomic(db: resources.SQLiteResource):
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.put_stage("/org/usr/files/a.bin", "file_path", "/tmp/a.bin")
+            db.put_chunks("/org/usr/files/a.bin", [(0, 0, 1, "a")])
+            raise RuntimeError("fail after both writes")
+    assert db.get_stage("/org/usr/files/a.bin", "file_path") is None
+    assert list(db.iter_chunks("/org/usr/files/a.bin")) == []
+
+
+def test_stage_versions(db: resources.SQLiteResource):
+    assert db.put_stage_versions("chunks", [("/a", "in1", "out1")])
+    assert db.stage_epoch("chunks") == 1
+    # Recomputed to the same output: the epoch stays put
+    assert not db.put_stage_versions("chunks", [("/a", "in2", "out1")])
+    assert db.stage_epoch("chunks") == 1
+    assert db.put_stage_versions("chunks", [("/a", "in3", "out2")])
+    assert db.stage_epoch("chunks") == 2
+    assert db.get_stage_versions("chunks", ["/a", "/b"]) \
+        == {"/a": ("in3", "out2")}
+    assert db.get_stage_versions("plain_files", ["/a"]) == {}
+    assert db.stage_epoch("plain_files") == 0
+    # Only output changes go to the change feed
+    assert db.stage_changes() == [(1, "chunks", "/a"), (2, "chunks", "/a")]
+    assert db.stage_changes(after_seq=1) == [(2, "chunks", "/a")]
+    assert db.last_change_seq() == 2
+
+
+def test_search_chunks(db: resources.SQLiteResource):
+    db.put_chunks("/org/usr/files/a.md", [
+        (0, 0, 20, "Pipelines ingest files", 0, 22),
+        (1, 20, 45, "Chunks are searched by keyword", 22, 50),
+    ])
+    db.put_chunks("/org/usr/files/b.md", [
+        (0, 0, 30, "keyword keyword: a keyword search"),
+    ])
+    hits = db.search_chunks("Keyword")
+    assert [(hit.doc_key, hit.idx) for hit in hits] \
+        == [("/org/usr/files/b.md", 0), ("/org/usr/files/a.md", 1)]
+    assert hits[0].score > hits[1].score
+    assert hits[1][2:6] == (20, 45, 22, 50)
+    assert "[keyword]" in hits[1].snippet
+    assert db.search_chunks("keyword", prefix="/org/usr/files/a") == hits[1:]
+    assert db.search_chunks("keyword", limit=1) == hits[:1]
+    # Every word must match, and punctuation is not query syntax
+    assert db.search_chunks("keyword pipelines") == []
+    assert len(db.search_chunks('"keyword" -(')) == 2
+    assert db.search_chunks("keyword OR pipelines") == []
+    assert len(db.search_chunks("keyword OR pipelines", raw=True)) == 3
+
+    # Rewrites and copies keep the index in step with the chunks table
+    db.put_chunks("/org/usr/files/b.md", [(0, 0, 5, "other")])
+    db.copy_chunks("/org/usr/files/a.md", "/org/usr/files/c.md")
+    assert sorted(hit.doc_key for hit in db.search_chunks("keyword")) \
+        == ["/org/usr/files/a.md", "/org/usr/files/c.md"]
+    assert db.search_chunks("other")[0].doc_key == "/org/usr/files/b.md"
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM chunks WHERE doc_key=?",
+                     ("/org/usr/files/c.md",))
+        conn.execute(
+            "INSERT INTO chunks_fts (chunks_fts, rank) "
+            "VALUES ('integrity-check', 1)"
+        )
+    assert len(db.search_chunks("keyword")) == 1
+
+
+def test_search_docs(db: resources.SQLiteResource):
+    db.put_stage("/org/usr/files/a.md", "file_path", "/tmp/a.md")
+    assert db.search_docs("hello") == []
+    db.put_stages("plain_rep", [("/org/usr/files/a.md", "Hello World"),
+                                ("/org/usr/files/b.md", "Goodbye World")])
+    assert [hit.bucket_key for hit in db.search_docs("hello")] \
+        == ["/org/usr/files/a.md"]
+    db.put_stage("/org/usr/files/a.md", "plain_rep", "Changed")
+    db.put_stage("/org/usr/files/a.md", "md_rep", "# Changed")
+    assert db.search_docs("hello") == []
+    assert len(db.search_docs("world")) == 1
+    db_utils.drop_val("/org/usr/files/b.md", db_name=db.db_path)
+    assert db.search_docs("world") == []
+    with db.transaction() as conn:
+        conn.execute(
+            "INSERT INTO plain_fts (plain_fts, rank) "
+            "VALUES ('integrity-check', 1)"
+        )
+
+
+def test_compress_db(tmp_path: Path):
+    import sqlite3
+    db_path = tmp_path / "legacy.db"
+    db_utils.init_db(str(db_path))
+    text = " ".join(f"word{idx % 50}" for idx in range(2000))
+    conn = sqlite3.connect(db_path)
+    # As written before values were compressed
+    conn.executemany(
+        "INSERT INTO files (bucket_key, md_rep, json_rep, plain_rep) "
+        "VALUES (?, ?, ?, ?)",
+        [(f"/org/usr/files/{idx}.md", text, text, text) for idx in range(30)]
+    )
+    conn.execute(
+        "INSERT INTO content_cache (digest, stage, value) VALUES (?, ?, ?)",
+        ("d", "md_rep", text)
+    )
+    conn.commit()
+    conn.close()
+
+    stats = db_utils.compress_db(db_path, batch_size=7)
+    assert stats["rows"] == 31
+    assert stats["bytes_after"] * 10 < stats["bytes_before"]
+    # Nothing left to do the second time
+    assert db_utils.compress_db(db_path, train=False)["rows"] == 0
+    db_utils.vacuum(str(db_path))
+
+    db = resources.SQLiteResource(db_path=str(db_path))
+    assert db.get_stage("/org/usr/files/3.md", "json_rep") == text
+    assert db.get_cached(["d"], "md_rep") == {"d": text}
+    assert len(db.search_docs("word7", limit=100)) == 30
+    db_utils.get_pool(db_path).close()
+
+
+def test_purge(db: resources.SQLiteResource):
+    for key, digest in (("/a", "d1"), ("/b", "d1"), ("/c", "d2")):
+        db.put_stage(key, "digest", digest)
+        db.put_stage(key, "plain_rep", f"text of {key[1:]}")
+        db.put_chunks(key, [(0, 0, 4, f"chunk of {key[1:]}")])
+        db.put_embeddings([(key, 0, 2, db_utils.pack_vector([1.0, 0.0]))])
+        db.put_stage_versions("chunks", [(key, "in", "out")])
+    db.put_cached("md_rep", [("d1", "x"), ("d2", "y")])
+    db.put_offset_maps([("d1", b"1"), ("d2", b"2")])
+    db.put_relationships(["/a"], [("/a", "/c", "A", 0.99)])
+    db.put_relationships(["/b"], [("/b", "/a", "A", 0.99)])
+    with db.transaction() as conn:
+        conn.execute("INSERT INTO ann_meta (name, dim) VALUES ('docs', 2)")
+        conn.executemany(
+            "INSERT INTO ann_items (name, row, doc_key, idx, list_no) "
+            "VALUES ('docs', ?, ?, 0, 0)",
+            [(0, "/a"), (1, "/b"), (2, "/c")]
+        )
+    epoch = db.stage_epoch("vec_embeddings")
+    seq = db.last_change_seq()
+
+    db.tombstone(["/a", "/c"])
+    assert db.tombstones(purged=False) == ["/a", "/c"]
+    assert db.purge(["/a", "/c"]) > 0
+    assert db.tombstones(purged=False) == []
+    assert db.tombstones(purged=True) == ["/a", "/c"]
+    assert db.get_stages(["/a", "/b", "/c"], "plain_rep") \
+        == {"/b": "text of b"}
+    assert [hit.doc_key for hit in db.search_chunks("chunk")] == ["/b"]
+    assert [key for key, *_ in db.iter_embeddings()] == ["/b"]
+    assert db.get_stage_versions("chunks", ["/a", "/b", "/c"]) \
+        == {"/b": ("in", "out")}
+    # d1 is still /b's content; d2 was only /c's
+    assert db.get_cached(["d1", "d2"], "md_rep") == {"d1": "x"}
+    assert db.get_offset_maps(["d1", "d2"]) == {"d1": b"1"}
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM relationships").fetchone() \
+            == (0,)
+        assert conn.execute("SELECT doc_key FROM ann_items").fetchall() \
+            == [("/b",)]
+        conn.execute("INSERT INTO plain_fts (plain_fts) "
+                     "VALUES ('integrity-check')")
+    assert db.stage_epoch("vec_embeddings") == epoch + 1
+    assert [change[1:] for change in db.stage_changes(seq)] \
+        == [("deleted", "/a"), ("deleted", "/c")]
+
+    # Purging again finds nothing and changes nothing
+    assert db.purge(["/a", "/c"]) == 0
+    assert db.last_change_seq() == seq + 2
+    assert db.prune_tombstones(before=0) == 0
+    # A file back before its tombstone is pruned is a file again
+    db.enqueue_backlog([("/a", "a.bin", "v2", 1)])
+    assert db.tombstones() == ["/c"]
+    assert db.prune_tombstones(before=float("inf")) == 1
+
+
+def test_compact(tmp_path: Path):
+    db = resources.SQLiteResource(db_path=str(tmp_path / "new.db"))
+    text = " ".join(f"word{idx}" for idx in range(200))
+    for idx in range(200):
+        db.put_chunks(f"/{idx}", [(0, 0, len(text), text)])
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM chunks")
+    with db.connection() as conn:
+        # New databases hand free pages back incrementally
+        assert conn.execute("PRAGMA auto_vacuum").fetchone() == (2,)
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        assert free > 10
+        stats = db_utils.compact(conn, pages=10)
+        assert stats["incremental"] == 1
+        assert stats["pages_freed"] == 10
+        stats = db_utils.compact(conn)
+        assert stats["free_pages"] == 0
+    assert db.search_chunks("word7") == []
+    db_utils.get_pool(db.db_path).close()
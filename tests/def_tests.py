@@ -5,12 +5,26 @@ from unittest.mock import Mock, patch
 import ingestion_pipeline_simple.defs
 from ingestion_pipeline_simple.utils import handle_files
 import os
+import shutil
 from pathlib import Path
-from ingestion_pipeline_simple.defs import assets
+from ingestion_pipeline_simple.defs import assets, maintenance, resources
+from ingestion_pipeline_simple.utils import columnar, db_utils, embedding, hashing
+from ingestion_pipeline_simple.utils.db_utils import unpack_vector
 import json
+from dagster._core.storage.tags import (
+    ASSET_PARTITION_RANGE_START_TAG,
+    ASSET_PARTITION_RANGE_END_TAG,
+)
 
 # DB_FILE = "file::memory:?cache=shared&mode=memory"
 DB_FILE = Path("tmp.db").resolve()
+STORE_ROOT = Path("tmp-store").resolve()
+# Directly invoked assets only build their tables for an exporting IO
+# manager, which has to come with their other resources in the context
+EXPORTING = {
+    "bucket_io_manager": resources.BucketIOManager(root=str(STORE_ROOT),
+                                                   export=True)
+}
 DB_CONN = sqlite3.connect(DB_FILE)
 CUR = DB_CONN.cursor()
 query = """
@@ -50,6 +64,12 @@ handle_files.convert_to_pdf(dir=str(TMP_BUCKET))
     encoding="utf-8"
 )
 
+BUCKET = resources.BucketResource(
+    bucket_path=str(TMP_BUCKET.parents[2]),
+    org="org",
+    usr="usr"
+)
+
 FILES: list[Path] = [
     Path(root, file)
     for root, _, files in os.walk(TMP_BUCKET)
@@ -69,21 +89,22 @@ def test_defs():
 
 
 def test_binary_files_asset():
-    mock_db_resource = Mock()
-    mock_db_resource.db_path = DB_FILE
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
     instance = dg.DagsterInstance.ephemeral()
     test_file = str(FILES[0])
     bucket_key = test_file.split("tmp-bucket")[-1]
     context = dg.build_asset_context(
         instance=instance,
+        resources={"db": db_resource, "bucket": BUCKET,
+                   **EXPORTING},
         partition_key=bucket_key,
         asset_config={
             "file_path": test_file
         }
     )
-    res: dg.Output = assets.binary_files(context, mock_db_resource)
-    assert res.value is None
-    filehash = str(hash(test_file) % (10 ** 10))
+    res: dg.Output = assets.binary_files(context)
+    assert res.value.column("bucket_key").to_pylist() == [bucket_key]
+    filehash = hashing.file_digest(test_file)[:assets.VERSION_CHARS]
     hash_val = "-".join([bucket_key, filehash])
     assert res.data_version is not None \
          and res.data_version.value == hash_val
@@ -96,51 +117,84 @@ def test_binary_files_asset():
     assert q_path == test_file
 
 
+def test_binary_files_finds_backfilled_paths():
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
+    # Not yet recorded by the test above
+    test_file = str(FILES[-1])
+    bucket_key = test_file.split("tmp-bucket")[-1]
+    # Backfills launched from the UI carry no run config
+    context = dg.build_asset_context(
+        instance=dg.DagsterInstance.ephemeral(), partition_key=bucket_key,
+        resources={"db": db_resource, "bucket": BUCKET,
+                   **EXPORTING}
+    )
+    res: dg.Output = assets.binary_files(context)
+    assert res.value.column("bucket_key").to_pylist() == [bucket_key]
+    assert db_resource.get_stage(bucket_key, "file_path") == test_file
+    s3 = resources.BucketResource(bucket_path="", org="org", usr="usr",
+                                  backend="s3", s3_bucket="uploads")
+    assert s3.source_path("/org/usr/a.pdf") == "s3://uploads/org/usr/a.pdf"
+
+
 def test_markdown_files_asset():
-    mock_db_resource = Mock()
-    mock_db_resource.db_path = DB_FILE
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
     instance = dg.DagsterInstance.ephemeral()
     test_file = str(FILES[0])
     bucket_key = test_file.split("tmp-bucket")[-1]
     context = dg.build_asset_context(
         instance=instance,
+        resources={"db": db_resource, **EXPORTING},
         partition_key=bucket_key
     )
     # Materialize upstream assets to enable isolated testing
     # upstream_res = dg.materialize_to_memory()
-    res: dg.Output = assets.markdown_files(context, mock_db_resource)
-    assert res.value is None
+    res: dg.Output = assets.markdown_files(context)
+    assert res.value.column_names == ["bucket_key", "md_rep"]
+    # Stage stats ride along as metadata
+    perf = {
+        name: value.value for name, value in res.metadata.items()
+        if name.startswith("perf/")
+    }
+    assert perf["perf/partitions"] == 1
+    assert perf["perf/wall_s"] >= perf["perf/db_s"] > 0
+    assert perf["perf/bytes_out"] == res.value.nbytes
     query = """
         SELECT md_rep FROM files
         WHERE bucket_key=?
     """
-    md_rep = CUR.execute(query, (bucket_key,)).fetchone()[0]
+    # Stored through the value codec; large values come back compressed
+    md_rep = db_resource.value_codec.decode(
+        CUR.execute(query, (bucket_key,)).fetchone()[0]
+    )
     assert isinstance(md_rep, str)
-    filehash = str(hash(md_rep) % (10 ** 10))
+    assert db_resource.get_stage(bucket_key, "md_rep") == md_rep
+    filehash = hashing.text_digest(md_rep)[:assets.VERSION_CHARS]
     hash_val = "-".join([bucket_key, filehash])
     assert res.data_version is not None \
          and res.data_version.value == hash_val
     
 
 def test_json_files_asset():
-    mock_db_resource = Mock()
-    mock_db_resource.db_path = DB_FILE
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
     instance = dg.DagsterInstance.ephemeral()
     test_file = str(FILES[0])
     bucket_key = test_file.split("tmp-bucket")[-1]
     context = dg.build_asset_context(
         instance=instance,
+        resources={"db": db_resource, **EXPORTING},
         partition_key=bucket_key
     )
-    res: dg.Output = assets.json_files(context, mock_db_resource)
-    assert res.value is None
+    res: dg.Output = assets.json_files(context)
+    assert res.value.column_names == ["bucket_key", "json_rep"]
     query = """
         SELECT json_rep FROM files
         WHERE bucket_key=?
     """
-    json_rep = CUR.execute(query, (bucket_key,)).fetchone()[0]
+    json_rep = db_resource.value_codec.decode(
+        CUR.execute(query, (bucket_key,)).fetchone()[0]
+    )
     assert isinstance(json_rep, str)
-    filehash = str(hash(json_rep) % (10 ** 10))
+    filehash = hashing.text_digest(json_rep)[:assets.VERSION_CHARS]
     hash_val = "-".join([bucket_key, filehash])
     assert res.data_version is not None \
          and res.data_version.value == hash_val
@@ -151,91 +205,485 @@ def test_json_files_asset():
     
 
 def test_plain_files_asset():
-    mock_db_resource = Mock()
-    mock_db_resource.db_path = DB_FILE
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
     instance = dg.DagsterInstance.ephemeral()
     test_file = str(FILES[0])
     bucket_key = test_file.split("tmp-bucket")[-1]
     context = dg.build_asset_context(
         instance=instance,
+        resources={"db": db_resource, **EXPORTING},
         partition_key=bucket_key
     )
-    res: dg.Output = assets.plain_files(context, mock_db_resource)
-    assert res.value is None
+    res: dg.Output = assets.plain_files(context)
+    assert res.value.column_names == ["bucket_key", "plain_rep"]
     query = """
         SELECT plain_rep FROM files
         WHERE bucket_key=?
     """
     plain_rep = CUR.execute(query, (bucket_key,)).fetchone()[0]
     assert isinstance(plain_rep, str)
-    filehash = str(hash(plain_rep) % (10 ** 10))
+    filehash = hashing.text_digest(plain_rep)[:assets.VERSION_CHARS]
     hash_val = "-".join([bucket_key, filehash])
     assert res.data_version is not None \
          and res.data_version.value == hash_val
     
 
 def test_chunks_asset():
-    mock_db_resource = Mock()
-    mock_db_resource.db_path = DB_FILE
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
     instance = dg.DagsterInstance.ephemeral()
     test_file = str(FILES[0])
     bucket_key = test_file.split("tmp-bucket")[-1]
     context = dg.build_asset_context(
         instance=instance,
+        resources={"db": db_resource, **EXPORTING},
         partition_key=bucket_key
     )
-    res: dg.Output = assets.chunks(context, mock_db_resource)
-    assert res.value is None
+    res: dg.Output = assets.chunks(context)
+    assert res.value.num_rows > 0
     query = """
-        SELECT chunks FROM files
-        WHERE bucket_key=?
+        SELECT text FROM chunks
+        WHERE doc_key=?
+        ORDER BY idx
     """
-    chunks = CUR.execute(query, (bucket_key,)).fetchone()[0]
-    assert isinstance(chunks, str)
-    filehash = str(hash(chunks) % (10 ** 10))
+    texts = [text for (text,) in CUR.execute(query, (bucket_key,))]
+    assert len(texts) > 0
+    # Each chunk cites the span of markdown it was cut from
+    md_rep = db_resource.get_stage(bucket_key, "md_rep")
+    spans = CUR.execute(
+        "SELECT md_start, md_end FROM chunks WHERE doc_key=? ORDER BY idx",
+        (bucket_key,)
+    ).fetchall()
+    assert all(0 <= md_start <= md_end <= len(md_rep)
+               for md_start, md_end in spans)
+    filehash = hashing.iter_digest(texts)[:assets.VERSION_CHARS]
     hash_val = "-".join([bucket_key, filehash])
     assert res.data_version is not None \
          and res.data_version.value == hash_val
+    query = """
+        SELECT chunks FROM files
+        WHERE bucket_key=?
+    """
+    chunks = CUR.execute(query, (bucket_key,)).fetchone()[0]
     try:
-        chunks_dict = json.loads(chunks)
-        assert len(chunks_dict) > 0
+        manifest = json.loads(chunks)
+        assert manifest["count"] == len(texts)
     except Exception:
         pytest.fail("Could not load stringified json.")
     
 
 def test_vecs_asset():
-    mock_db_resource = Mock()
-    mock_db_resource.db_path = DB_FILE
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
     instance = dg.DagsterInstance.ephemeral()
     test_file = str(FILES[0])
     bucket_key = test_file.split("tmp-bucket")[-1]
     context = dg.build_asset_context(
         instance=instance,
+        resources={"db": db_resource, **EXPORTING},
         partition_key=bucket_key
     )
-    res: dg.Output = assets.vec_embeddings(context, mock_db_resource)
-    assert res.value is None
+    res: dg.Output = assets.vec_embeddings(context)
+    assert res.value.num_rows > 0
     query = """
         SELECT vec_embeddings FROM files
         WHERE bucket_key=?
     """
     vec_embeddings = CUR.execute(query, (bucket_key,)).fetchone()[0]
-    assert isinstance(vec_embeddings, str)
-    filehash = str(hash(vec_embeddings) % (10 ** 10))
-    hash_val = "-".join([bucket_key, filehash])
+    manifest = json.loads(vec_embeddings)
+    rows = CUR.execute(
+        "SELECT idx, dim, vector FROM embeddings WHERE doc_key=? ORDER BY idx",
+        (bucket_key,)
+    ).fetchall()
+    assert manifest["count"] == len(rows) > 0
+    assert manifest["dim"] == embedding.EMBED_DIM
+    for _, dim, vector in rows:
+        values = unpack_vector(vector)
+        assert len(values) == dim == manifest["dim"]
+        assert sum(v * v for v in values) == pytest.approx(1.0, abs=1e-4)
+    vecs_hash = hashing.StreamDigest()
+    for _, _, vector in rows:
+        vecs_hash.update(vector)
+    assert manifest["digest"] == vecs_hash.hexdigest()
+    hash_val = "-".join([bucket_key, manifest["digest"][:assets.VERSION_CHARS]])
     assert res.data_version is not None \
          and res.data_version.value == hash_val
-    try:
-        vecs_dict = json.loads(vec_embeddings)
-        assert len(vecs_dict) > 0
-    except Exception:
-        pytest.fail("Could not load stringified json.")
-    
+
+
+def test_relationships_asset():
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
+    instance = dg.DagsterInstance.ephemeral()
+    test_file = str(FILES[0])
+    bucket_key = test_file.split("tmp-bucket")[-1]
+    context = dg.build_asset_context(
+        instance=instance,
+        resources={"db": db_resource, **EXPORTING},
+        partition_key=bucket_key
+    )
+    res: dg.Output = assets.relationships(context)
+    assert set(res.value.column("bucket_key").to_pylist()) <= {bucket_key}
+    assert res.data_version is not None \
+        and res.data_version.value.startswith(bucket_key)
+    query = """
+        SELECT COUNT(*) FROM ann_items
+        WHERE name='chunks' AND doc_key=?
+    """
+    chunk_count = json.loads(CUR.execute(
+        "SELECT vec_embeddings FROM files WHERE bucket_key=?", (bucket_key,)
+    ).fetchone()[0])["count"]
+    assert CUR.execute(query, (bucket_key,)).fetchone()[0] == chunk_count
+    query = """
+        SELECT relationship, score FROM relationships
+        WHERE doc_a_key=? OR doc_b_key=?
+    """
+    for relationship, score in CUR.execute(query, (bucket_key, bucket_key)):
+        assert assets._grade(score) == relationship
+
+
+def test_duplicate_upload_uses_cache():
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
+    instance = dg.DagsterInstance.ephemeral()
+    test_file = str(FILES[0])
+    bucket_key = test_file.split("tmp-bucket")[-1]
+    dup_key = bucket_key + ".copy"
+    context = dg.build_asset_context(
+        instance=instance,
+        partition_key=dup_key,
+        asset_config={
+            "file_path": test_file
+        }
+    )
+    assets.binary_files(context, db_resource, BUCKET)
+    context = dg.build_asset_context(
+        instance=instance,
+        partition_key=dup_key
+    )
+    with patch.object(assets, "_convert_files") as convert:
+        assets.markdown_files(context, db_resource)
+    convert.assert_not_called()
+    query = """
+        SELECT md_rep FROM files
+        WHERE bucket_key=?
+    """
+    assert CUR.execute(query, (dup_key,)).fetchone()[0] \
+        == CUR.execute(query, (bucket_key,)).fetchone()[0]
+
+
+def test_batched_run():
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
+    instance = dg.DagsterInstance.ephemeral()
+    file_paths = {
+        str(file).split("tmp-bucket")[-1]: str(file)
+        for file in FILES
+    }
+    bucket_keys = list(file_paths)
+    instance.add_dynamic_partitions(
+        assets.files_partition_def.name,
+        bucket_keys
+    )
+    # Earlier tests ran the assets without the IO manager
+    with db_resource.transaction() as conn:
+        conn.execute("DELETE FROM stage_versions")
+    res = dg.materialize(
+        [
+            assets.binary_files,
+            assets.markdown_files,
+            assets.json_files,
+            assets.plain_files,
+            assets.chunks,
+            assets.vec_embeddings,
+            assets.relationships,
+        ],
+        instance=instance,
+        resources={
+            "db": db_resource,
+            "bucket": BUCKET,
+            "bucket_io_manager": resources.BucketIOManager(
+                root=str(STORE_ROOT), export=True
+            ),
+        },
+        tags={
+            ASSET_PARTITION_RANGE_START_TAG: bucket_keys[0],
+            ASSET_PARTITION_RANGE_END_TAG: bucket_keys[-1],
+        },
+        run_config={
+            "ops": {
+                "binary_files": {
+                    "config": {"file_paths": file_paths}
+                }
+            }
+        },
+    )
+    assert res.success
+    # One run, one materialization per partition per asset
+    assert len(res.get_asset_materialization_events()) == 7 * len(FILES)
+    query = """
+        SELECT COUNT(*) FROM files
+        WHERE vec_embeddings IS NOT NULL
+    """
+    assert CUR.execute(query).fetchone()[0] == len(FILES)
+    query = "SELECT COUNT(*) FROM ann_items WHERE name='docs'"
+    assert CUR.execute(query).fetchone()[0] == len(FILES)
+    chunks_data = columnar.dataset(STORE_ROOT, "chunks").to_table()
+    assert set(chunks_data.column("bucket_key").to_pylist()) == set(bucket_keys)
+    assert chunks_data.num_rows == CUR.execute(
+        "SELECT COUNT(*) FROM chunks"
+    ).fetchone()[0]
+    vectors = columnar.read_partitions(STORE_ROOT, "vec_embeddings", bucket_keys)
+    assert columnar.vectors(vectors.column("vector")).shape \
+        == (vectors.num_rows, embedding.EMBED_DIM)
+
+
+def test_rerun_skips_unchanged():
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
+    file_paths = {
+        str(file).split("tmp-bucket")[-1]: str(file)
+        for file in FILES
+    }
+    bucket_keys = list(file_paths)
+    asset_defs = [
+        assets.binary_files,
+        assets.markdown_files,
+        assets.json_files,
+        assets.plain_files,
+        assets.chunks,
+        assets.vec_embeddings,
+        assets.relationships,
+    ]
+
+    def materialize(keys: list[str]) -> dict[str, tuple[str, list[str]]]:
+        instance = dg.DagsterInstance.ephemeral()
+        instance.add_dynamic_partitions(
+            assets.files_partition_def.name, bucket_keys
+        )
+        res = dg.materialize(
+            asset_defs,
+            instance=instance,
+            resources={
+                "db": db_resource,
+                "bucket": BUCKET,
+                "bucket_io_manager": resources.BucketIOManager(
+                    root=str(STORE_ROOT), export=True
+                ),
+            },
+            tags={
+                ASSET_PARTITION_RANGE_START_TAG: keys[0],
+                ASSET_PARTITION_RANGE_END_TAG: keys[-1],
+            },
+            run_config={"ops": {"binary_files": {"config": {
+                "file_paths": {key: file_paths[key] for key in keys}
+            }}}},
+        )
+        assert res.success
+        return {
+            event.asset_key.to_user_string(): (
+                event.step_materialization_data.materialization.tags[
+                    "dagster/data_version"],
+                event.step_materialization_data.materialization.metadata[
+                    resources.UNCHANGED_METADATA_KEY].value,
+            )
+            for event in res.get_asset_materialization_events()
+        }
+
+    first = materialize(bucket_keys)
+    store = sorted(STORE_ROOT.rglob("*.arrow"))
+    mtimes = [path.stat().st_mtime_ns for path in store]
+    with db_resource.transaction() as conn:
+        conn.execute("DELETE FROM chunks")
+
+    # Nothing changed: same data versions, nothing recomputed or rewritten
+    second = materialize(bucket_keys)
+    assert {stage: version for stage, (version, _) in second.items()} \
+        == {stage: version for stage, (version, _) in first.items()}
+    assert all(sorted(unchanged) == sorted(bucket_keys)
+               for _, unchanged in second.values())
+    assert CUR.execute("SELECT COUNT(*) FROM chunks").fetchone()[0] == 0
+    assert [path.stat().st_mtime_ns for path in store] == mtimes
+
+
+def test_fused_text_stages(tmp_path: Path):
+    db_resource = resources.SQLiteResource(db_path=str(DB_FILE))
+    instance = dg.DagsterInstance.ephemeral()
+    file_paths = {
+        str(file).split("tmp-bucket")[-1]: str(file)
+        for file in FILES
+    }
+    bucket_keys = list(file_paths)
+    instance.add_dynamic_partitions(
+        assets.files_partition_def.name,
+        bucket_keys
+    )
+    with db_resource.transaction() as conn:
+        conn.execute("DELETE FROM chunks")
+        conn.execute("DELETE FROM stage_versions")
+    res = dg.materialize(
+        [
+            assets.binary_files,
+            assets.markdown_files,
+            assets._fused_text_stages(),
+        ],
+        instance=instance,
+        resources={
+            "db": db_resource,
+            "bucket": BUCKET,
+            "bucket_io_manager": resources.BucketIOManager(
+                root=str(tmp_path / "store")
+            ),
+        },
+        tags={
+            ASSET_PARTITION_RANGE_START_TAG: bucket_keys[0],
+            ASSET_PARTITION_RANGE_END_TAG: bucket_keys[-1],
+        },
+        run_config={
+            "ops": {
+                "binary_files": {
+                    "config": {"file_paths": file_paths}
+                }
+            }
+        },
+    )
+    assert res.success
+    materialized = {
+        event.asset_key.to_user_string()
+        for event in res.get_asset_materialization_events()
+    }
+    assert {"json_files", "plain_files", "chunks"} <= materialized
+    assert len(res.get_asset_materialization_events()) == 5 * len(FILES)
+    # Stage tables are only written when the IO manager exports them
+    assert not (tmp_path / "store").exists()
+    for bucket_key in bucket_keys:
+        manifest = json.loads(CUR.execute(
+            "SELECT chunks FROM files WHERE bucket_key=?", (bucket_key,)
+        ).fetchone()[0])
+        texts = [
+            text for (text,) in CUR.execute(
+                "SELECT text FROM chunks WHERE doc_key=? ORDER BY idx",
+                (bucket_key,)
+            )
+        ]
+        assert manifest["count"] == len(texts) > 0
+        assert manifest["digest"] == hashing.iter_digest(texts)
+
+
+def test_large_files_are_streamed(monkeypatch: pytest.MonkeyPatch):
+    [pdf_path] = [str(file) for file in FILES if file.suffix == ".pdf"]
+    monkeypatch.setattr(assets, "LARGE_FILE_BYTES", os.path.getsize(pdf_path))
+    streamed = []
+    stream_pdf = assets.STREAMING_REGISTRY["pdf"]
+    monkeypatch.setitem(
+        assets.STREAMING_REGISTRY, "pdf",
+        lambda path, out: streamed.append(str(path)) or stream_pdf(path, out)
+    )
+    file_paths = {str(file): str(file) for file in FILES}
+    md_reps = assets._convert(file_paths)
+    # Only the large file is streamed; the small ones go through the pool
+    assert streamed == [pdf_path]
+    assert set(md_reps) == set(file_paths)
+    assert md_reps[pdf_path].split() \
+        == assets.convert_pdf(pdf_path).markdown.split()
+
+
+def test_serial_conversion_skips_failures(monkeypatch: pytest.MonkeyPatch):
+    [pdf_path] = [str(file) for file in FILES if file.suffix == ".pdf"]
+    monkeypatch.setattr(assets, "LARGE_FILE_BYTES", 0)
+
+    def broken(path, out):
+        raise ValueError("corrupt")
+
+    monkeypatch.setitem(assets.STREAMING_REGISTRY, "pdf", broken)
+    file_paths = {str(file): str(file) for file in FILES}
+    # Every file is large, so the whole batch takes the serial lane
+    md_reps = assets._convert(file_paths)
+    assert set(md_reps) == set(file_paths) - {pdf_path}
+
 
 def test_clean_up():
     DB_CONN.close()
     for file in FILES:
         os.remove(file)
     os.removedirs(TMP_BUCKET)
+    db_utils.get_pool(DB_FILE).close()
+    shutil.rmtree(resources.SQLiteResource(db_path=str(DB_FILE)).ann_dir,
+                  ignore_errors=True)
+    shutil.rmtree(STORE_ROOT, ignore_errors=True)
     if ":memory:" not in str(DB_FILE):
-        os.remove(DB_FILE)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(f"{DB_FILE}{suffix}"):
+                os.remove(f"{DB_FILE}{suffix}")
+
+
+def test_compaction_job(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    db = resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
+    store = tmp_path / "store"
+    db.tombstone(["/org/usr/gone.bin"])
+    db.purge(["/org/usr/gone.bin"])
+    # Written back by a run that was in flight at the deletion
+    db.put_stage("/org/usr/gone.bin", "md_rep", "stale")
+    columnar.partition_dir(store, "chunks", "/org/usr/gone.bin").mkdir(
+        parents=True
+    )
+    instance = dg.DagsterInstance.ephemeral()
+    instance.add_dynamic_partitions(
+        "files", ["/org/usr/gone.bin", "/org/usr/kept.bin"]
+    )
+    run_resources = {
+        "db": db,
+        "bucket_io_manager": resources.BucketIOManager(root=str(store)),
+    }
+
+    res = maintenance.compact_db_job.execute_in_process(
+        instance=instance, resources=run_resources
+    )
+    assert res.success
+    assert db.get_stage("/org/usr/gone.bin", "md_rep") is None
+    assert not columnar.partition_dir(
+        store, "chunks", "/org/usr/gone.bin"
+    ).exists()
+    assert db.tombstones() == ["/org/usr/gone.bin"]
+
+    # Past retention, the tombstone goes, and the partition with it
+    monkeypatch.setattr(resources, "TOMBSTONE_RETENTION_S", -60)
+    res = maintenance.compact_db_job.execute_in_process(
+        instance=instance, resources=run_resources
+    )
+    assert res.success
+    assert db.tombstones() == []
+    assert instance.get_dynamic_partitions("files") == ["/org/usr/kept.bin"]
+
+
+def _chunk_args(size: int) -> dict:
+    return {**{name: field.default_value
+               for name, field in assets.CHUNK_CONFIG.items()},
+            "size": size}
+
+
+def _texts(db: resources.SQLiteResource, bucket_key: str) -> list[str]:
+    return [row[3] for row in db.iter_chunks(bucket_key)]
+
+
+def test_cached_chunks_follow_rechunking(tmp_path: Path):
+    db = resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
+    text = "alpha beta gamma delta epsilon zeta eta theta iota"
+    db.put_stage("/k1", "digest", "d1")
+    db.put_stage("/k1", "plain_rep", text)
+    for size in (128, 10, 128):
+        assets.compute_chunks(db, ["/k1"], _chunk_args(size))
+    manifest = json.loads(db.get_stage("/k1", "chunks"))
+    assert manifest["size"] == 128
+    assert _texts(db, "/k1") == [text] and manifest["count"] == 1
+
+
+def test_cached_chunks_follow_overwrites(tmp_path: Path):
+    db = resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
+    old, new = "the original upload", "a different upload"
+    db.put_stage("/k1", "digest", "d-old")
+    db.put_stage("/k1", "plain_rep", old)
+    assets.compute_chunks(db, ["/k1"], _chunk_args(128))
+    db.put_stage("/k1", "digest", "d-new")
+    db.put_stage("/k1", "plain_rep", new)
+    assets.compute_chunks(db, ["/k1"], _chunk_args(128))
+
+    # Same bytes as the old /k1, which no longer holds them
+    db.put_stage("/k2", "digest", "d-old")
+    db.put_stage("/k2", "plain_rep", old)
+    assets.compute_chunks(db, ["/k2"], _chunk_args(128))
+    assert _texts(db, "/k2") == [old]
+    assert _texts(db, "/k1") == [new]
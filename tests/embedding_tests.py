@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from ingestion_pipeline_simple.utils import embedding
+
+TEXTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "A lazy dog sleeps; the fox does not.",
+    "",
+    "Completely unrelated words about databases and indexes.",
+]
+
+
+def test_shape_and_norm():
+    embedder = embedding.get_embedder("hashing", dim=64)
+    matrix = embedding.normalize(embedder.embed(TEXTS))
+    assert matrix.shape == (len(TEXTS), 64)
+    assert matrix.dtype == np.float32
+    norms = np.linalg.norm(matrix, axis=1)
+    assert norms[2] == 0
+    assert np.allclose(np.delete(norms, 2), 1.0, atol=1e-6)
+
+
+def test_independent_of_batch():
+    embedder = embedding.get_embedder("hashing")
+    together = embedder.embed(TEXTS)
+    alone = np.vstack([embedder.embed([text]) for text in TEXTS])
+    assert np.array_equal(together, alone)
+
+
+def test_similar_texts_closer():
+    embedder = embedding.get_embedder("hashing")
+    matrix = embedding.normalize(embedder.embed(TEXTS))
+    sims = matrix @ matrix.T
+    assert sims[0, 1] > sims[0, 3]
+
+
+def test_sublinear_tf():
+    embedder = embedding.HashingEmbedder(dim=1024)
+    once, thrice = embedder.embed(["fox", "fox fox fox"])
+    col = int(np.flatnonzero(once)[0])
+    assert abs(once[col]) == 1.0
+    assert abs(thrice[col]) == pytest.approx(1 + np.log(3))
+
+
+def test_pack_rows():
+    matrix = np.array([[0.5, -1.0], [2.0, 0.25]], dtype=np.float32)
+    packed = embedding.pack_rows(matrix)
+    assert [np.frombuffer(blob, dtype="<f4").tolist() for blob in packed] \
+        == matrix.tolist()
+
+
+def test_unknown_embedder():
+    with pytest.raises(AssertionError):
+        embedding.get_embedder("missing")
@@ -0,0 +1,71 @@
+import asyncio
+from pathlib import Path
+from ingestion_pipeline_simple.defs import resources
+from ingestion_pipeline_simple.utils import backfill, ingest_daemon
+
+
+def _daemon(tmp_path: Path) -> ingest_daemon.Daemon:
+    return ingest_daemon.Daemon(
+        resources.SQLiteResource(db_path=str(tmp_path / "test.db")),
+        resources.BucketResource(bucket_path=str(tmp_path / "bucket"),
+                                 org="org", usr="usr"),
+        store_root=str(tmp_path / "store"),
+        poll_seconds=0.05,
+    )
+
+
+def test_daemon_ingests(tmp_path: Path):
+    files_dir = tmp_path / "bucket" / "org" / "usr"
+    files_dir.mkdir(parents=True)
+    for idx, name in enumerate(["a.bin", "b.bin", "c.bin"]):
+        (files_dir / name).write_text(f"Hello World {idx}!", encoding="utf-8")
+    keys = ["/org/usr/a.bin", "/org/usr/b.bin", "/org/usr/c.bin"]
+
+    daemon = _daemon(tmp_path)
+    db = daemon.db
+    assert asyncio.run(daemon.run(once=True)) == {"done": 3, "failed": 0}
+    assert daemon.latency()["p99_s"] > 0
+    assert db.backlog_size() == 0 and daemon.in_flight == {}
+    assert db.get_stage("/org/usr/b.bin", "md_rep").strip() \
+        == "Hello World 1!"
+    assert sorted(db.get_stages(keys, "vec_embeddings")) == keys
+    assert sorted(db.get_stage_versions("relationships", keys)) == keys
+    assert (tmp_path / "store" / "chunks").is_dir()
+    # Written as the assets write them, so nothing is stale for Dagster
+    assert backfill.select(db, stale="relationships") == []
+
+    # A changed file goes through again; the others are not detected
+    (files_dir / "b.bin").write_text("Changed", encoding="utf-8")
+    daemon = _daemon(tmp_path)
+    assert asyncio.run(daemon.run(once=True)) == {"done": 1, "failed": 0}
+    assert db.get_stage("/org/usr/b.bin", "md_rep").strip() == "Changed"
+    assert backfill.select(db, stale="vec_embeddings") == []
+    # New embeddings make every other document's neighbours stale, as
+    # after a Dagster run
+    assert [key for key, _ in backfill.select(db, stale="relationships")] \
+        == ["/org/usr/a.bin", "/org/usr/c.bin"]
+
+    # A deleted file is purged from the database and the store
+    (files_dir / "c.bin").unlink()
+    daemon = _daemon(tmp_path)
+    assert asyncio.run(daemon.run(once=True)) == {"done": 0, "failed": 0}
+    assert db.get_stage("/org/usr/c.bin", "md_rep") is None
+    assert sorted(db.get_stages(keys, "vec_embeddings")) == keys[:2]
+    assert sorted(db.get_stage_versions("relationships", keys)) == keys[:2]
+    assert list(db.iter_chunks("/org/usr/c.bin")) == []
+    assert db.tombstones(purged=True) == ["/org/usr/c.bin"]
+    store = tmp_path / "store"
+    assert not list(store.glob("*/bucket_key=%2Forg%2Fusr%2Fc.bin"))
+    assert list(store.glob("*/bucket_key=%2Forg%2Fusr%2Fa.bin"))
+
+
+def test_daemon_stops(tmp_path: Path):
+    (tmp_path / "bucket" / "org" / "usr").mkdir(parents=True)
+    daemon = _daemon(tmp_path)
+
+    async def main():
+        stop = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.2, stop.set)
+        return await daemon.run(stop=stop)
+
+    assert asyncio.run(main()) == {"done": 0, "failed": 0}
@@ -0,0 +1,47 @@
+import pytest
+import time
+from ingestion_pipeline_simple.utils import instrumentation
+
+
+def test_measure():
+    with instrumentation.measure("stage", partitions=2) as stats:
+        assert instrumentation.current() is stats
+        with instrumentation.timed("db"):
+            # Nested blocks of the same kind are only counted once
+            with instrumentation.timed("db"):
+                time.sleep(0.01)
+        instrumentation.add("bytes_in", 5)
+        instrumentation.add("bytes_in", instrumentation.size_of("abc"))
+    assert instrumentation.current() is None
+    assert stats.wall_s >= stats.db_s >= 0.01
+    assert stats.conversion_s == 0.0
+    assert stats.bytes_in == 8
+    assert stats.partitions == 2
+    assert stats.metadata()["perf/bytes_in"] == 8
+
+
+def test_rss_delta():
+    with instrumentation.measure("stage") as stats:
+        if not instrumentation.current_rss():
+            pytest.skip("no /proc/self/statm")
+        block = b"x" * (64 * 1024 * 1024)
+    assert stats.rss_delta_bytes >= len(block) // 2
+    assert stats.process_peak_rss_bytes >= stats.rss_delta_bytes
+
+
+def test_outside_measure_is_noop():
+    with instrumentation.timed("db"):
+        instrumentation.add("bytes_in", 1)
+    assert instrumentation.current() is None
+
+
+def test_write_textfile(tmp_path):
+    for _ in range(2):
+        with instrumentation.measure("chunks", partitions=3) as stats:
+            instrumentation.add("bytes_out", 10)
+        path = instrumentation.write_textfile(stats, tmp_path)
+    lines = path.read_text().splitlines()
+    assert 'ingestion_stage_partitions_total{stage="chunks"} 6.0' in lines
+    assert 'ingestion_stage_bytes_out_total{stage="chunks"} 20.0' in lines
+    assert 'ingestion_stage_runs_total{stage="chunks"} 2.0' in lines
+    assert "# TYPE ingestion_stage_process_peak_rss_bytes gauge" in lines
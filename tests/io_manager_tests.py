@@ -0,0 +1,81 @@
+import dagster as dg
+import numpy as np
+from pathlib import Path
+from ingestion_pipeline_simple.defs import resources
+from ingestion_pipeline_simple.utils import columnar
+
+KEYS = ["/org/usr/files/a.pdf", "/org/usr/files/b.docx"]
+
+
+def _chunks(keys: list[str], texts: list[str]):
+    return columnar.table("chunks", {
+        "bucket_key": keys,
+        "idx": list(range(len(keys))),
+        "start": [0] * len(keys),
+        "end": [len(text) for text in texts],
+        "text": texts,
+    })
+
+
+def test_roundtrip_by_partition(tmp_path: Path):
+    io_manager = resources.BucketIOManager(root=str(tmp_path), export=True)
+    table = _chunks([KEYS[0], KEYS[1], KEYS[0]], ["a", "b", "c"])
+    io_manager.handle_output(
+        dg.build_output_context(
+            asset_key=dg.AssetKey("chunks"),
+            partition_key=KEYS[0],
+        ),
+        table.filter(table.column("bucket_key").to_numpy() == KEYS[0])
+    )
+    columnar.write_partitions(tmp_path, "chunks", table, KEYS)
+
+    loaded = io_manager.load_input(dg.build_input_context(
+        asset_key=dg.AssetKey("chunks"),
+        partition_key=KEYS[1],
+        asset_partitions_def=dg.StaticPartitionsDefinition(KEYS),
+    ))
+    assert loaded.column("text").to_pylist() == ["b"]
+    assert loaded.column("bucket_key").to_pylist() == [KEYS[1]]
+
+    everything = columnar.dataset(tmp_path, "chunks").to_table()
+    assert sorted(everything.column("text").to_pylist()) == ["a", "b", "c"]
+    assert set(everything.column("bucket_key").to_pylist()) == set(KEYS)
+
+
+def test_rewrite_replaces_partition(tmp_path: Path):
+    columnar.write_partitions(tmp_path, "chunks", _chunks(KEYS, ["a", "b"]))
+    columnar.write_partitions(tmp_path, "chunks", _chunks([KEYS[0]], ["z"]))
+    loaded = columnar.read_partitions(tmp_path, "chunks", KEYS)
+    assert loaded.column("text").to_pylist() == ["z", "b"]
+
+
+def test_empty_partition_keeps_schema(tmp_path: Path):
+    columnar.write_partitions(tmp_path, "chunks", _chunks([], []), KEYS[:1])
+    loaded = columnar.read_partitions(tmp_path, "chunks", KEYS[:1])
+    assert loaded.num_rows == 0
+    assert loaded.schema.field("text").type == "string"
+
+
+def test_vectors_roundtrip(tmp_path: Path):
+    matrix = np.arange(12, dtype=np.float32).reshape(4, 3)
+    columnar.write_partitions(tmp_path, "vec_embeddings", columnar.table(
+        "vec_embeddings", {
+            "bucket_key": [KEYS[0]] * 4,
+            "idx": list(range(4)),
+            "vector": columnar.vector_column(matrix),
+        }
+    ))
+    loaded = columnar.read_partitions(tmp_path, "vec_embeddings", KEYS[:1])
+    assert np.array_equal(columnar.vectors(loaded.column("vector")), matrix)
+
+
+def test_export_is_opt_in(tmp_path: Path):
+    io_manager = resources.BucketIOManager(root=str(tmp_path))
+    io_manager.handle_output(
+        dg.build_output_context(
+            asset_key=dg.AssetKey("chunks"),
+            partition_key=KEYS[0],
+        ),
+        _chunks([KEYS[0]], ["a"])
+    )
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,61 @@
+import pytest
+from ingestion_pipeline_simple.utils import markdown_plain
+from ingestion_pipeline_simple.utils.markdown_plain import OffsetMap, to_plain
+
+
+@pytest.mark.parametrize("md, plain", [
+    ("# Title #\n", "Title\n"),
+    ("Some **bold** and _em_ text", "Some bold and em text"),
+    ("keep snake_case_names", "keep snake_case_names"),
+    ("5 * 3 and a*b", "5 * 3 and a*b"),
+    ("an *unpaired star and a *pair*", "an *unpaired star and a pair"),
+    ("**bold with _em_ inside** and ~~gone~~",
+     "bold with em inside and gone"),
+    ("a `x * y` span", "a x * y span"),
+    ("see [the docs](http://x.io \"t\") now", "see the docs now"),
+    ("![alt *text*](a.png)", "alt text"),
+    ("<https://example.org>", "https://example.org"),
+    ("a <b>bold</b> tag", "a bold tag"),
+    (r"\*not em\*", "*not em*"),
+    ("> quoted\n> - item\n", "quoted\nitem\n"),
+    ("- [x] done\n2. two\n", "done\ntwo\n"),
+    ("para\n\n---\n\nnext\n", "para\n\n\nnext\n"),
+    ("Title\n=====\n", "Title\n"),
+    ("[ref]: http://x.io\ntext\n", "text\n"),
+    ("```py\nx = a*b\n```\n", "x = a*b\n"),
+    ("| A | B |\n|---|:-:|\n| 1 | *2* |\n", "A\tB\n1\t2\n"),
+    ("a | b\n", "a | b\n"),
+])
+def test_to_plain(md: str, plain: str):
+    assert to_plain(md).text == plain
+
+
+def test_offsets_point_at_source():
+    md = markdown_plain.sample_markdown(4000)
+    plain = to_plain(md)
+    assert plain.offsets.length == len(plain.text)
+    for pos, char in enumerate(plain.text):
+        if char != markdown_plain.CELL_SEP:
+            assert md[plain.offsets.to_source(pos)] == char
+
+    start = plain.text.index("snake_case_words")
+    md_start, md_end = plain.offsets.source_span(start, start + 16)
+    assert md[md_start:md_end] == "snake_case_words"
+    # A span over stripped syntax covers the syntax too
+    start = plain.text.index("bold remarks")
+    md_start, md_end = plain.offsets.source_span(start, start + 12)
+    assert md[md_start:md_end] == "bold** remarks"
+
+
+def test_pack_round_trip():
+    md = markdown_plain.sample_markdown(2000)
+    offsets = to_plain(md).offsets
+    unpacked = OffsetMap.unpack(offsets.pack())
+    assert all(
+        unpacked.to_source(pos) == offsets.to_source(pos)
+        for pos in range(offsets.length + 1)
+    )
+
+
+def test_bench():
+    assert markdown_plain.bench(size_mb=0.1, repeat=1) > 0
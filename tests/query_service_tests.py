@@ -0,0 +1,103 @@
+import asyncio
+import threading
+from pathlib import Path
+from ingestion_pipeline_simple.defs import resources
+from ingestion_pipeline_simple.utils import ingest_daemon, query_service
+
+
+def test_fuse():
+    fused = query_service.fuse([["a", "b", "c"], ["c", "d"]], k=1)
+    assert [item for item, _ in fused] == ["c", "a", "b", "d"]
+    assert fused[0][1] == 1 / 4 + 1 / 2
+
+
+def test_result_cache():
+    now = [0.0]
+    cache = query_service.ResultCache(maxsize=2, ttl_s=10,
+                                      clock=lambda: now[0])
+    assert cache.put("q1", [1], {"/a"}, cache.token())
+    assert cache.put("q2", [2], {"/a", "/b"}, cache.token())
+    assert cache.get("q1") == [1]
+    # q2 is the least recently used
+    assert cache.put("q3", [3], {"/c"}, cache.token())
+    assert cache.get("q2") is None
+    assert cache.invalidate(["/a", "/x"]) == 1
+    assert cache.get("q1") is None and cache.get("q3") == [3]
+    now[0] = 10
+    assert cache.get("q3") is None
+    assert (cache.hits, cache.misses) == (2, 3)
+
+    # A result computed across an invalidation is not kept
+    token = cache.token()
+    cache.invalidate(["/b"])
+    assert not cache.put("q4", [4], {"/c"}, token)
+    assert len(cache) == 0
+
+
+def test_query_service(tmp_path: Path):
+    files_dir = tmp_path / "bucket" / "org" / "usr"
+    files_dir.mkdir(parents=True)
+    texts = {
+        "a.bin": "Apples and pears grow in orchards.",
+        "b.bin": "Rust proofing for steel bridges.",
+        "c.bin": "Orchards need bees to pollinate apples.",
+    }
+    for name, text in texts.items():
+        (files_dir / name).write_text(text, encoding="utf-8")
+    db = resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
+    bucket = resources.BucketResource(bucket_path=str(tmp_path / "bucket"),
+                                      org="org", usr="usr")
+
+    def ingest() -> None:
+        daemon = ingest_daemon.Daemon(db, bucket, poll_seconds=0.05)
+        assert asyncio.run(daemon.run(once=True))["failed"] == 0
+
+    ingest()
+    service = query_service.QueryService(db, refresh_seconds=0)
+    hits = service.search("apples orchards")
+    assert {hit.doc_key for hit in hits[:2]} \
+        == {"/org/usr/a.bin", "/org/usr/c.bin"}
+    assert all(hit.vector_score is not None for hit in hits)
+    assert hits[0].keyword_score is not None and "[" in hits[0].snippet
+    assert hits[0][2:4] == (0, len(texts[Path(hits[0].doc_key).name]))
+    assert [hit.doc_key for hit in service.search("steel", mode="keyword")] \
+        == ["/org/usr/b.bin"]
+    assert [hit.doc_key for hit in service.search("apples",
+                                                  prefix="/org/usr/c")] \
+        == ["/org/usr/c.bin"]
+
+    assert service.search("apples orchards") == hits
+    assert service.cache.hits == 1
+    # Writes hold the write lock; queries neither wait for nor see them
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM chunks")
+        found = []
+        reader = threading.Thread(
+            target=lambda: found.append(service.search("bees"))
+        )
+        reader.start()
+        reader.join(timeout=5)
+        assert found and found[0][0].doc_key == "/org/usr/c.bin"
+        conn.rollback()
+
+    # Re-materializing a.bin drops the cached results holding it only
+    (files_dir / "a.bin").write_text("Nothing about fruit.", encoding="utf-8")
+    ingest()
+    assert service.refresh() == 2
+    assert service.search("steel", mode="keyword")[0].doc_key \
+        == "/org/usr/b.bin"
+    assert service.cache.hits == 2
+    hits = service.search("apples orchards", mode="keyword")
+    assert [hit.doc_key for hit in hits] == ["/org/usr/c.bin"]
+
+    # So does purging a deleted document
+    assert service.search("bees", mode="keyword")[0].doc_key \
+        == "/org/usr/c.bin"
+    (files_dir / "c.bin").unlink()
+    ingest()
+    assert service.refresh() == 3
+    hits = service.cache.hits
+    assert service.search("steel", mode="keyword")[0].doc_key \
+        == "/org/usr/b.bin"
+    assert service.cache.hits == hits + 1
+    assert service.search("bees", mode="keyword") == []
@@ -0,0 +1,118 @@
+import dagster as dg
+import os
+import pytest
+from pathlib import Path
+from moto import mock_aws
+from ingestion_pipeline_simple.defs import resources, sensors
+from ingestion_pipeline_simple.utils import db_utils, s3_bucket
+
+BUCKET_NAME = "test-bucket"
+
+
+@pytest.fixture
+def client(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    with mock_aws():
+        # The shared client must be created inside the mock
+        s3_bucket._CLIENTS.clear()
+        client = s3_bucket.get_client()
+        client.create_bucket(Bucket=BUCKET_NAME)
+        yield client
+        s3_bucket._CLIENTS.clear()
+
+
+@pytest.fixture
+def db(tmp_path: Path):
+    db_path = tmp_path / "test.db"
+    yield resources.SQLiteResource(db_path=str(db_path))
+    db_utils.get_pool(db_path).close()
+
+
+def _put(client, key: str, body: bytes) -> None:
+    client.put_object(Bucket=BUCKET_NAME, Key=key, Body=body)
+
+
+def test_list_changes(client, db: resources.SQLiteResource):
+    for idx in range(3):
+        _put(client, f"org/usr/files/{idx}.bin", b"hello")
+
+    delta = s3_bucket.list_changes(db, client, BUCKET_NAME, "org/usr/",
+                                   max_pages=1, page_size=2)
+    assert len(delta.added) == 2 and delta.token is not None
+    delta = s3_bucket.list_changes(db, client, BUCKET_NAME, "org/usr/",
+                                   token=delta.token,
+                                   generation=delta.generation,
+                                   max_pages=1, page_size=2)
+    assert len(delta.added) == 1 and delta.token is None
+    assert delta.generation == 2 and not delta.deleted
+
+    _put(client, "org/usr/files/0.bin", b"changed")
+    client.delete_object(Bucket=BUCKET_NAME, Key="org/usr/files/1.bin")
+    delta = s3_bucket.list_changes(db, client, BUCKET_NAME, "org/usr/",
+                                   generation=delta.generation)
+    assert [obj.key for obj in delta.added] == []
+    assert [obj.key for obj in delta.changed] == ["org/usr/files/0.bin"]
+    assert delta.deleted == ["org/usr/files/1.bin"]
+
+
+def test_fetch(client, tmp_path: Path):
+    body = os.urandom(3 * 1024 + 5)
+    _put(client, "org/usr/files/big.bin", body)
+    path = s3_bucket.fetch(client, BUCKET_NAME, "org/usr/files/big.bin",
+                           tmp_path / "spool", part_size=1024)
+    assert path.read_bytes() == body
+    assert path.name == "big.bin"
+    # Unchanged objects are served from the spool
+    assert s3_bucket.fetch(client, BUCKET_NAME, "org/usr/files/big.bin",
+                           tmp_path / "spool", part_size=1024) == path
+
+    # A new version replaces the old copy
+    _put(client, "org/usr/files/big.bin", b"changed")
+    new_path = s3_bucket.fetch(client, BUCKET_NAME, "org/usr/files/big.bin",
+                               tmp_path / "spool")
+    assert new_path.read_bytes() == b"changed"
+    assert not path.exists()
+    assert [entry.name for entry in new_path.parents[1].iterdir()] \
+        == [new_path.parent.name]
+
+
+def test_sensor_s3(client, db: resources.SQLiteResource, tmp_path: Path):
+    _put(client, "org/usr/files/dummy.bin", b"hello world")
+    bucket = resources.BucketResource(
+        bucket_path="",
+        org="org",
+        usr="usr",
+        backend="s3",
+        s3_bucket=BUCKET_NAME,
+        spool_path=str(tmp_path / "spool"),
+    )
+    context = dg.build_sensor_context(
+        instance=dg.DagsterInstance.ephemeral(),
+        resources={"bucket": bucket, "db": db}
+    )
+    res = sensors.file_monitor(context)
+    assert res.run_requests is not None and len(res.run_requests) == 1
+    [run_req] = res.run_requests
+    assert run_req.partition_key == "/org/usr/files/dummy.bin"
+    file_path = run_req.run_config["ops"]["binary_files"]["config"]["file_path"]
+    assert file_path == f"s3://{BUCKET_NAME}/org/usr/files/dummy.bin"
+    assert Path(bucket.fetch(file_path)).read_bytes() == b"hello world"
+
+    res = sensors.file_monitor(context)
+    assert res.run_requests is not None and len(res.run_requests) == 0
+
+
+def test_purge_evicts_spool(client, db: resources.SQLiteResource,
+                            tmp_path: Path):
+    _put(client, "org/usr/files/gone.bin", b"bye")
+    bucket = resources.BucketResource(
+        bucket_path="", org="org", usr="usr", backend="s3",
+        s3_bucket=BUCKET_NAME, spool_path=str(tmp_path / "spool"),
+    )
+    path = Path(bucket.fetch(bucket.source_path("/org/usr/files/gone.bin")))
+    db.tombstone(["/org/usr/files/gone.bin"])
+    assert sensors.purge_deleted(db, print, bucket=bucket) \
+        == ["/org/usr/files/gone.bin"]
+    assert not path.exists()
+    assert not path.parents[1].exists()
@@ -0,0 +1,91 @@
+import os
+import pytest
+from pathlib import Path
+from ingestion_pipeline_simple.defs import resources
+from ingestion_pipeline_simple.utils import db_utils, scan_index
+
+
+@pytest.fixture
+def db(tmp_path: Path):
+    db_path = tmp_path / "test.db"
+    yield resources.SQLiteResource(db_path=str(db_path))
+    db_utils.get_pool(db_path).close()
+
+
+@pytest.fixture
+def root(tmp_path: Path) -> Path:
+    root = tmp_path / "bucket"
+    os.makedirs(root / "a" / "b")
+    return root
+
+
+def _paths(entries: list[scan_index.ScanEntry]) -> set[str]:
+    return {entry.path for entry in entries}
+
+
+def test_scan_added(db: resources.SQLiteResource, root: Path):
+    (root / "x.bin").write_text("x")
+    (root / "a" / "b" / "y.bin").write_text("y")
+    delta = scan_index.scan(db, root)
+    assert _paths(delta.added) == {str(root / "x.bin"),
+                                   str(root / "a" / "b" / "y.bin")}
+    # Files are only stat'ed, not read
+    assert not any(entry.digest for entry in delta.added)
+
+    delta = scan_index.scan(db, root)
+    assert not delta.added and not delta.changed and not delta.deleted
+    # Nothing changed, so no directory had to be listed again
+    assert delta.dirs_listed == 0 and delta.dirs_pruned == 3
+
+
+def test_scan_same_mtime(db: resources.SQLiteResource, root: Path):
+    (root / "x.bin").write_text("x")
+    scan_index.scan(db, root)
+    # A later file with an older mtime is still picked up
+    (root / "y.bin").write_text("y")
+    os.utime(root / "y.bin", ns=(0, os.stat(root / "x.bin").st_mtime_ns - 10))
+    delta = scan_index.scan(db, root)
+    assert _paths(delta.added) == {str(root / "y.bin")}
+
+
+def test_scan_changed(db: resources.SQLiteResource, root: Path):
+    (root / "x.bin").write_text("x")
+    scan_index.scan(db, root)
+
+    os.utime(root / "x.bin", ns=(0, 1))
+    delta = scan_index.scan(db, root, full=True)
+    assert _paths(delta.changed) == {str(root / "x.bin")}
+
+    (root / "x.bin").write_text("xx")
+    delta = scan_index.scan(db, root, full=True)
+    assert _paths(delta.changed) == {str(root / "x.bin")}
+
+
+def test_scan_changed_digests(db: resources.SQLiteResource, root: Path):
+    (root / "x.bin").write_text("x")
+    delta = scan_index.scan(db, root, compute_digests=True)
+    assert all(entry.digest for entry in delta.added)
+
+    # Touched but identical content is not a change
+    os.utime(root / "x.bin", ns=(0, 1))
+    delta = scan_index.scan(db, root, full=True, compute_digests=True)
+    assert not delta.changed
+
+    (root / "x.bin").write_text("xx")
+    delta = scan_index.scan(db, root, full=True, compute_digests=True)
+    assert _paths(delta.changed) == {str(root / "x.bin")}
+
+
+def test_scan_deleted(db: resources.SQLiteResource, root: Path):
+    (root / "x.bin").write_text("x")
+    (root / "a" / "b" / "y.bin").write_text("y")
+    scan_index.scan(db, root)
+
+    os.remove(root / "x.bin")
+    os.remove(root / "a" / "b" / "y.bin")
+    os.rmdir(root / "a" / "b")
+    delta = scan_index.scan(db, root)
+    assert set(delta.deleted) == {str(root / "x.bin"),
+                                  str(root / "a" / "b" / "y.bin")}
+    delta = scan_index.scan(db, root)
+    assert not delta.deleted
@@ -1,10 +1,12 @@
 import dagster as dg
 import pytest
 from unittest.mock import patch, Mock
-from ingestion_pipeline_simple.defs import sensors
+from ingestion_pipeline_simple.defs import sensors, resources
+from ingestion_pipeline_simple.utils import columnar, instrumentation
 # from ..test_bucket import handle_files
 from pathlib import Path
 import os
+import json
 
 # Need to test:
 #   - If it triggers correctly
@@ -28,7 +30,8 @@ def test_sensor_skip(tmp_path: Path):
     context = dg.build_sensor_context(
         instance=instance,
         resources={
-            "bucket": mock_bucket
+            "bucket": mock_bucket,
+            "db": resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
         }
     )
     res = sensors.file_monitor(context)
@@ -40,7 +43,7 @@ def test_sensor_skip(tmp_path: Path):
     assert res.dynamic_partitions_requests is not None \
         and len(res.dynamic_partitions_requests[0].partition_keys) == 0
     assert res.cursor is not None \
-        and float(res.cursor) == 0
+        and json.loads(res.cursor)["last_full_scan"] > 0
 
 
 def test_sensor_run(tmp_path: Path):
@@ -66,7 +69,8 @@ def test_sensor_run(tmp_path: Path):
     context = dg.build_sensor_context(
         instance=instance,
         resources={
-            "bucket": mock_bucket
+            "bucket": mock_bucket,
+            "db": resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
         }
     )
     res = sensors.file_monitor(context)
@@ -77,4 +81,269 @@ def test_sensor_run(tmp_path: Path):
     assert res.dynamic_partitions_requests is not None \
         and len(res.dynamic_partitions_requests[0].partition_keys) == 1
     assert res.cursor is not None \
-        and float(res.cursor) > 0
\ No newline at end of file
+        and json.loads(res.cursor)["last_full_scan"] > 0
+    # Nothing changed, so the next tick launches nothing
+    res = sensors.file_monitor(context)
+    assert res.run_requests is not None \
+        and len(res.run_requests) == 0
+
+def test_sensor_batch(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(sensors.assets, "RUN_BATCH_SIZE", 2)
+    mock_bucket = Mock()
+    mock_bucket.bucket_path = tmp_path
+    mock_bucket.org = "org"
+    mock_bucket.usr = "usr"
+    dirpath = Path(
+        mock_bucket.bucket_path,
+        mock_bucket.org,
+        mock_bucket.usr
+    )
+    os.makedirs(dirpath, exist_ok=True)
+    for idx in range(3):
+        (dirpath / f"dummy{idx}.bin").write_text(
+            "hello world", encoding="utf-8"
+        )
+    instance = dg.DagsterInstance.ephemeral()
+    context = dg.build_sensor_context(
+        instance=instance,
+        resources={
+            "bucket": mock_bucket,
+            "db": resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
+        }
+    )
+    res = sensors.file_monitor(context)
+    assert isinstance(res, dg.SensorResult)
+    assert res.run_requests is not None \
+        and len(res.run_requests) == 2
+    batch, single = res.run_requests
+    assert batch.partition_key_range is not None
+    batch_paths = batch.run_config["ops"]["binary_files"]["config"]["file_paths"]
+    assert list(batch_paths) == [batch.partition_key_range.start,
+                                 batch.partition_key_range.end]
+    assert single.partition_key is not None
+    assert res.dynamic_partitions_requests is not None \
+        and len(res.dynamic_partitions_requests[0].partition_keys) == 3
+
+
+def _bucket_context(tmp_path: Path,
+                    sizes: list[int],
+                    cursor: str | None = None):
+    mock_bucket = Mock()
+    mock_bucket.bucket_path = tmp_path
+    mock_bucket.org = "org"
+    mock_bucket.usr = "usr"
+    mock_bucket.backend = "local"
+    dirpath = Path(tmp_path, "org", "usr")
+    os.makedirs(dirpath, exist_ok=True)
+    for idx, size in enumerate(sizes):
+        (dirpath / f"dummy{idx}.bin").write_bytes(b"x" * size)
+    db = resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
+    context = dg.build_sensor_context(
+        instance=dg.DagsterInstance.ephemeral(),
+        cursor=cursor,
+        resources={"bucket": mock_bucket, "db": db}
+    )
+    return context, db
+
+
+def _runs_count(small: int, large: int = 0):
+    """`get_runs_count` stand-in for the given in-flight runs per lane."""
+    return lambda filters: large if filters.tags else small + large
+
+
+def test_sensor_backpressure(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(sensors.assets, "RUN_BATCH_SIZE", 1)
+    monkeypatch.setattr(sensors, "MAX_IN_FLIGHT_RUNS", 2)
+    context, db = _bucket_context(tmp_path, [10, 10, 10])
+
+    with patch.object(dg.DagsterInstance, "get_runs_count",
+                      side_effect=_runs_count(1)):
+        res = sensors.file_monitor(context)
+    # One slot free: one run admitted, the rest wait in the backlog
+    assert len(res.run_requests) == 1
+    assert db.backlog_size() == 2
+
+    with patch.object(dg.DagsterInstance, "get_runs_count",
+                      side_effect=_runs_count(2)):
+        res = sensors.file_monitor(context)
+    assert len(res.run_requests) == 0
+    assert db.backlog_size() == 2
+
+    res = sensors.file_monitor(context)
+    assert len(res.run_requests) == 2
+    assert db.backlog_size() == 0
+    with db.connection() as conn:
+        assert conn.execute(
+            "SELECT COUNT(*) FROM ingest_backlog"
+        ).fetchone()[0] == 2
+    # The next tick settles the committed admissions
+    res = sensors.file_monitor(context)
+    assert len(res.run_requests) == 0
+    with db.connection() as conn:
+        assert conn.execute(
+            "SELECT COUNT(*) FROM ingest_backlog"
+        ).fetchone()[0] == 0
+
+
+def test_sensor_uncommitted_tick_is_retried(tmp_path: Path):
+    context, db = _bucket_context(tmp_path, [10])
+    res = sensors.file_monitor(context)
+    assert len(res.run_requests) == 1
+    # The tick's result was lost: a tick from the old cursor admits again
+    retry, _ = _bucket_context(tmp_path, [], cursor=None)
+    res = sensors.file_monitor(retry)
+    assert len(res.run_requests) == 1
+    assert db.backlog_size() == 0
+
+
+def test_sensor_size_order(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(sensors.assets, "RUN_BATCH_SIZE", 1)
+    monkeypatch.setattr(sensors, "MAX_IN_FLIGHT_RUNS", 1)
+    monkeypatch.setattr(sensors, "ADMISSION_ORDER", "size")
+    context, db = _bucket_context(tmp_path, [30, 10, 20])
+    admitted = []
+    for _ in range(3):
+        [run] = sensors.file_monitor(context).run_requests
+        admitted.append(run.partition_key)
+    assert admitted == ["/org/usr/dummy1.bin", "/org/usr/dummy2.bin",
+                        "/org/usr/dummy0.bin"]
+
+
+def test_sensor_sizes_batches_from_stats(tmp_path: Path):
+    context, db = _bucket_context(tmp_path, [10, 10, 10, 40])
+    # Observed: 50s per document over all stages, 10 bytes on average
+    stats = instrumentation.StageStats(
+        "binary_files", partitions=2, wall_s=20.0, bytes_in=20
+    )
+    db.record_stage_stats(stats)
+    db.record_stage_stats(instrumentation.StageStats(
+        "markdown_files", partitions=2, wall_s=80.0
+    ))
+    res = sensors.file_monitor(context)
+    # 120s target: two average documents per run, the large one alone
+    sizes = [
+        len(run.run_config["ops"]["binary_files"]["config"].get(
+            "file_paths", [None]
+        ))
+        for run in res.run_requests
+    ]
+    assert sizes == [2, 1, 1]
+
+
+def test_sensor_large_file_lane(tmp_path: Path,
+                                monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(sensors.assets, "LARGE_FILE_BYTES", 100)
+    monkeypatch.setattr(sensors, "MAX_IN_FLIGHT_RUNS", 1)
+    context, db = _bucket_context(tmp_path, [500, 10, 600, 10])
+
+    res = sensors.file_monitor(context)
+    lanes = [
+        (run.tags[sensors.LANE_TAG], run.partition_key
+         or f"{run.partition_key_range.start}..{run.partition_key_range.end}")
+        for run in res.run_requests
+    ]
+    # Small files share one run; one large file gets a run of its own
+    assert lanes == [
+        ("small", "/org/usr/dummy1.bin../org/usr/dummy3.bin"),
+        ("large", "/org/usr/dummy0.bin"),
+    ]
+    assert db.backlog_size() == 1
+
+    # A busy small lane does not hold up the other large file, nor the
+    # other way round
+    (Path(tmp_path, "org", "usr") / "dummy4.bin").write_bytes(b"x" * 10)
+    with patch.object(dg.DagsterInstance, "get_runs_count",
+                      side_effect=_runs_count(1)):
+        [run] = sensors.file_monitor(context).run_requests
+    assert (run.tags[sensors.LANE_TAG], run.partition_key) \
+        == ("large", "/org/usr/dummy2.bin")
+    with patch.object(dg.DagsterInstance, "get_runs_count",
+                      side_effect=_runs_count(0, large=1)):
+        [run] = sensors.file_monitor(context).run_requests
+    assert (run.tags[sensors.LANE_TAG], run.partition_key) \
+        == ("small", "/org/usr/dummy4.bin")
+
+
+def test_sensor_deletes(tmp_path: Path):
+    files_dir = tmp_path / "org" / "usr"
+    files_dir.mkdir(parents=True)
+    (files_dir / "a.bin").write_text("a", encoding="utf-8")
+    (files_dir / "b.bin").write_text("b", encoding="utf-8")
+    store = tmp_path / "store"
+    db = resources.SQLiteResource(db_path=str(tmp_path / "test.db"),
+                                  store_root=str(store))
+    instance = dg.DagsterInstance.ephemeral()
+    bucket = resources.BucketResource(bucket_path=str(tmp_path),
+                                      org="org", usr="usr")
+    context = dg.build_sensor_context(
+        instance=instance,
+        resources={"bucket": bucket, "db": db}
+    )
+    res = sensors.file_monitor(context)
+    keys = res.dynamic_partitions_requests[0].partition_keys
+    assert sorted(keys) == ["/org/usr/a.bin", "/org/usr/b.bin"]
+    instance.add_dynamic_partitions("files", keys)
+    for key in keys:
+        db.put_stage(key, "md_rep", "text")
+    stored = columnar.partition_dir(store, "chunks", "/org/usr/a.bin")
+    stored.mkdir(parents=True)
+
+    (files_dir / "a.bin").unlink()
+    before = context.cursor
+    res = sensors.file_monitor(context)
+    assert len(res.dynamic_partitions_requests) == 2
+    delete = res.dynamic_partitions_requests[1]
+    assert isinstance(delete, dg.DeleteDynamicPartitionsRequest)
+    assert delete.partition_keys == ["/org/usr/a.bin"]
+    assert db.get_stage("/org/usr/a.bin", "md_rep") is None
+    assert db.get_stage("/org/usr/b.bin", "md_rep") == "text"
+    assert not stored.exists()
+
+    # Asked again by a tick that did not commit, not by later ones
+    retry = dg.build_sensor_context(
+        instance=instance, cursor=before,
+        resources={"bucket": bucket, "db": db}
+    )
+    res = sensors.file_monitor(retry)
+    assert res.dynamic_partitions_requests[1].partition_keys \
+        == ["/org/usr/a.bin"]
+    res = sensors.file_monitor(context)
+    assert len(res.dynamic_partitions_requests) == 1
+    instance.delete_dynamic_partition("files", "/org/usr/a.bin")
+
+    # A file that comes back is ingested again, not deleted
+    (files_dir / "a.bin").write_text("a again", encoding="utf-8")
+    res = sensors.file_monitor(context)
+    assert len(res.dynamic_partitions_requests) == 1
+    assert res.dynamic_partitions_requests[0].partition_keys \
+        == ["/org/usr/a.bin"]
+    assert db.tombstones() == []
+
+
+def test_sensor_readmits_reuploaded_file(tmp_path: Path):
+    files_dir = tmp_path / "org" / "usr"
+    files_dir.mkdir(parents=True)
+    (files_dir / "a.bin").write_text("a", encoding="utf-8")
+    db = resources.SQLiteResource(db_path=str(tmp_path / "test.db"))
+    instance = dg.DagsterInstance.ephemeral()
+    context = dg.build_sensor_context(
+        instance=instance,
+        resources={
+            "bucket": resources.BucketResource(bucket_path=str(tmp_path),
+                                               org="org", usr="usr"),
+            "db": db,
+        }
+    )
+    [first] = sensors.file_monitor(context).run_requests
+    instance.add_dynamic_partitions("files", ["/org/usr/a.bin"])
+
+    (files_dir / "a.bin").unlink()
+    sensors.file_monitor(context)
+    instance.delete_dynamic_partition("files", "/org/usr/a.bin")
+
+    # Same bytes again: Dagster never launches a run key twice, so the
+    # new run must not reuse the old one's
+    (files_dir / "a.bin").write_text("a", encoding="utf-8")
+    [again] = sensors.file_monitor(context).run_requests
+    assert again.partition_key == "/org/usr/a.bin"
+    assert again.run_key != first.run_key